@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""ORCAFlashCapture
+Max Snelling
+
+Statistics on frame delivery during an acquisition, to check whether the
+software keeps up with the camera:
+
+ - intervals between the camera timestamps of consecutive frames
+ - missed frames, from gaps in the camera framestamps
+ - the backlog of frames waiting in the camera buffers each time they are
+   checked, and how often it overran the buffers
+ - the time taken to copy frames out of the camera buffers
+"""
+import numpy as np
+import threading
+
+class AcquisitionStats:
+    """Collect statistics on the frames delivered by the camera.
+
+    The camera calls add_frames, add_backlog and add_copy as frames are
+    delivered. Totals are kept for the whole acquisition, and the last
+    history frame intervals are kept for the percentiles.
+
+    Keyword arguments:
+    history -- number of the most recent frame intervals to keep
+    """
+    def __init__(self, history=10000):
+        self.history = history
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear the statistics for a new acquisition."""
+        with self.lock:
+            self.n_frames = 0         # frames delivered
+            self.missed = 0           # frames missing from the framestamps
+            self.last_stamp = None    # framestamp of the last frame
+            self.last_time = None     # timestamp of the last frame
+            self.first_time = None    # timestamp of the first frame
+            self.intervals = np.zeros(self.history) # ring of recent intervals
+            self.n_intervals = 0      # total number of intervals
+            self.interval_sum = 0.
+            self.interval_sum2 = 0.
+            self.n_checks = 0         # number of times the backlog was checked
+            self.backlog_max = 0      # high-water mark of frames waiting in the camera buffers
+            self.backlog_sum = 0
+            self.overruns = 0         # checks where the backlog was more than the buffers
+            self.copy_time = 0.       # total time spent copying frames
+            self.copy_max = 0.        # longest time for one copy
+            self.n_copied = 0
+
+    def add_frames(self, framestamps, timestamps):
+        """Add the framestamps and timestamps (in seconds) of new frames,
+        in the order they were taken."""
+        stamps = np.asarray(framestamps, dtype=int)
+        times = np.asarray(timestamps, dtype=float)
+        if not np.size(stamps):
+            return
+        with self.lock:
+            if self.last_stamp is not None: # join onto the previous frames
+                stamps = np.concatenate(([self.last_stamp], stamps))
+                times = np.concatenate(([self.last_time], times))
+            elif self.first_time is None:
+                self.first_time = times[0]
+            gaps = np.diff(stamps)
+            self.missed += int(np.sum(gaps[gaps > 1] - 1))
+            dt = np.diff(times)
+            n = np.size(dt)
+            if n:
+                idx = (self.n_intervals + np.arange(n)) % self.history
+                self.intervals[idx[-self.history:]] = dt[-self.history:]
+                self.n_intervals += n
+                self.interval_sum += np.sum(dt)
+                self.interval_sum2 += np.dot(dt, dt)
+            self.n_frames += np.size(framestamps)
+            self.last_stamp, self.last_time = stamps[-1], times[-1]
+
+    def add_backlog(self, backlog, n_buffers):
+        """Add the number of new frames found in n_buffers camera buffers."""
+        with self.lock:
+            self.n_checks += 1
+            self.backlog_sum += backlog
+            self.backlog_max = max(self.backlog_max, backlog)
+            if backlog > n_buffers:
+                self.overruns += 1
+
+    def add_copy(self, seconds, n_frames=1):
+        """Add the time taken to copy n_frames out of the camera buffers."""
+        with self.lock:
+            self.copy_time += seconds
+            self.copy_max = max(self.copy_max, seconds)
+            self.n_copied += n_frames
+
+    def summary(self):
+        """Return a dictionary of the statistics so far."""
+        with self.lock:
+            n = self.n_intervals
+            recent = self.intervals[:min(n, self.history)]
+            mean = self.interval_sum / n if n else 0.
+            return {'frames': self.n_frames, 'missed': self.missed,
+                'rate': 1. / mean if mean > 0 else 0.,
+                'interval mean': mean,
+                'interval std': np.sqrt(max(self.interval_sum2 / n - mean**2, 0)) if n else 0.,
+                'interval max': np.max(recent) if n else 0.,
+                'interval 99%': np.percentile(recent, 99) if n else 0.,
+                'backlog max': self.backlog_max,
+                'backlog mean': self.backlog_sum / self.n_checks if self.n_checks else 0.,
+                'overruns': self.overruns,
+                'copy time per frame': self.copy_time / self.n_copied if self.n_copied else 0.,
+                'copy time max': self.copy_max}
+
+    def __str__(self):
+        s = self.summary()
+        return ("{frames} frames at {rate:.1f} fps, {missed} missed; interval {mean:.3g} +/- "
+            "{std:.2g} s (max {imax:.3g} s); backlog max {backlog max}, {overruns} overruns; "
+            "copy {copy:.3g} s per frame").format(mean=s['interval mean'], std=s['interval std'],
+            imax=s['interval max'], copy=s['copy time per frame'], **s)
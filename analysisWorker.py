@@ -0,0 +1,238 @@
+"""ORCAFlashCapture
+Max Snelling
+
+Run the image analysis in a separate thread from the GUI.
+
+ - images (file paths or arrays) are put in a bounded queue
+ - the worker takes all of the images waiting in the queue and processes
+   them together with the image handlers
+ - lightweight results (histograms, latest counts, the last image) are
+   emitted back to the GUI at most once every refresh seconds
+ - the optional accumulator keeps the sum of all of the images, and the
+   mean image can be sent instead of the last image, at most once every
+   acc_refresh seconds
+
+The image handlers are shared with the GUI, so the GUI should hold the
+worker's lock when it changes them.
+"""
+import numpy as np
+import os
+import time
+import threading
+import queue
+try:
+    from PyQt4.QtCore import QThread, pyqtSignal
+except ModuleNotFoundError:
+    from PyQt5.QtCore import QThread, pyqtSignal
+
+####    ####    ####    ####
+
+class analysis_worker(QThread):
+    """Consume images from a queue and process them with the image handlers.
+
+    Each item in the queue is (image, label, mode, release):
+    image   -- the path to an image file, an image array indexed [x, y],
+                or a stack of images indexed [image, x, y]. getFrameStack
+                reuses its array for the next call, so queue a copy of it.
+    label   -- the label for the files array (None for a file, which uses
+                the file name), or a list of labels for a stack (None
+                uses the image numbers)
+    mode    -- 'thresh' to update the threshold with hist_and_thresh,
+                'fixed' to keep the threshold with histogram, or None to
+                only process the image without updating the display
+    release -- None, or a function called when the image is no longer
+                needed. For an image array, if it returns False the image 
+                was corrupted while it was being processed (e.g. overwritten
+                by the camera) and the count is discarded. For a file, it's
+                called once the file has been loaded, e.g. so that it can be
+                deleted.
+    The optional site_handler (an imageHandler.multi_site_handler) gets the
+    counts of every site of an array from the same images.
+    The optional accumulator (an imageHandler.image_accumulator) adds up
+    the images, split by whether image_handler[0] found an atom, while an
+    accumulated image is chosen to display (display is not 'last').
+    Keyword arguments:
+    image_handler -- the list of image handlers to process images with
+    maxsize       -- the maximum number of images waiting in the queue.
+                    add() blocks when the queue is full, unless block=False.
+    refresh       -- minimum time in seconds between emitting results
+    chunk         -- maximum number of files to load and process at once
+    """
+    results = pyqtSignal(object) # dict of results to display
+
+    def __init__(self, image_handler, maxsize=1000, refresh=0.1, chunk=64):
+        super().__init__()
+        self.image_handler = image_handler
+        self.site_handler = None        # multi_site_handler for array ROIs, set with the lock held
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.RLock()   # hold while using the image handlers
+        self.refresh = refresh
+        self.chunk = chunk
+        self.show_im = True             # whether to send the last image with the results
+        self.accumulator = None         # image_accumulator summing the images, set with the lock held
+        self.display = 'last'           # image to send: 'last', 'mean', 'atom', 'empty', or 'std'
+        self.acc_refresh = 1            # minimum time in seconds between sending accumulated images
+        self.last_acc = 0               # time an accumulated image was last sent
+        self.dropped = 0                # images not queued because the queue was full
+        self.running = False
+        self.int_time = 0               # time taken to process an image
+        self.last_emit = 0              # time the results were last emitted
+
+    def add(self, image, label=None, mode='thresh', release=None, block=True):
+        """Put an image in the queue to be processed. If block is False and
+        the queue is full, raises queue.Full instead of waiting."""
+        self.queue.put((image, label, mode, release), block)
+
+    def start(self):
+        """Start processing images. running is set here rather than in run
+        so that stop() straight after start() still stops the thread."""
+        self.running = True
+        super().start()
+
+    def stop(self):
+        """Stop the thread once it has processed all of the images waiting
+        in the queue, so that none are missing from the saved results"""
+        self.running = False
+        self.wait()
+
+    def get_items(self, timeout):
+        """Wait up to timeout seconds for an item in the queue, then take
+        the rest of the items that are waiting, up to chunk items."""
+        try:
+            items = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(items) < self.chunk:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def process(self, items):
+        """Process the images with each of the image handlers. Consecutive
+        file paths are loaded once and processed together as a batch.
+        Returns the last image processed."""
+        last_im = None
+        i = 0
+        while i < len(items):
+            image, label, mode, release = items[i]
+            if isinstance(image, str):
+                j = i
+                while j < len(items) and isinstance(items[j][0], str):
+                    j += 1
+                stack, labels = self.image_handler[0].load_batch([x[0] for x in items[i:j]])
+                for im_han in self.image_handler:
+                    im_han.process_batch(stack, labels)
+                if self.site_handler is not None:
+                    self.site_handler.process_batch(stack, labels)
+                if self.accumulator is not None and self.display != 'last' and len(labels):
+                    self.accumulator.add(stack, self.atoms(len(labels)))
+                if len(labels):
+                    last_im = stack[-1]
+                for x in items[i:j]:
+                    if x[3] is not None:
+                        x[3]() # the file has been loaded
+                i = j
+            else:
+                n = 1
+                for im_han in self.image_handler:
+                    if np.ndim(image) == 3:
+                        n = im_han.process_batch(image, label)
+                    else:
+                        im_han.process_frame(image, label)
+                m = 0
+                if self.site_handler is not None:
+                    if np.ndim(image) == 3:
+                        m = self.site_handler.process_batch(image, label)
+                    else:
+                        m = self.site_handler.process_frame(image, label)
+                accumulate = self.accumulator is not None and self.display != 'last' and n
+                copied = False
+                if accumulate and release is not None:
+                    image, copied = np.array(image), True # copy before it is released
+                if self.show_im and mode and n:
+                    last_im = image[-1] if np.ndim(image) == 3 else image
+                    if not copied:
+                        last_im = np.array(last_im) # copy before it is released
+                if release is not None and not release():
+                    for im_han in self.image_handler:
+                        im_han.discard(n)
+                    if self.site_handler is not None:
+                        self.site_handler.discard(m)
+                    last_im = None
+                elif accumulate:
+                    self.accumulator.add(image, self.atoms(n))
+                i += 1
+        return last_im
+
+    def atoms(self, n):
+        """Return whether image_handler[0] found an atom in each of the last
+        n images, by comparing the counts to the current threshold."""
+        im_han = self.image_handler[0]
+        return im_han.counts[im_han.im_num-n:im_han.im_num] > im_han.thresh
+
+    def accumulated_image(self):
+        """Return the accumulated image to display, or None if it's not
+        time to send one yet."""
+        if self.accumulator is None or time.time() - self.last_acc < self.acc_refresh:
+            return None
+        self.last_acc = time.time()
+        with self.lock:
+            if self.display == 'std':
+                return self.accumulator.std()
+            return self.accumulator.mean({'mean':None, 'atom':True, 'empty':False}[self.display])
+
+    def run(self):
+        """Process the queue until stopped, emitting the results at most once
+        every refresh seconds."""
+        mode, last_im, last_name = None, None, ''
+        pending = False # there are results that haven't been emitted
+        while self.running or not self.queue.empty():
+            if pending:
+                timeout = max(self.last_emit + self.refresh - time.time(), 0)
+            else:
+                timeout = 0.1
+            items = self.get_items(timeout)
+            if items:
+                t1 = time.time()
+                with self.lock:
+                    im = self.process(items)
+                self.int_time = (time.time() - t1) / len(items)
+                for image, label, item_mode, _ in items:
+                    if item_mode:
+                        mode = item_mode
+                        pending = True
+                if im is not None:
+                    last_im = im
+                name, label = items[-1][:2]
+                if isinstance(name, str):
+                    last_name = os.path.basename(name)
+                elif np.ndim(name) == 3: # stack, name it after the last image
+                    last_name = 'frame ' + str(label[-1] if label else self.image_handler[0].im_num - 1)
+                else:
+                    last_name = 'frame ' + str(label)
+
+            if pending and time.time() - self.last_emit >= self.refresh:
+                self.emit_results(mode, last_im, last_name)
+                pending, last_im = False, None
+
+    def emit_results(self, mode, last_im, last_name):
+        """Make the histograms and emit them with the latest counts"""
+        hists = []
+        with self.lock:
+            for im_han in self.image_handler:
+                if mode == 'thresh':
+                    bins, occ, thresh = im_han.hist_and_thresh()
+                else:
+                    bins, occ, thresh = im_han.histogram()
+                hists.append({'bins':np.array(bins), 'occ':np.array(occ), 'thresh':thresh,
+                    'count':im_han.get_latest_count(), 'im_num':im_han.im_num,
+                    'atom':im_han.atom[im_han.im_num-1] if im_han.im_num else None})
+        if not self.show_im:
+            last_im = None
+        elif self.display != 'last':
+            last_im = self.accumulated_image()
+        self.results.emit({'hists':hists, 'name':last_name,
+            'image':last_im, 'int_time':self.int_time})
+        self.last_emit = time.time()
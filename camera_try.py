@@ -28,9 +28,18 @@ George 11/17 - Updated for SDK4 and to allow fixed length acquisition
 import ctypes
 import ctypes.util
 import numpy as np
+import os
+import threading
 import time
 
-import storm_control.sc_library.halExceptions as halExceptions
+import acquisitionStats
+import frameRecorder
+
+try:
+    import storm_control.sc_library.halExceptions as halExceptions
+    HardwareException = halExceptions.HardwareException
+except ModuleNotFoundError:
+    HardwareException = Exception # storm_control is only needed to use the camera with HAL
 
 
 # Hamamatsu constants.
@@ -41,6 +50,7 @@ DCAMERR_NOERROR = 1
 
 DCAMPROP_ATTR_HASRANGE = int("0x80000000", 0)
 DCAMPROP_ATTR_HASVALUETEXT = int("0x10000000", 0)
+DCAMPROP_ATTR_VOLATILE = int("0x00080000", 0)
 DCAMPROP_ATTR_READABLE = int("0x00010000", 0)
 DCAMPROP_ATTR_WRITABLE = int("0x00020000", 0)
 
@@ -90,6 +100,40 @@ DCAMCAP_START_SNAP = 0
 
 DCAMBUF_ATTACHKIND_FRAME = 0
 
+# Property cache.
+#
+# Writing one of these properties can change the value (or the range) of
+# the properties listed with it, so they are dropped from the cache and
+# read again from the camera the next time they are needed. Writing a
+# property that isn't listed here drops all of the cached values.
+_frame_dependents = ["image_rowbytes", "image_framebytes", "buffer_rowbytes",
+                     "buffer_framebytes", "buffer_top_offset_bytes"]
+_timing_dependents = ["exposure_time", "internal_frame_rate", "internal_frame_interval",
+                      "internal_line_interval", "timing_readout_time",
+                      "timing_min_trigger_interval", "timing_min_trigger_blanking",
+                      "timing_exposure", "timing_global_exposure_delay"]
+_h_dependents = ["image_width", "subarray_hpos", "subarray_hsize"] + _frame_dependents
+_v_dependents = ["image_height", "subarray_vpos", "subarray_vsize"] + _frame_dependents + _timing_dependents
+PROPERTY_DEPENDENTS = {
+    "binning" : _h_dependents + _v_dependents,
+    "subarray_hpos" : _h_dependents,
+    "subarray_hsize" : _h_dependents,
+    "subarray_mode" : _h_dependents + _v_dependents,
+    "subarray_vpos" : _v_dependents,
+    "subarray_vsize" : _v_dependents,
+    "exposure_time" : _timing_dependents,
+    "readout_speed" : _timing_dependents,
+    "sensor_mode" : _timing_dependents + _h_dependents + _v_dependents,
+    "trigger_active" : _timing_dependents,
+    "trigger_mode" : _timing_dependents,
+    "trigger_polarity" : [],
+    "trigger_source" : _timing_dependents,
+    }
+
+# Properties that change without being written, so are never cached.
+UNCACHED_PROPERTIES = ["sensor_temperature", "sensor_temperature_status",
+                       "sensor_cooler_status", "system_alive"]
+
 # Hamamatsu structures.
 
 ## DCAMAPI_INIT
@@ -155,6 +199,14 @@ class DCAMBUF_ATTACH(ctypes.Structure):
             ("buffer", ctypes.POINTER(ctypes.c_void_p)),
             ("buffercount", ctypes.c_int32)]
 
+## DCAM_TIMESTAMP
+#
+# The time a frame was captured
+#
+class DCAM_TIMESTAMP(ctypes.Structure):
+    _fields_ = [("sec", ctypes.c_uint32),
+            ("microsec", ctypes.c_int32)]
+
 ## DCAMBUF_FRAME
 #
 # The dcam buffer frame structure
@@ -171,7 +223,7 @@ class DCAMBUF_FRAME(ctypes.Structure):
             ("height", ctypes.c_int32),
             ("left", ctypes.c_int32),
             ("top", ctypes.c_int32),
-            ("timestamp", ctypes.c_int32),
+            ("timestamp", DCAM_TIMESTAMP),
             ("framestamp", ctypes.c_int32),
             ("camerastamp", ctypes.c_int32)]
 
@@ -254,10 +306,47 @@ def convertPropertyName(p_name):
     return p_name.lower().replace(" ", "_")
 
 
-class DCAMException(halExceptions.HardwareException):
+class DCAMException(HardwareException):
     pass
 
 
+## loadDCAM
+#
+# Load the DCAM library. The backend is chosen with the backend argument
+# or the DCAM_LIBRARY environment variable:
+#   not set - dcamapi installed with the Hamamatsu driver
+#   "sim"   - the pure Python stand-in in dcamSim.py
+#   a path  - a shared library with the same functions as dcamapi,
+#             e.g. a stand-in built for profiling on Linux
+# Each library is only loaded once and is shared by all of the cameras.
+#
+dcam_libraries = {}
+
+def loadDCAM(backend = None):
+    """
+    Return the DCAM library for backend (see above).
+    """
+    if backend is None:
+        backend = os.environ.get("DCAM_LIBRARY", "")
+    if not (backend in dcam_libraries):
+        if (backend == "sim"):
+            import dcamSim
+            dcam = dcamSim.DCAMSim()
+        elif backend and (os.name == "nt"):
+            dcam = ctypes.WinDLL(backend)
+        elif backend:
+            dcam = ctypes.CDLL(backend)
+        elif (os.name == "nt"):
+            dcam = ctypes.windll.dcamapi
+        else:
+            path = ctypes.util.find_library("dcamapi")
+            if path is None:
+                raise DCAMException("dcamapi not found, set DCAM_LIBRARY to the library path or to sim")
+            dcam = ctypes.CDLL(path)
+        dcam_libraries[backend] = dcam
+    return dcam_libraries[backend]
+
+
 
 class HCamData(object):
     """
@@ -270,13 +359,22 @@ class HCamData(object):
 
     Using numpy makes a lot more sense anyways..
     """
-    def __init__(self, size = None, **kwds):
+    def __init__(self, size = None, data = None, **kwds):
         """
-        Create a data object of the appropriate size.
+        Create a data object of the appropriate size, or wrapping data
+        (e.g. one frame of a larger block of memory) if given.
         """
         super().__init__(**kwds)
-        self.np_array = np.ascontiguousarray(np.empty(int(size/2), dtype=np.uint16)) #self.np_array is a contiguous array in memory, that has size/2 elements of uint16 type I think...)
+        if data is not None:
+            size = data.nbytes
+            self.np_array = data
+        else:
+            self.np_array = np.ascontiguousarray(np.empty(int(size/2), dtype=np.uint16)) #self.np_array is a contiguous array in memory, that has size/2 elements of uint16 type I think...)
         self.size = size                                                                      #It's size over two since we input the number of bytes of a frame, and we reserve space for uint16 variabl (bytes are 8 bit, their ratio is 2
+        self.refs = 0        # number of holds on this frame (see HamamatsuCameraMR.holdFrame)
+        self.stale = False   # the camera overwrote this frame while it was held
+        self.framestamp = -1 # number of the frame counted by the camera
+        self.timestamp = 0.  # time the frame was captured (s)
 
     def __getitem__(self, slice):
         return self.np_array[slice]
@@ -304,12 +402,13 @@ class HamamatsuCamera(object):
     Storage for the data from the camera is allocated dynamically and
     copied out of the camera buffers.
     """
-    def __init__(self, camera_id = None, **kwds):
+    def __init__(self, camera_id = None, dcam = None, **kwds):
         """
-        Open the connection to the camera specified by camera_id.
+        Open the connection to the camera specified by camera_id, using
+        the DCAM library dcam (loadDCAM() if None).
         """
         super().__init__(**kwds)
-        self.dcam = ctypes.windll.dcamapi
+        self.dcam = dcam if dcam is not None else loadDCAM()
 
         self.buffer_index = 0
         self.camera_id = camera_id
@@ -320,11 +419,19 @@ class HamamatsuCamera(object):
         self.frame_y = 0
         self.last_frame_number = 0
         self.properties = None
+        self.prop_attrs = {}      # cached DCAMPROP_ATTR of each property
+        self.prop_texts = {}      # cached text options of each property
+        self.prop_values = {}     # cached [value, type] of each property
         self.max_backlog = 0
         self.number_image_buffers = 0
+        self.overrun = False      # the last check found more new frames than buffers
 
         self.acquisition_mode = "run_till_abort"
         self.number_frames = 0
+        self.frame_stack = None   # reused by getFrameStack()
+        self.stack_info = None    # framestamp and timestamp of each frame in the stack
+        self.stats = acquisitionStats.AcquisitionStats()
+        self.stats_printed = True # the stats have been printed since the last captureSetup
         
 
         
@@ -347,6 +454,7 @@ class HamamatsuCamera(object):
 
         # Get camera properties.
         self.properties = self.getCameraProperties()
+        self.loadPropertyCache()
         # Get camera max width, height.
         self.max_width = self.getPropertyValue("image_width")[0]
         self.max_height = self.getPropertyValue("image_height")[0]
@@ -360,6 +468,8 @@ class HamamatsuCamera(object):
         """
         self.buffer_index = -1
         self.last_frame_number = 0
+        self.stats.reset()
+        self.stats_printed = False
 
         # Set sub array mode.
         self.setSubArrayMode()
@@ -441,26 +551,76 @@ class HamamatsuCamera(object):
         there new frames available when it is called.
         """
         frames = []
-        for n in self.newFrames():
-
-            paramlock = DCAMBUF_FRAME(
-                    0, 0, 0, n, None, 0, 0, 0, 0, 0, 0, 0, 0, 0)
-            paramlock.size = ctypes.sizeof(paramlock)    
+        new_frames = self.newFrames()
+        t0 = time.perf_counter()
+        for n in new_frames:
 
             # Lock the frame in the camera buffer & get address.
-            self.checkStatus(self.dcam.dcambuf_lockframe(self.camera_handle,
-                                                ctypes.byref(paramlock)),
-                             "dcambuf_lockframe")
+            [address, framestamp, timestamp] = self.getFrameInfo(n)
 
             # Create storage for the frame & copy into this storage.
             hc_data = HCamData(self.frame_bytes)
-            hc_data.copyData(paramlock.buf)
+            hc_data.copyData(address)
+            hc_data.framestamp = framestamp
+            hc_data.timestamp = timestamp
 
             frames.append(hc_data)
 
-
+        if frames:
+            self.stats.add_copy(time.perf_counter() - t0, len(frames))
+            self.stats.add_frames([f.framestamp for f in frames], [f.timestamp for f in frames])
         return [frames, [self.frame_x, self.frame_y]]
 
+    def getFrameStack(self):
+        """
+        Gets all of the available frames as one (N, frame_y, frame_x) uint16
+        array, oldest first, so that they can be analysed together.
+
+        The array is reused by the next call (there is no allocation for
+        each frame), so copy anything that needs to be kept.
+        """
+        new_frames = self.newFrames()
+        t0 = time.perf_counter()
+        stack = self.stackBuffer(len(new_frames))
+        for i, n in enumerate(new_frames):
+            [address, framestamp, timestamp] = self.getFrameInfo(n)
+            ctypes.memmove(stack[i].ctypes.data, address, self.frame_bytes)
+            self.stack_info[i] = (framestamp, timestamp)
+        if new_frames:
+            self.stats.add_copy(time.perf_counter() - t0, len(new_frames))
+            info = self.stack_info[:len(new_frames)]
+            self.stats.add_frames(info['framestamp'], info['timestamp'])
+        return [stack, [self.frame_x, self.frame_y]]
+
+    def getFrameInfo(self, n):
+        """
+        Lock frame n in the camera buffers and return [address, framestamp,
+        timestamp]: the address of the frame data, the number of the frame
+        counted by the camera since the start of the acquisition, and the
+        time the frame was captured in seconds.
+        """
+        paramlock = DCAMBUF_FRAME(0, 0, 0, n)
+        paramlock.size = ctypes.sizeof(paramlock)
+        self.checkStatus(self.dcam.dcambuf_lockframe(self.camera_handle,
+                                            ctypes.byref(paramlock)),
+                         "dcambuf_lockframe")
+        return [paramlock.buf, paramlock.framestamp,
+                paramlock.timestamp.sec + paramlock.timestamp.microsec * 1e-6]
+
+    def getFramesInfo(self, new_frames):
+        """
+        Return the framestamps and timestamps of the frames in the camera
+        buffers listed in new_frames, and add them to the acquisition
+        statistics.
+        """
+        framestamps, timestamps = [], []
+        for n in new_frames:
+            [address, framestamp, timestamp] = self.getFrameInfo(n)
+            framestamps.append(framestamp)
+            timestamps.append(timestamp)
+        self.stats.add_frames(framestamps, timestamps)
+        return [framestamps, timestamps]
+
     def getModelInfo(self, camera_id):
         """
         Returns the model of the camera
@@ -491,9 +651,10 @@ class HamamatsuCamera(object):
     def getPropertyAttribute(self, property_name):
         """
         Return the attribute structure of a particular property.
-        
-        FIXME (OPTIMIZATION): Keep track of known attributes?
+        The attributes are cached, see loadPropertyCache().
         """
+        if property_name in self.prop_attrs:
+            return self.prop_attrs[property_name]
         p_attr = DCAMPROP_ATTR()
         p_attr.cbSize = ctypes.sizeof(p_attr)
         p_attr.iProp = self.properties[property_name]
@@ -504,6 +665,7 @@ class HamamatsuCamera(object):
             print("property", property_name, "is not supported")
             return False
         else:
+            self.prop_attrs[property_name] = p_attr
             return p_attr
 
     def getPropertyRange(self, property_name):
@@ -541,9 +703,13 @@ class HamamatsuCamera(object):
     def getPropertyText(self, property_name):
         """
         #Return the text options of a property (if any).
+        The text options don't change so they are cached.
         """
+        if property_name in self.prop_texts:
+            return self.prop_texts[property_name]
         prop_attr = self.getPropertyAttribute(property_name)
         if not (prop_attr.attribute & DCAMPROP_ATTR_HASVALUETEXT):
+            self.prop_texts[property_name] = {}
             return {}
         else:
             # Create property text structure.
@@ -580,44 +746,58 @@ class HamamatsuCamera(object):
                 if (ret != 1):
                     done = True
 
+            self.prop_texts[property_name] = text_options
             return text_options
 
     def getPropertyValue(self, property_name):
         """
         Return the current setting of a particular property.
+        Values are cached until the property, or one that it depends
+        on, is written with setPropertyValue().
         """
 
         # Check if the property exists.
         if not (property_name in self.properties):
             print(" unknown property name:", property_name)
             return False
+        if property_name in self.prop_values:
+            return list(self.prop_values[property_name])
         prop_id = self.properties[property_name]
 
-        # Get the property attributes.
-        prop_attr = self.getPropertyAttribute(property_name)
-
         # Get the property value.
         c_value = ctypes.c_double(0)
         self.checkStatus(self.dcam.dcamprop_getvalue(self.camera_handle,
                                                     ctypes.c_int32(prop_id),
                                                     ctypes.byref(c_value)),
                          "dcamprop_getvalue")
+        return self.storePropertyValue(property_name, c_value.value)
+
+    def storePropertyValue(self, property_name, value):
+        """
+        Convert a value read from the camera to the property's type and
+        keep it in the value cache (unless the property is volatile).
+        Returns [value, type] as getPropertyValue().
+        """
+        prop_attr = self.getPropertyAttribute(property_name)
 
         # Convert type based on attribute type.
         temp = prop_attr.attribute & DCAMPROP_TYPE_MASK
         if (temp == DCAMPROP_TYPE_MODE):
             prop_type = "MODE"
-            prop_value = int(c_value.value)
+            prop_value = int(value)
         elif (temp == DCAMPROP_TYPE_LONG):
             prop_type = "LONG"
-            prop_value = int(c_value.value)
+            prop_value = int(value)
         elif (temp == DCAMPROP_TYPE_REAL):
             prop_type = "REAL"
-            prop_value = c_value.value
+            prop_value = value
         else:
             prop_type = "NONE"
             prop_value = False
-    
+
+        if not ((prop_attr.attribute & DCAMPROP_ATTR_VOLATILE) or
+                (property_name in UNCACHED_PROPERTIES)):
+            self.prop_values[property_name] = (prop_value, prop_type)
         return [prop_value, prop_type]
     
     def getPropertiesValues(self):
@@ -626,6 +806,21 @@ class HamamatsuCamera(object):
             prop_attr = self.getPropertyValue(i)
             print("{} : {}".format(i, prop_attr[0]))
 
+    def invalidateProperty(self, property_name):
+        """
+        Drop the cached values that could have changed when property_name
+        was written. The attributes of writeable dependent properties are
+        dropped too since their ranges can depend on the property.
+        """
+        if property_name in PROPERTY_DEPENDENTS:
+            for name in PROPERTY_DEPENDENTS[property_name] + [property_name]:
+                self.prop_values.pop(name, None)
+                attr = self.prop_attrs.get(name)
+                if (name != property_name) and attr and (attr.attribute & DCAMPROP_ATTR_WRITABLE):
+                    del self.prop_attrs[name]
+        else: # unknown dependencies
+            self.prop_values = {}
+
     def isCameraProperty(self, property_name):
         """
         Check if a property name is supported by the camera.
@@ -635,6 +830,30 @@ class HamamatsuCamera(object):
         else:
             return False
 
+    def loadPropertyCache(self):
+        """
+        Read the attributes and text options of all of the camera properties
+        once when the camera is opened, so that setting a property only
+        needs one call to the camera.
+        """
+        self.prop_attrs, self.prop_texts, self.prop_values = {}, {}, {}
+        for name in self.properties:
+            if self.getPropertyAttribute(name):
+                self.getPropertyText(name)
+
+    def getFrameCount(self):
+        """
+        Return the number of frames the camera has captured since the start
+        of the acquisition.
+        """
+        paramtransfer = DCAMCAP_TRANSFERINFO(
+                0, DCAMCAP_TRANSFERKIND_FRAME, 0, 0)
+        paramtransfer.size = ctypes.sizeof(paramtransfer)
+        self.checkStatus(self.dcam.dcamcap_transferinfo(self.camera_handle,
+                                               ctypes.byref(paramtransfer)),
+                         "dcamcap_transferinfo")
+        return paramtransfer.nFrameCount
+
     def newFrames(self):
         """
         Return a list of the ids of all the new frames since the last check.
@@ -673,10 +892,12 @@ class HamamatsuCamera(object):
         # Check that we have not acquired more frames than we can store in our buffer.
         # Keep track of the maximum backlog.
         backlog = cur_frame_number - self.last_frame_number
-        if (backlog > self.number_image_buffers):
+        self.overrun = (backlog > self.number_image_buffers)
+        if self.overrun:
             print(">> Warning! hamamatsu camera frame buffer overrun detected!")
         if (backlog > self.max_backlog):
             self.max_backlog = backlog
+        self.stats.add_backlog(backlog, self.number_image_buffers)
         self.last_frame_number = cur_frame_number
 
 
@@ -729,11 +950,16 @@ class HamamatsuCamera(object):
         # Set the property value, return what it was set too.
         prop_id = self.properties[property_name]
         p_value = ctypes.c_double(property_value)
-        self.checkStatus(self.dcam.dcamprop_setgetvalue(self.camera_handle,
+        ret = self.checkStatus(self.dcam.dcamprop_setgetvalue(self.camera_handle,
                                            ctypes.c_int32(prop_id),
                                            ctypes.byref(p_value),
                                            ctypes.c_int32(DCAM_DEFAULT_ARG)),
                          "dcamprop_setgetvalue")
+        self.invalidateProperty(property_name)
+        if (ret < 0): # DCAM4 errors are negative, the value wasn't set
+            print(" could not set", property_name, "error code", hex(ret & 0xFFFFFFFF))
+            return self.getPropertyValue(property_name)[0]
+        self.storePropertyValue(property_name, p_value.value)
         return p_value.value
 
     def setSubArrayMode(self):
@@ -747,9 +973,49 @@ class HamamatsuCamera(object):
 
         # If the ROI is smaller than the entire frame turn on subarray mode
         if ((roi_w == self.max_width) and (roi_h == self.max_height)):
-            self.setPropertyValue("subarray_mode", "OFF")
+            mode = "OFF"
         else:
-            self.setPropertyValue("subarray_mode", "ON")
+            mode = "ON"
+        if (self.getPropertyValue("subarray_mode")[0] != self.getPropertyText("subarray_mode")[mode]):
+            self.setPropertyValue("subarray_mode", mode)
+
+    def getSubArray(self):
+        """
+        Return the window of the sensor that is read out as
+        [hpos, hsize, vpos, vsize] in unbinned sensor pixels.
+        """
+        if (self.getPropertyValue("subarray_mode")[0] == self.getPropertyText("subarray_mode")["OFF"]):
+            return [0, int(self.max_width), 0, int(self.max_height)]
+        return [int(self.getPropertyValue(name)[0]) for name in
+                ["subarray_hpos", "subarray_hsize", "subarray_vpos", "subarray_vsize"]]
+
+    def setSubArray(self, hpos, hsize, vpos, vsize):
+        """
+        Read out the window of the sensor with its corner at (hpos, vpos)
+        and size (hsize, vsize) in unbinned sensor pixels. The window is
+        grown out to the allowed steps of the subarray properties so that
+        it still covers the requested pixels, then the sub-array mode is
+        set. Returns the window that was set as [hpos, hsize, vpos, vsize].
+        """
+        for axis, pos, size, sensor in [("h", hpos, hsize, self.max_width),
+                                        ("v", vpos, vsize, self.max_height)]:
+            pos_name, size_name = "subarray_" + axis + "pos", "subarray_" + axis + "size"
+            step = int(max(self.getPropertyAttribute(pos_name).valuestep,
+                           self.getPropertyAttribute(size_name).valuestep, 1))
+            start = max(int(pos) // step * step, 0)
+            end = min(-(-int(pos + size) // step) * step, int(sensor))
+            size = max(end - start, self.getPropertyRange(size_name)[0])
+            start = min(start, int(sensor) - size)
+
+            # Move to the edge first if the new size doesn't fit at the old position.
+            if (self.getPropertyValue(pos_name)[0] + size > sensor):
+                self.setPropertyValue(pos_name, 0)
+            if (size != self.getPropertyValue(size_name)[0]):
+                self.setPropertyValue(size_name, size)
+            if (start != self.getPropertyValue(pos_name)[0]):
+                self.setPropertyValue(pos_name, start)
+        self.setSubArrayMode()
+        return self.getSubArray()
 
     def setACQMode(self, mode, number_frames = None):
         '''
@@ -814,6 +1080,9 @@ class HamamatsuCamera(object):
                          "dcamcap_stop")
 
         print("max camera backlog was", self.max_backlog, "of", self.number_image_buffers)
+        if self.stats.n_frames and not self.stats_printed:
+            print("acquisition:", self.stats)
+            self.stats_printed = True
         self.max_backlog = 0
 
         # Free image buffers.
@@ -822,6 +1091,15 @@ class HamamatsuCamera(object):
                                                 DCAMBUF_ATTACHKIND_FRAME),
                          "dcambuf_release")
 
+    def abortWait(self):
+        """
+        Abort a newFrames() call that is waiting for a frame in another
+        thread, so that the thread can be stopped without waiting for
+        the next frame or the timeout.
+        """
+        self.checkStatus(self.dcam.dcamwait_abort(self.wait_handle),
+                         "dcamwait_abort")
+
     def shutdown(self):
         """
         Close down the connection to the camera.
@@ -838,6 +1116,24 @@ class HamamatsuCamera(object):
         text_values = self.getPropertyText(property_name)
         return sorted(text_values, key = text_values.get)
 
+    def stackBuffer(self, n_frames):
+        """
+        Return the first n_frames of the array reused by getFrameStack()
+        (internal use only). The array is reallocated if the frame size
+        changed, or grown by doubling if it has too few frames.
+        """
+        shape = (self.frame_y, self.frame_x)
+        stack = self.frame_stack
+        if (stack is None) or (stack.shape[1:] != shape):
+            stack = np.empty((max(n_frames, 1),) + shape, dtype=np.uint16)
+        elif (len(stack) < n_frames):
+            size = min(max(2 * len(stack), n_frames), max(self.number_image_buffers, n_frames))
+            stack = np.empty((size,) + shape, dtype=np.uint16)
+        if not (stack is self.frame_stack):
+            self.stack_info = np.zeros(len(stack), dtype=[('framestamp', int), ('timestamp', float)])
+        self.frame_stack = stack
+        return stack[:n_frames]
+
 
 class HamamatsuCameraMR(HamamatsuCamera):
     """
@@ -856,16 +1152,18 @@ class HamamatsuCameraMR(HamamatsuCamera):
              will try and access the same bit of memory at the same time
              as the camera and this could end badly.
 
-    FIXME: Use lockbits (and unlockbits) to avoid memory clashes?
-           This would probably also involve some kind of reference 
-           counting scheme.
+    Consumers that read frames in place should holdFrame() them and
+    releaseFrame() them when done, see checkHeldFrames().
     """
     def __init__(self, **kwds):
         super().__init__(**kwds)
 
         self.hcam_data = []
         self.hcam_ptr = False
+        self.ring = None        # (number_image_buffers, pixels) array of the camera buffers
         self.old_frame_bytes = -1
+        self.held_frames = {}   # buffer index : HCamData held by a consumer
+        self.frame_lock = threading.Lock()
 
         #self.setPropertyValue("output_trigger_kind[0]", 2)
 
@@ -879,16 +1177,100 @@ class HamamatsuCameraMR(HamamatsuCamera):
         FIXME: It does not always seem to block? The length of frames can
                be zero. Are frames getting dropped? Some sort of race condition?
         """
+        new_frames = self.newFrames()
         frames = []
-        for n in self.newFrames():
+        [framestamps, timestamps] = self.getFramesInfo(new_frames)
+        for n, framestamp, timestamp in zip(new_frames, framestamps, timestamps):
+            self.hcam_data[n].framestamp = framestamp
+            self.hcam_data[n].timestamp = timestamp
             frames.append(self.hcam_data[n])
 
+        self.checkHeldFrames(new_frames)
         return [frames, [self.frame_x, self.frame_y]]
 
+    def getFrameStack(self):
+        """
+        Gets all of the available frames as one (N, frame_y, frame_x) uint16
+        array, oldest first, so that they can be analysed together.
+
+        The new frames are consecutive buffers in the ring, which can wrap
+        around to the start once, so they are copied with (at most) two
+        block copies. The array is reused by the next call, so copy
+        anything that needs to be kept.
+        """
+        new_frames = self.newFrames()
+        n_frames = len(new_frames)
+        stack = self.stackBuffer(n_frames)
+        if n_frames:
+            [framestamps, timestamps] = self.getFramesInfo(new_frames)
+            self.stack_info[:n_frames] = list(zip(framestamps, timestamps))
+            t0 = time.perf_counter()
+            flat = stack.reshape(n_frames, -1)
+            start = new_frames[0]
+            first = min(n_frames, self.number_image_buffers - start)
+            flat[:first] = self.ring[start:start + first]
+            flat[first:] = self.ring[:n_frames - first]
+            self.stats.add_copy(time.perf_counter() - t0, n_frames)
+
+        self.checkHeldFrames(new_frames)
+        return [stack, [self.frame_x, self.frame_y]]
+
+    def holdFrame(self, hc_data):
+        """
+        Mark a frame returned by getFrames() as in use so that its data can be
+        read in place (e.g. by analysis in another thread) without copying.
+        Every holdFrame() must be matched by a releaseFrame().
+        """
+        with self.frame_lock:
+            for n, ring_data in enumerate(self.hcam_data):
+                if ring_data is hc_data:
+                    hc_data.refs += 1
+                    hc_data.stale = False
+                    self.held_frames[n] = hc_data
+                    return True
+        return False # not one of the camera buffers
+
+    def releaseFrame(self, hc_data):
+        """
+        Release a frame held with holdFrame(). Returns False if the camera
+        has started to write over the frame while it was held, in which case
+        the data read from it should be discarded. The buffer of frame f is
+        reused for frame f + number_image_buffers, which the camera starts
+        writing once it has captured that many frames.
+        """
+        with self.frame_lock:
+            hc_data.refs = max(hc_data.refs - 1, 0)
+            if hc_data.refs == 0:
+                for n, held_data in list(self.held_frames.items()):
+                    if held_data is hc_data:
+                        del self.held_frames[n]
+            if (self.getFrameCount() >= hc_data.framestamp + self.number_image_buffers):
+                hc_data.stale = True
+        return not hc_data.stale
+
+    def checkHeldFrames(self, new_frames):
+        """
+        Flag held frames that the camera has written over as stale. The
+        camera cannot be stopped from writing into a buffer and consumers
+        read held frames in place (e.g. through views of the buffer), so
+        the frames stay held until they are released, when releaseFrame()
+        checks the frame count again.
+        """
+        if not self.held_frames:
+            return
+        with self.frame_lock:
+            for n, hc_data in self.held_frames.items():
+                if (self.overrun or (n in new_frames)) and not hc_data.stale:
+                    print(">> Warning! held frame", n, "was overwritten by the camera")
+                    hc_data.stale = True
+
     def startAcquisition(self):
         """
         Allocate as many frames as will fit in 2GB of memory and start data acquisition.
         """
+        with self.frame_lock: # the frame count restarts, so frames still held can't be checked
+            for hc_data in self.held_frames.values():
+                hc_data.stale = True
         self.captureSetup()
 
         # Allocate new image buffers if necessary. This will allocate
@@ -900,21 +1282,22 @@ class HamamatsuCameraMR(HamamatsuCamera):
         # be long enough.
         #
         #backslash is used to escape the newline
+        n_buffers = min(int((2.0 * 1024 * 1024 * 1024)/self.frame_bytes), 2000)
+        if self.acquisition_mode == "fixed_length":
+            n_buffers = self.number_frames
         if (self.old_frame_bytes != self.frame_bytes) or \
-                (self.acquisition_mode == "fixed_length"): 
-
-            n_buffers = min(int((2.0 * 1024 * 1024 * 1024)/self.frame_bytes), 2000)
-            if self.acquisition_mode == "fixed_length":
-                self.number_image_buffers = self.number_frames
-            else:
-                self.number_image_buffers = n_buffers
+                (self.number_image_buffers != n_buffers) or \
+                (self.acquisition_mode == "fixed_length"):
+            self.number_image_buffers = n_buffers
 
-            # Allocate new image buffers.
+            # Allocate new image buffers. These are the frames of one contiguous
+            # ring so that getFrameStack() can copy several frames at once.
             ptr_array = ctypes.c_void_p * self.number_image_buffers #crea un array del tipo c_void_p
             self.hcam_ptr = ptr_array() 
+            self.ring = np.empty((self.number_image_buffers, int(self.frame_bytes/2)), dtype=np.uint16)
             self.hcam_data = []
             for i in range(self.number_image_buffers):
-                hc_data = HCamData(self.frame_bytes)
+                hc_data = HCamData(data = self.ring[i])
                 self.hcam_ptr[i] = hc_data.getDataPtr()
                 self.hcam_data.append(hc_data)
 
@@ -965,111 +1348,21 @@ class HamamatsuCameraMR(HamamatsuCamera):
                          "dcambuf_release")
 
         print("max camera backlog was:", self.max_backlog)
+        if self.stats.n_frames and not self.stats_printed:
+            print("acquisition:", self.stats)
+            self.stats_printed = True
         self.max_backlog = 0
     
-    def startRecording(self):
-        
-        self.captureSetup()
-        self.number_image_buffers = 2
-        paramrec = DCAMREC_OPEN(0, 0, None, None, None, 0, 0, 0, 0, 0, 0, 0)
-        paramrec.size = ctypes.sizeof(paramrec)
-        paramrec.path = ctypes.c_wchar_p("C:\Data\ProvaRec\ProvaIm36")
-        paramrec.ext = ctypes.c_wchar_p("dcimg")
-        paramrec.maxframepersession = 10
-        print(dcam.dcamrec_openW(ctypes.byref(paramrec)))
-        self.rec_handle = ctypes.c_void_p(paramrec.hrec)
-        #self.rec_handle = paramrec.hrec
-        
-#         captureStatus = ctypes.c_int32(0)
-#         print(captureStatus.value)
-#         print(DCAMCAP_STATUS_READY)
-#         while(captureStatus != DCAMCAP_STATUS_READY):
-#         self.checkStatus(dcam.dcamcap_status(self.camera_handle, ctypes.byref(captureStatus)))
-#         print(captureStatus.value)
-#         
-#             
-#         
-        #print(self.checkStatus(dcam.dcamrec_open(self.rec_handle), "dcamrec_open"))
-        
-        ptr_array = ctypes.c_void_p * self.number_image_buffers #crea un array del tipo c_void_p
-        self.hcam_ptr = ptr_array() 
-        self.hcam_data = []
-        for i in range(self.number_image_buffers):
-            hc_data = HCamData(self.frame_bytes)
-            self.hcam_ptr[i] = hc_data.getDataPtr()
-            self.hcam_data.append(hc_data)
-
-        self.old_frame_bytes = self.frame_bytes
-
-        # Attach image buffers and start acquisition.
-        #
-        # We need to attach & release for each acquisition otherwise
-        # we'll get an error if we try to change the ROI in any way
-        # between acquisitions.
-
-
-        paramattach = DCAMBUF_ATTACH(0, DCAMBUF_ATTACHKIND_FRAME,
-                self.hcam_ptr, self.number_image_buffers)
-        paramattach.size = ctypes.sizeof(paramattach)
-        
-        self.checkStatus(dcam.dcambuf_alloc(self.camera_handle,
-                                  ctypes.c_int32(self.number_image_buffers)),
-                         "dcambuf_alloc")
-        
-        #self.checkStatus(dcam.dcambuf_attach(self.camera_handle,
-        #                            paramattach),
-        #                     "dcambuf_attach")
-        print(self.checkStatus(dcam.dcamcap_record(self.camera_handle, 
-                                                   self.rec_handle), 
-                                                   "dcamcap_record"))
-        
-        print(self.checkStatus(dcam.dcamcap_start(self.camera_handle,
-                                    DCAMCAP_START_SNAP),
-                                                  "dcamcap_start"))
-        paramstart = DCAMWAIT_START(
-                    0, 
-                    0, 
-                    DCAMWAIT_CAPEVENT_STOPPED, 
-                    10000)
-        paramstart.size = ctypes.sizeof(paramstart)
-        print(self.checkStatus(dcam.dcamwait_start(self.wait_handle,
-                                                   ctypes.byref(paramstart)), "boh"))
-        print(self.checkStatus(dcam.dcamcap_stop(self.camera_handle),
-                         "dcamcap_stop"))
-        
-        paramrecstatus = DCAMREC_STATUS(0, 0, 0, 0, 0, 0, 0, 0)
-        paramrecstatus.size = ctypes.sizeof(paramrecstatus)
-        print(self.checkStatus(dcam.dcamrec_status(self.rec_handle, ctypes.byref(paramrecstatus)), "dcamrec_status"))
-        print("=========")
-        print(paramrecstatus.currentsession_index)
-        print(paramrecstatus.maxframecount_per_session)
-        print(paramrecstatus.currentframe_index)
-        print(paramrecstatus.missingframe_count)
-        print("=========")
-#         paramstart = DCAMWAIT_START(
-#                     0, 
-#                     0, 
-#                     DCAMWAIT_RECEVENT_STOPPED, 
-#                     10000) #1000 is the timeout. Remember it when changin the tmie exposure
-#         paramstart.size = ctypes.sizeof(paramstart)
-        print(self.checkStatus(dcam.dcamrec_status(self.rec_handle, ctypes.byref(paramrecstatus)), "dcamrec_status"))
-        print("=========")
-        print(paramrecstatus.currentsession_index)
-        print(paramrecstatus.maxframecount_per_session)
-        print(paramrecstatus.currentframe_index)
-        print(paramrecstatus.missingframe_count)
-        print("=========")
-#         print(self.checkStatus(dcam.dcamwait_start(self.wait_handle,
-#                                             ctypes.byref(paramstart)),
-#                              "dcamwait_start"))
-        
-        print(self.checkStatus(dcam.dcamrec_close(self.rec_handle), 
-                               "dcamrec_close"))
-        print(self.checkStatus(dcam.dcambuf_release(self.camera_handle,
-                                                DCAMBUF_ATTACHKIND_FRAME),
-                         "dcambuf_release"))
-        print(self.checkStatus(dcam.dcamwait_close(self.wait_handle, "dcamwait_close")))
-        
+    def startRecording(self, file_name, max_frames, slots = 64):
+        """
+        Start acquiring and stream the frames to a raw file, see
+        frameRecorder.FrameRecorder. At most max_frames are recorded and
+        at most slots frames are kept in memory waiting to be written.
+        Returns the recorder, call its stop() to finish the recording.
+        """
+        recorder = frameRecorder.FrameRecorder(self, file_name, max_frames, slots)
+        recorder.start()
+        return recorder
 
 
 
@@ -1085,7 +1378,7 @@ if __name__ == '__main__':
     # Initialization
     #
     #dcam = ctypes.WinDLL('C:\\Users\\Admin\\Downloads\\DCAM-API for Windows (18.11.5660)\\DCAMAPI\\fbdphx\\Win\\x64\\dcamapi.dll')
-    dcam = ctypes.windll.dcamapi
+    dcam = loadDCAM() # set DCAM_LIBRARY=sim to run without the camera
     #dcam.visit()
     print(dcam)
     paraminit = DCAMAPI_INIT(0, 1, 0, 0, None, None) 
@@ -1191,8 +1484,10 @@ if __name__ == '__main__':
     if 1:
         try:
             
-            hcam.startRecording()
-            
+            recorder = hcam.startRecording("trying_recording.raw", 100)
+            while recorder.is_alive():
+                time.sleep(0.1)
+            recorder.stop()
         
         finally:
             
@@ -28,9 +28,17 @@ George 11/17 - Updated for SDK4 and to allow fixed length acquisition
 import ctypes
 import ctypes.util
 import numpy as np
+import threading
 import time
 
-import storm_control.sc_library.halExceptions as halExceptions
+import acquisitionStats
+import frameRecorder
+
+try:
+    import storm_control.sc_library.halExceptions as halExceptions
+    HardwareException = halExceptions.HardwareException
+except ModuleNotFoundError:
+    HardwareException = Exception # the simulation runs without storm_control
 
 
 # Hamamatsu constants.
@@ -155,6 +163,14 @@ class DCAMBUF_ATTACH(ctypes.Structure):
             ("buffer", ctypes.POINTER(ctypes.c_void_p)),
             ("buffercount", ctypes.c_int32)]
 
+## DCAM_TIMESTAMP
+#
+# The time a frame was captured
+#
+class DCAM_TIMESTAMP(ctypes.Structure):
+    _fields_ = [("sec", ctypes.c_uint32),
+            ("microsec", ctypes.c_int32)]
+
 ## DCAMBUF_FRAME
 #
 # The dcam buffer frame structure
@@ -171,7 +187,7 @@ class DCAMBUF_FRAME(ctypes.Structure):
             ("height", ctypes.c_int32),
             ("left", ctypes.c_int32),
             ("top", ctypes.c_int32),
-            ("timestamp", ctypes.c_int32),
+            ("timestamp", DCAM_TIMESTAMP),
             ("framestamp", ctypes.c_int32),
             ("camerastamp", ctypes.c_int32)]
 
@@ -254,360 +270,1088 @@ def convertPropertyName(p_name):
     return p_name.lower().replace(" ", "_")
 
 
-class DCAMException(halExceptions.HardwareException):
+class DCAMException(HardwareException):
     pass
 
-class HCamData(object):
-    None
 
-class HamamatsuCamera(object):
+def loadDCAM(backend = None):
+    """
+    The simulated camera doesn't need the DCAM library. This returns the
+    pure Python stand-in from dcamSim.py so that callers can still call
+    dcamapi_init, whatever the backend.
+    """
+    import dcamSim
+    return dcamSim.DCAMSim(latency_scale = 0)
+
 
-    def __init__(self, camera_id = None, **kwds):
-        None
+# Simulated camera.
+#
+# Everything below replaces the DCAM library with a simulation of an
+# ORCA-Flash 4.0 V3 so that the acquisition and analysis code can be run
+# (and timed) without the camera or the Windows driver.
 
+# Time to read out one line of the sensor (standard scan). The sensor is
+# read from the centre outwards so a subarray of vsize lines takes
+# vsize/2 line times to read out.
+SIM_LINE_TIME = 9.74436e-6
 
-    def __captureSetup(self):
-        None
+# Maximum memory used for the ring of image buffers, as for the real camera.
+SIM_BUFFER_BYTES = 2.0 * 1024 * 1024 * 1024
 
+SIM_ATTR_RW = DCAMPROP_ATTR_READABLE | DCAMPROP_ATTR_WRITABLE | DCAMPROP_ATTR_HASRANGE
+SIM_ATTR_RO = DCAMPROP_ATTR_READABLE | DCAMPROP_ATTR_HASRANGE
+SIM_ATTR_TEXT = SIM_ATTR_RW | DCAMPROP_ATTR_HASVALUETEXT
+
+## SIM_PROPERTIES
+#
+# Properties supported by the simulated camera:
+#   name : [id, type, attribute, min, max, step, default, {text : value}]
+#
+SIM_PROPERTIES = {
+    "binning" : [0x00401110, DCAMPROP_TYPE_MODE, SIM_ATTR_TEXT, 1, 4, 1, 1,
+                 {"1x1" : 1, "2x2" : 2, "4x4" : 4}],
+    "buffer_framebytes" : [0x00420840, DCAMPROP_TYPE_LONG, SIM_ATTR_RO, 0, 2048*2048*2, 1, 2048*2048*2, {}],
+    "buffer_rowbytes" : [0x00420830, DCAMPROP_TYPE_LONG, SIM_ATTR_RO, 0, 2048*2, 1, 2048*2, {}],
+    "defect_correct_mode" : [0x00470010, DCAMPROP_TYPE_MODE, SIM_ATTR_TEXT, 1, 2, 1, 2,
+                             {"OFF" : 1, "ON" : 2}],
+    "exposure_time" : [0x001F0110, DCAMPROP_TYPE_REAL, SIM_ATTR_RW, 3.8e-5, 10.0, 1e-6, 0.01, {}],
+    "image_framebytes" : [0x00420240, DCAMPROP_TYPE_LONG, SIM_ATTR_RO, 0, 2048*2048*2, 1, 2048*2048*2, {}],
+    "image_height" : [0x00420220, DCAMPROP_TYPE_LONG, SIM_ATTR_RO, 0, 2048, 1, 2048, {}],
+    "image_pixeltype" : [0x00420270, DCAMPROP_TYPE_MODE, SIM_ATTR_RO | DCAMPROP_ATTR_HASVALUETEXT,
+                         2, 2, 1, 2, {"MONO16" : 2}],
+    "image_rowbytes" : [0x00420230, DCAMPROP_TYPE_LONG, SIM_ATTR_RO, 0, 2048*2, 1, 2048*2, {}],
+    "image_width" : [0x00420210, DCAMPROP_TYPE_LONG, SIM_ATTR_RO, 0, 2048, 1, 2048, {}],
+    "internal_frame_rate" : [0x00403810, DCAMPROP_TYPE_REAL, SIM_ATTR_RO, 0.1, 26000.0, 0, 100.0, {}],
+    "readout_speed" : [0x00400110, DCAMPROP_TYPE_LONG, SIM_ATTR_RW, 1, 2, 1, 2, {}],
+    "sensor_temperature" : [0x00200310, DCAMPROP_TYPE_REAL, SIM_ATTR_RO, -50.0, 50.0, 0, -10.0, {}],
+    "subarray_hpos" : [0x00402110, DCAMPROP_TYPE_LONG, SIM_ATTR_RW, 0, 2044, 4, 0, {}],
+    "subarray_hsize" : [0x00402120, DCAMPROP_TYPE_LONG, SIM_ATTR_RW, 4, 2048, 4, 2048, {}],
+    "subarray_mode" : [0x00402150, DCAMPROP_TYPE_MODE, SIM_ATTR_TEXT, 1, 2, 1, 1,
+                       {"OFF" : 1, "ON" : 2}],
+    "subarray_vpos" : [0x00402130, DCAMPROP_TYPE_LONG, SIM_ATTR_RW, 0, 2044, 4, 0, {}],
+    "subarray_vsize" : [0x00402140, DCAMPROP_TYPE_LONG, SIM_ATTR_RW, 4, 2048, 4, 2048, {}],
+    "timing_readout_time" : [0x00403010, DCAMPROP_TYPE_REAL, SIM_ATTR_RO, 0, 1.0, 0, 2048/2*SIM_LINE_TIME, {}],
+    "trigger_active" : [0x00100120, DCAMPROP_TYPE_MODE, SIM_ATTR_TEXT, 1, 3, 1, 1,
+                        {"EDGE" : 1, "LEVEL" : 2, "SYNCREADOUT" : 3}],
+    "trigger_mode" : [0x00100210, DCAMPROP_TYPE_MODE, SIM_ATTR_TEXT, 1, 6, 5, 1,
+                      {"NORMAL" : 1, "START" : 6}],
+    "trigger_polarity" : [0x00100220, DCAMPROP_TYPE_MODE, SIM_ATTR_TEXT, 1, 2, 1, 1,
+                          {"NEGATIVE" : 1, "POSITIVE" : 2}],
+    "trigger_source" : [0x00100110, DCAMPROP_TYPE_MODE, SIM_ATTR_TEXT, 1, 3, 1, 1,
+                        {"INTERNAL" : 1, "EXTERNAL" : 2, "SOFTWARE" : 3}]}
+
+SIM_SENSOR_SIZE = 2048
+
+
+class SimulatedFrameSource(object):
+    """
+    Synthetic frames for the simulated camera.
+
+    A frame is a bias level with Gaussian read noise and a Poissonian
+    background. Each site (x, y) in sensor pixels is loaded with an atom
+    with probability loading_prob, and a loaded atom adds a Poissonian
+    number of photons (mean atom_counts) spread over a Gaussian PSF of
+    standard deviation psf_width.
+
+    The noise is drawn once into a bank of bank_size frames when the
+    sensor window is configured, so making a frame only costs a copy
+    and the photons around the sites. This lets the simulation keep up
+    with the frame rate of the camera, at the cost of the background
+    repeating every bank_size frames.
+    """
+    def __init__(self, bias = 100, read_noise = 2.0, background = 0.5,
+                 sites = ((1024, 1024),), loading_prob = 0.5, atom_counts = 200,
+                 psf_width = 1.5, bank_size = 8, seed = None, **kwds):
+        super().__init__(**kwds)
+        self.bias = bias
+        self.read_noise = read_noise
+        self.background = background
+        self.sites = sites
+        self.loading_prob = loading_prob
+        self.atom_counts = atom_counts
+        self.psf_width = psf_width
+        self.bank_size = bank_size
+        self.rng = np.random.RandomState(seed)
+
+        self.bank = None
+        self.frame_number = 0
+        self.loaded = np.zeros(len(sites), dtype=bool) # which sites held an atom in the last frame
+        self.spots = []
+        self.window = None
+
+    def configure(self, left, top, width, height, binning = 1):
+        """
+        Set the window of the sensor (in unbinned sensor pixels) that frames
+        are generated for. The noise bank is only remade if the window changed.
+        """
+        window = (int(left), int(top), int(width), int(height), int(binning))
+        if window == self.window:
+            return
+        self.window = window
+        self.width = int(width) // int(binning)
+        self.height = int(height) // int(binning)
+
+        # Binning sums the background of binning**2 pixels.
+        bank = self.rng.normal(self.bias, self.read_noise * binning,
+                               (self.bank_size, self.height, self.width))
+        bank += self.rng.poisson(self.background * binning**2, np.shape(bank))
+        self.bank = np.clip(np.around(bank), 0, 65535).astype(np.uint16)
+
+        # Precompute the expected photon distribution around each site in the window.
+        sigma = self.psf_width / binning
+        r = int(np.ceil(3 * sigma))
+        yy, xx = np.mgrid[-r:r+1, -r:r+1]
+        self.spots = []
+        for x, y in self.sites:
+            xb, yb = (x - left) / binning, (y - top) / binning # centre in binned window pixels
+            xi, yi = int(round(xb)), int(round(yb))
+            if not (0 <= xi < self.width and 0 <= yi < self.height):
+                continue
+            psf = np.exp(-((xx + xi - xb)**2 + (yy + yi - yb)**2) / (2 * sigma**2))
+            psf /= np.sum(psf)
+            rows = slice(max(yi - r, 0), min(yi + r + 1, self.height))
+            cols = slice(max(xi - r, 0), min(xi + r + 1, self.width))
+            psf = psf[rows.start - yi + r:rows.stop - yi + r, cols.start - xi + r:cols.stop - xi + r]
+            self.spots.append((rows, cols, self.atom_counts * psf))
+        self.loaded = np.zeros(len(self.spots), dtype=bool)
+
+    def fill(self, out):
+        """
+        Write the next frame into out, a uint16 array with height*width
+        elements laid out row by row as in the camera buffers. Returns
+        which sites were loaded.
+        """
+        im = np.reshape(out, (self.height, self.width))
+        im[...] = self.bank[self.frame_number % self.bank_size]
+        self.frame_number += 1
+
+        self.loaded = self.rng.random_sample(len(self.spots)) < self.loading_prob
+        for (rows, cols, mean), loaded in zip(self.spots, self.loaded):
+            if loaded:
+                spot = self.rng.poisson(mean) + im[rows, cols]
+                im[rows, cols] = np.minimum(spot, 65535)
+        return self.loaded
+
+
+class HCamData(object):
+    """
+    Hamamatsu camera data object.
+
+    Initially I tried to use create_string_buffer() to allocate storage for the
+    data from the camera but this turned out to be too slow. The software
+    kept falling behind the camera and create_string_buffer() seemed to be the
+    bottleneck.
+
+    Using numpy makes a lot more sense anyways..
+    """
+    def __init__(self, size = None, data = None, **kwds):
+        """
+        Create a data object of the appropriate size, or wrapping data
+        (e.g. one frame of a larger block of memory) if given.
+        """
+        super().__init__(**kwds)
+        if data is not None:
+            size = data.nbytes
+            self.np_array = data
+        else:
+            self.np_array = np.ascontiguousarray(np.empty(int(size/2), dtype=np.uint16))
+        self.size = size
+        self.refs = 0        # number of holds on this frame (see HamamatsuCameraMR.holdFrame)
+        self.stale = False   # the camera overwrote this frame while it was held
+        self.framestamp = -1 # number of the frame counted by the camera
+        self.timestamp = 0.  # time the frame was captured (s)
+
+    def __getitem__(self, slice):
+        return self.np_array[slice]
+
+    def copyData(self, address):
+        """
+        Uses the C memmove function to copy data from an address in memory
+        into memory allocated for the numpy array of this object.
+        """
+        ctypes.memmove(self.np_array.ctypes.data, address, self.size)
+
+    def getData(self):
+        return self.np_array
+
+    def getDataPtr(self):
+        return self.np_array.ctypes.data
+
+
+class HamamatsuCamera(object):
+    """
+    Simulated camera interface class.
+
+    This has the same interface as camera_try.HamamatsuCamera, but the
+    DCAM library is replaced by the SIM_PROPERTIES table and a capture
+    thread which writes frames from a SimulatedFrameSource into a ring
+    of image buffers at the camera frame rate. The capture status, the
+    frame ready wait (with its 1 second timeout), the transfer info and
+    buffer overruns behave as they do with the DCAM library.
+
+    With an external trigger source, frames are taken once every
+    trigger_period seconds, or each time fireTrigger() is called if
+    trigger_period is 0.
+    """
+    def __init__(self, camera_id = None, frame_source = None, dcam = None, **kwds):
+        """
+        Open the connection to the simulated camera. dcam is accepted
+        for compatibility with camera_try and isn't used.
+        """
+        super().__init__(**kwds)
+
+        self.buffer_index = 0
+        self.camera_id = camera_id
+        self.debug = False
+        self.encoding = 'utf-8'
+        self.frame_bytes = 0
+        self.frame_x = 0
+        self.frame_y = 0
+        self.last_frame_number = 0
+        self.properties = None
+        self.max_backlog = 0
+        self.number_image_buffers = 0
+        self.overrun = False      # the last check found more new frames than buffers
+        self.frames_lost = 0      # frames overwritten before they were read
+
+        self.acquisition_mode = "run_till_abort"
+        self.number_frames = 0
+        self.frame_stack = None   # reused by getFrameStack()
+        self.stack_info = None    # framestamp and timestamp of each frame in the stack
+        self.stats = acquisitionStats.AcquisitionStats()
+        self.stats_printed = True # the stats have been printed since the last captureSetup
+
+        # State of the simulated camera.
+        if frame_source is None:
+            frame_source = SimulatedFrameSource()
+        self.frame_source = frame_source
+        self.trigger_period = 0   # seconds between simulated external triggers
+        self.sim_values = {name : p[6] for name, p in SIM_PROPERTIES.items()}
+        self.sim_buffers = []     # image buffers the capture thread writes into
+        self.sim_stamps = np.zeros(0, dtype=int)
+        self.sim_times = np.zeros(0)
+        self.sim_status = DCAMCAP_STATUS_READY
+        self.sim_newest = -1      # index of the newest frame in the buffers
+        self.sim_count = 0        # number of frames captured
+        self.sim_late = 0         # frames the generator was too slow to fill
+        self.sim_cond = threading.Condition()
+        self.sim_abort = False    # abortWait() was called
+        self.sim_trigger = threading.Event()
+        self.sim_stop = threading.Event()
+        self.sim_thread = None
+        self.simUpdate()
+
+        # Get camera model.
+        self.camera_model = self.getModelInfo(camera_id)
+        self.camera_handle = ctypes.c_void_p(0)
+        self.wait_handle = ctypes.c_void_p(0)
+
+        # Get camera properties.
+        self.properties = self.getCameraProperties()
+        # Get camera max width, height.
+        self.max_width = self.getPropertyValue("image_width")[0]
+        self.max_height = self.getPropertyValue("image_height")[0]
+
+    def captureSetup(self):
+        """
+        Capture setup (internal use only). This is called at the start
+        of new acquisition sequence to determine the current ROI and
+        get the camera configured properly.
+        """
+        self.buffer_index = -1
+        self.last_frame_number = 0
+        self.stats.reset()
+        self.stats_printed = False
+
+        # Set sub array mode.
+        self.setSubArrayMode()
+
+        # Get frame properties.
+        self.frame_x = self.getPropertyValue("image_width")[0]
+        self.frame_y = self.getPropertyValue("image_height")[0]
+        self.frame_bytes = self.getPropertyValue("image_framebytes")[0]
+
+        # Generate frames for the window of the sensor that is read out.
+        binning = self.sim_values["binning"]
+        self.frame_source.configure(self.frame_left, self.frame_top,
+                                    self.frame_x * binning, self.frame_y * binning, binning)
 
     def checkStatus(self, fn_return, fn_name= "unknown"):
-        None
+        """
+        Check return value of the dcam function call.
+        The simulated calls never fail.
+        """
+        return fn_return
 
     def getCameraProperties(self):
-        None
+        """
+        Return the ids & names of all the properties that the camera supports. This
+        is used at initialization to populate the self.properties attribute.
+        """
+        return {name : p[0] for name, p in SIM_PROPERTIES.items()}
 
     def getFrames(self):
-        None
+        """
+        Gets all of the available frames.
+
+        This will block waiting for new frames even if
+        there new frames available when it is called.
+        """
+        frames = []
+        new_frames = self.newFrames()
+        t0 = time.perf_counter()
+        for n in new_frames:
+
+            # Create storage for the frame & copy into this storage.
+            [address, framestamp, timestamp] = self.getFrameInfo(n)
+            hc_data = HCamData(self.frame_bytes)
+            hc_data.copyData(address)
+            hc_data.framestamp = framestamp
+            hc_data.timestamp = timestamp
+
+            frames.append(hc_data)
+
+        if frames:
+            self.stats.add_copy(time.perf_counter() - t0, len(frames))
+            self.stats.add_frames([f.framestamp for f in frames], [f.timestamp for f in frames])
+        return [frames, [self.frame_x, self.frame_y]]
+
+    def getFrameStack(self):
+        """
+        Gets all of the available frames as one (N, frame_y, frame_x) uint16
+        array, oldest first, so that they can be analysed together.
+
+        The array is reused by the next call (there is no allocation for
+        each frame), so copy anything that needs to be kept.
+        """
+        new_frames = self.newFrames()
+        t0 = time.perf_counter()
+        stack = self.stackBuffer(len(new_frames))
+        for i, n in enumerate(new_frames):
+            [address, framestamp, timestamp] = self.getFrameInfo(n)
+            stack[i].flat[:] = self.sim_buffers[n]
+            self.stack_info[i] = (framestamp, timestamp)
+        if new_frames:
+            self.stats.add_copy(time.perf_counter() - t0, len(new_frames))
+            info = self.stack_info[:len(new_frames)]
+            self.stats.add_frames(info['framestamp'], info['timestamp'])
+        return [stack, [self.frame_x, self.frame_y]]
+
+    def getFrameInfo(self, n):
+        """
+        Return [address, framestamp, timestamp] for frame n in the camera
+        buffers: the address of the frame data, the number of the frame
+        counted since the start of the acquisition, and the time the frame
+        was captured in seconds.
+        """
+        with self.sim_cond:
+            return [self.sim_buffers[n].ctypes.data, int(self.sim_stamps[n]), float(self.sim_times[n])]
+
+    def getFramesInfo(self, new_frames):
+        """
+        Return the framestamps and timestamps of the frames in the camera
+        buffers listed in new_frames, and add them to the acquisition
+        statistics.
+        """
+        framestamps, timestamps = [], []
+        for n in new_frames:
+            [address, framestamp, timestamp] = self.getFrameInfo(n)
+            framestamps.append(framestamp)
+            timestamps.append(timestamp)
+        self.stats.add_frames(framestamps, timestamps)
+        return [framestamps, timestamps]
 
     def getModelInfo(self, camera_id):
-        None
+        """
+        Returns the model of the camera
+        """
+        return "C13440-20CU (simulated)"
 
     def getProperties(self):
-        None
+        """
+        Return the list of camera properties. This is the one to call if you
+        want to know the camera properties.
+        """
+        return self.properties
 
     def getPropertyAttribute(self, property_name):
-        None
+        """
+        Return the attribute structure of a particular property.
+        """
+        if not (property_name in SIM_PROPERTIES):
+            print("property", property_name, "is not supported")
+            return False
+        p_id, p_type, p_attr, p_min, p_max, p_step, p_default, _ = SIM_PROPERTIES[property_name]
+        prop_attr = DCAMPROP_ATTR()
+        prop_attr.cbSize = ctypes.sizeof(prop_attr)
+        prop_attr.iProp = p_id
+        prop_attr.attribute = p_attr | p_type
+        prop_attr.valuemin = p_min
+        prop_attr.valuemax = p_max
+        prop_attr.valuestep = p_step
+        prop_attr.valuedefault = p_default
+        return prop_attr
 
     def getPropertyRange(self, property_name):
-        None
+        """
+        Return the range for an attribute.
+        """
+        prop_attr = self.getPropertyAttribute(property_name)
+        temp = prop_attr.attribute & DCAMPROP_TYPE_MASK
+        if (temp == DCAMPROP_TYPE_REAL):
+            return [float(prop_attr.valuemin), float(prop_attr.valuemax)]
+        else:
+            return [int(prop_attr.valuemin), int(prop_attr.valuemax)]
 
     def getPropertyRW(self, property_name):
-        None
+        """
+        Return if a property is readable / writeable.
+        """
+        prop_attr = self.getPropertyAttribute(property_name)
+        return [bool(prop_attr.attribute & DCAMPROP_ATTR_READABLE),
+                bool(prop_attr.attribute & DCAMPROP_ATTR_WRITABLE)]
 
     def getPropertyText(self, property_name):
-        None
+        """
+        Return the text options of a property (if any).
+        """
+        return dict(SIM_PROPERTIES[property_name][7])
 
     def getPropertyValue(self, property_name):
-        None
-    
+        """
+        Return the current setting of a particular property.
+        """
+
+        # Check if the property exists.
+        if not (property_name in self.properties):
+            print(" unknown property name:", property_name)
+            return False
+
+        # Convert type based on attribute type.
+        temp = SIM_PROPERTIES[property_name][1]
+        if (temp == DCAMPROP_TYPE_MODE):
+            return [int(self.sim_values[property_name]), "MODE"]
+        elif (temp == DCAMPROP_TYPE_LONG):
+            return [int(self.sim_values[property_name]), "LONG"]
+        else:
+            return [float(self.sim_values[property_name]), "REAL"]
+
     def getPropertiesValues(self):
-        None
+
+        for i in self.properties:
+            prop_attr = self.getPropertyValue(i)
+            print("{} : {}".format(i, prop_attr[0]))
 
     def isCameraProperty(self, property_name):
-        None
+        """
+        Check if a property name is supported by the camera.
+        """
+        return (property_name in self.properties)
+
+    def getFrameCount(self):
+        """
+        Return the number of frames the camera has captured since the start
+        of the acquisition.
+        """
+        with self.sim_cond:
+            return self.sim_count
 
     def newFrames(self):
-        None
+        """
+        Return a list of the ids of all the new frames since the last check.
+        Returns an empty list if the camera has already stopped and no frames
+        are available.
+
+        This will block waiting for at least one new frame.
+        """
+        with self.sim_cond:
+            # Wait for a new frame if the camera is acquiring.
+            if self.sim_status == DCAMCAP_STATUS_BUSY:
+                count = self.sim_count
+                self.sim_cond.wait_for(
+                    lambda: (self.sim_count != count) or (self.sim_status != DCAMCAP_STATUS_BUSY)
+                            or self.sim_abort,
+                    1.0) # 1 second timeout, as for dcamwait_start
+                self.sim_abort = False
+
+            # Check how many new frames there are.
+            cur_buffer_index = self.sim_newest
+            cur_frame_number = self.sim_count
+
+        # Check that we have not acquired more frames than we can store in our buffer.
+        # Keep track of the maximum backlog.
+        backlog = cur_frame_number - self.last_frame_number
+        self.overrun = (backlog > self.number_image_buffers)
+        if self.overrun:
+            print(">> Warning! hamamatsu camera frame buffer overrun detected!")
+            self.frames_lost += backlog - self.number_image_buffers
+        if (backlog > self.max_backlog):
+            self.max_backlog = backlog
+        self.stats.add_backlog(backlog, self.number_image_buffers)
+        self.last_frame_number = cur_frame_number
+
+        # Create a list of the new frames.
+        new_frames = []
+        if (cur_buffer_index < self.buffer_index):
+            for i in range(self.buffer_index + 1, self.number_image_buffers):
+                new_frames.append(i)
+            for i in range(cur_buffer_index + 1):
+                new_frames.append(i)
+        else:
+            for i in range(self.buffer_index, cur_buffer_index):
+                new_frames.append(i+1)
+        self.buffer_index = cur_buffer_index
+
+        if self.debug:
+            print(new_frames)
+
+        return new_frames
 
     def setPropertyValue(self, property_name, property_value):
-        None
+        """
+        Set the value of a property.
+        """
+
+        # Check if the property exists.
+        if not (property_name in self.properties):
+            print(" unknown property name:", property_name)
+            return False
+
+        # If the value is text, figure out what the
+        # corresponding numerical property value is.
+        if (isinstance(property_value, str)):
+            text_values = self.getPropertyText(property_name)
+            if (property_value in text_values):
+                property_value = float(text_values[property_value])
+            else:
+                print(" unknown property text value:", property_value, "for", property_name)
+                return False
+
+        if not self.getPropertyRW(property_name)[1]:
+            print(" property", property_name, "is read only")
+            return False
+
+        # Check that the property is within range.
+        [pv_min, pv_max] = self.getPropertyRange(property_name)
+        if (property_value < pv_min):
+            print(" set property value", property_value, "is less than minimum of", pv_min, property_name, "setting to minimum")
+            property_value = pv_min
+        if (property_value > pv_max):
+            print(" set property value", property_value, "is greater than maximum of", pv_max, property_name, "setting to maximum")
+            property_value = pv_max
+
+        # The camera rounds to the nearest allowed value.
+        p_type, step = SIM_PROPERTIES[property_name][1], SIM_PROPERTIES[property_name][5]
+        if (p_type == DCAMPROP_TYPE_MODE):
+            options = list(SIM_PROPERTIES[property_name][7].values()) or [int(property_value)]
+            property_value = min(options, key = lambda v: abs(v - property_value))
+        elif (p_type == DCAMPROP_TYPE_LONG):
+            property_value = int(round(property_value / step) * step)
+
+        # The subarray must stay on the sensor.
+        if property_name in ("subarray_hpos", "subarray_hsize"):
+            self.sim_values[property_name] = property_value
+            self.sim_values["subarray_hpos"] = min(self.sim_values["subarray_hpos"],
+                    SIM_SENSOR_SIZE - self.sim_values["subarray_hsize"])
+        elif property_name in ("subarray_vpos", "subarray_vsize"):
+            self.sim_values[property_name] = property_value
+            self.sim_values["subarray_vpos"] = min(self.sim_values["subarray_vpos"],
+                    SIM_SENSOR_SIZE - self.sim_values["subarray_vsize"])
+        else:
+            self.sim_values[property_name] = property_value
+        self.simUpdate()
+
+        # Return what it was set too.
+        return float(self.sim_values[property_name])
 
     def setSubArrayMode(self):
-        None
+        """
+        This sets the sub-array mode as appropriate based on the current ROI.
+        """
+
+        # Check ROI properties.
+        roi_w = self.getPropertyValue("subarray_hsize")[0]
+        roi_h = self.getPropertyValue("subarray_vsize")[0]
+
+        # If the ROI is smaller than the entire frame turn on subarray mode
+        if ((roi_w == self.max_width) and (roi_h == self.max_height)):
+            self.setPropertyValue("subarray_mode", "OFF")
+        else:
+            self.setPropertyValue("subarray_mode", "ON")
+
+    def getSubArray(self):
+        """
+        Return the window of the sensor that is read out as
+        [hpos, hsize, vpos, vsize] in unbinned sensor pixels.
+        """
+        if (self.getPropertyValue("subarray_mode")[0] == self.getPropertyText("subarray_mode")["OFF"]):
+            return [0, int(self.max_width), 0, int(self.max_height)]
+        return [int(self.getPropertyValue(name)[0]) for name in
+                ["subarray_hpos", "subarray_hsize", "subarray_vpos", "subarray_vsize"]]
+
+    def setSubArray(self, hpos, hsize, vpos, vsize):
+        """
+        Read out the window of the sensor with its corner at (hpos, vpos)
+        and size (hsize, vsize) in unbinned sensor pixels. The window is
+        grown out to the allowed steps of the subarray properties so that
+        it still covers the requested pixels, then the sub-array mode is
+        set. Returns the window that was set as [hpos, hsize, vpos, vsize].
+        """
+        for axis, pos, size, sensor in [("h", hpos, hsize, self.max_width),
+                                        ("v", vpos, vsize, self.max_height)]:
+            pos_name, size_name = "subarray_" + axis + "pos", "subarray_" + axis + "size"
+            step = int(max(self.getPropertyAttribute(pos_name).valuestep,
+                           self.getPropertyAttribute(size_name).valuestep, 1))
+            start = max(int(pos) // step * step, 0)
+            end = min(-(-int(pos + size) // step) * step, int(sensor))
+            size = max(end - start, self.getPropertyRange(size_name)[0])
+            start = min(start, int(sensor) - size)
+
+            # Move to the edge first if the new size doesn't fit at the old position.
+            if (self.getPropertyValue(pos_name)[0] + size > sensor):
+                self.setPropertyValue(pos_name, 0)
+            if (size != self.getPropertyValue(size_name)[0]):
+                self.setPropertyValue(size_name, size)
+            if (start != self.getPropertyValue(pos_name)[0]):
+                self.setPropertyValue(pos_name, start)
+        self.setSubArrayMode()
+        return self.getSubArray()
 
     def setACQMode(self, mode, number_frames = None):
-        None
+        '''
+        Set the acquisition mode to either run until aborted or to
+        stop after acquiring a set number of frames.
+
+        mode should be either "fixed_length" or "run_till_abort"
+
+        if mode is "fixed_length", then number_frames indicates the number
+        of frames to acquire.
+        '''
+
+        self.stopAcquisition()
+
+        if mode == "fixed_length" or \
+                mode == "run_till_abort":
+            self.acquisition_mode = mode
+            self.number_frames = number_frames
+        else:
+            raise DCAMException("Unrecognized acqusition mode: " + mode)
+
+    def simUpdate(self):
+        """
+        Update the read only properties that depend on the current settings.
+        """
+        values = self.sim_values
+        binning = int(values["binning"])
+        if values["subarray_mode"] == SIM_PROPERTIES["subarray_mode"][7]["ON"]:
+            self.frame_left, self.frame_top = values["subarray_hpos"], values["subarray_vpos"]
+            width, height = values["subarray_hsize"], values["subarray_vsize"]
+        else:
+            self.frame_left, self.frame_top = 0, 0
+            width, height = SIM_SENSOR_SIZE, SIM_SENSOR_SIZE
+        values["image_width"] = width // binning
+        values["image_height"] = height // binning
+        values["image_rowbytes"] = values["buffer_rowbytes"] = 2 * values["image_width"]
+        values["image_framebytes"] = values["buffer_framebytes"] = \
+                values["image_rowbytes"] * values["image_height"]
+        values["timing_readout_time"] = height / 2 * SIM_LINE_TIME
+        values["internal_frame_rate"] = 1.0 / max(values["exposure_time"], values["timing_readout_time"])
+
+    def simStart(self, snap):
+        """
+        Start the capture thread writing frames into self.sim_buffers.
+        If snap is True, stop once every buffer has been filled once.
+        """
+        with self.sim_cond:
+            self.sim_newest = -1
+            self.sim_count = 0
+            self.sim_late = 0
+            self.sim_stamps = np.full(len(self.sim_buffers), -1, dtype=int) # framestamp of each buffer
+            self.sim_times = np.zeros(len(self.sim_buffers))                 # time each buffer was filled
+            self.sim_status = DCAMCAP_STATUS_BUSY
+        self.sim_stop.clear()
+        self.sim_trigger.clear()
+        self.sim_thread = threading.Thread(target = self.simCapture, args = (snap,), daemon = True)
+        self.sim_thread.start()
+
+    def simStop(self):
+        """
+        Stop the capture thread.
+        """
+        self.sim_stop.set()
+        self.sim_trigger.set()
+        if self.sim_thread is not None:
+            self.sim_thread.join()
+            self.sim_thread = None
+        with self.sim_cond:
+            self.sim_status = DCAMCAP_STATUS_READY
+            self.sim_cond.notify_all()
+
+    def simCapture(self, snap):
+        """
+        Capture thread. With the internal trigger, frames are due once
+        every 1/internal_frame_rate seconds. If making the frames falls
+        behind, the frame count still advances at the camera rate (as
+        the camera would), but only the newest of the due frames is
+        filled and the rest are counted in sim_late.
+        """
+        n_buffers = len(self.sim_buffers)
+        external = (self.sim_values["trigger_source"] == DCAMPROP_TRIGGERSOURCE__EXTERNAL)
+        period = 1.0 / self.sim_values["internal_frame_rate"]
+        delay = self.sim_values["exposure_time"] + self.sim_values["timing_readout_time"]
+        t0 = time.perf_counter()
+        while not self.sim_stop.is_set():
+            if external and self.trigger_period:
+                # Periodic external trigger, the frame is ready after exposure and readout.
+                t_next = t0 + (self.sim_count + 1) * max(self.trigger_period, period)
+                if self.sim_stop.wait(max(t_next + delay - time.perf_counter(), 0)):
+                    break
+                due = 1
+            elif external:
+                # Wait for fireTrigger().
+                if not self.sim_trigger.wait(0.1):
+                    continue
+                self.sim_trigger.clear()
+                if self.sim_stop.wait(delay):
+                    break
+                due = 1
+            else:
+                t_next = t0 + (self.sim_count + 1) * period
+                if self.sim_stop.wait(max(t_next - time.perf_counter(), 0)):
+                    break
+                due = max(int((time.perf_counter() - t0) / period) - self.sim_count, 1)
+
+            if snap:
+                due = min(due, n_buffers - self.sim_count)
+            index = (self.sim_newest + due) % n_buffers
+            self.frame_source.fill(self.sim_buffers[index])
+
+            with self.sim_cond:
+                # frames that weren't generated in time keep the old data, but
+                # are counted with the newest frame as the camera would have taken them
+                skipped = (self.sim_newest + 1 + np.arange(due)) % n_buffers
+                self.sim_stamps[skipped] = self.sim_count + np.arange(due)
+                self.sim_times[skipped] = time.time()
+                self.sim_newest = index
+                self.sim_count += due
+                self.sim_late += due - 1
+                if snap and (self.sim_count >= n_buffers):
+                    self.sim_status = DCAMCAP_STATUS_READY
+                self.sim_cond.notify_all()
+            if self.sim_status != DCAMCAP_STATUS_BUSY:
+                break
+
+    def fireTrigger(self):
+        """
+        Send a simulated external trigger pulse.
+        """
+        self.sim_trigger.set()
 
     def startAcquisition(self):
-        None
+        """
+        Start data acquisition.
+        """
+        self.captureSetup()
+
+        #
+        # Allocate image buffers.
+        # We allocate enough to buffer 2 seconds of data or the specified
+        # number of frames for a fixed length acquisition
+        #
+        if self.acquisition_mode == "run_till_abort":
+            n_buffers = int(2.0*self.getPropertyValue("internal_frame_rate")[0])
+        elif self.acquisition_mode == "fixed_length":
+            n_buffers = self.number_frames
+
+        self.number_image_buffers = n_buffers
+        self.sim_buffers = [np.empty(int(self.frame_bytes/2), dtype=np.uint16)
+                            for i in range(self.number_image_buffers)]
+
+        # Start acquisition.
+        self.simStart(self.acquisition_mode == "fixed_length")
 
     def stopAcquisition(self):
-        None
+        """
+        Stop data acquisition.
+        """
+
+        # Stop acquisition.
+        self.simStop()
+
+        print("max camera backlog was", self.max_backlog, "of", self.number_image_buffers)
+        if self.stats.n_frames and not self.stats_printed:
+            print("acquisition:", self.stats)
+            self.stats_printed = True
+        self.max_backlog = 0
+
+        # Free image buffers.
+        self.number_image_buffers = 0
+        self.sim_buffers = []
+
+    def abortWait(self):
+        """
+        Abort a newFrames() call that is waiting for a frame in another
+        thread, so that the thread can be stopped without waiting for
+        the next frame or the timeout.
+        """
+        with self.sim_cond:
+            self.sim_abort = True
+            self.sim_cond.notify_all()
 
     def shutdown(self):
-        None
+        """
+        Close down the connection to the camera.
+        """
+        self.simStop()
 
     def sortedPropertyTextOptions(self, property_name):
-        None
+        """
+        Returns the property text options a list sorted by value.
+        """
+        text_values = self.getPropertyText(property_name)
+        return sorted(text_values, key = text_values.get)
+
+    def stackBuffer(self, n_frames):
+        """
+        Return the first n_frames of the array reused by getFrameStack()
+        (internal use only). The array is reallocated if the frame size
+        changed, or grown by doubling if it has too few frames.
+        """
+        shape = (self.frame_y, self.frame_x)
+        stack = self.frame_stack
+        if (stack is None) or (stack.shape[1:] != shape):
+            stack = np.empty((max(n_frames, 1),) + shape, dtype=np.uint16)
+        elif (len(stack) < n_frames):
+            size = min(max(2 * len(stack), n_frames), max(self.number_image_buffers, n_frames))
+            stack = np.empty((size,) + shape, dtype=np.uint16)
+        if not (stack is self.frame_stack):
+            self.stack_info = np.zeros(len(stack), dtype=[('framestamp', int), ('timestamp', float)])
+        self.frame_stack = stack
+        return stack[:n_frames]
 
 
 class HamamatsuCameraMR(HamamatsuCamera):
+    """
+    Memory recycling camera class.
 
+    This version allocates "user memory" for the camera buffers, which
+    the capture thread writes into directly. This memory is also the
+    location of the storage for the np_array element of a HCamData()
+    class, as for camera_try.HamamatsuCameraMR.
+
+    Consumers that read frames in place should holdFrame() them and
+    releaseFrame() them when done, see checkHeldFrames().
+    """
     def __init__(self, **kwds):
-        None
+        super().__init__(**kwds)
+
+        self.hcam_data = []
+        self.hcam_ptr = False
+        self.ring = None        # (number_image_buffers, pixels) array of the camera buffers
+        self.old_frame_bytes = -1
+        self.held_frames = {}   # buffer index : HCamData held by a consumer
+        self.frame_lock = threading.Lock()
+        self.buffer_bytes = SIM_BUFFER_BYTES
 
     def getFrames(self):
+        """
+        Gets all of the available frames.
+
+        This will block waiting for new frames even if there new frames
+        available when it is called.
+        """
+        new_frames = self.newFrames()
         frames = []
-        return [frames, [None, None]]
+        [framestamps, timestamps] = self.getFramesInfo(new_frames)
+        for n, framestamp, timestamp in zip(new_frames, framestamps, timestamps):
+            self.hcam_data[n].framestamp = framestamp
+            self.hcam_data[n].timestamp = timestamp
+            frames.append(self.hcam_data[n])
+
+        self.checkHeldFrames(new_frames)
+        return [frames, [self.frame_x, self.frame_y]]
+
+    def getFrameStack(self):
+        """
+        Gets all of the available frames as one (N, frame_y, frame_x) uint16
+        array, oldest first, so that they can be analysed together.
+
+        The new frames are consecutive buffers in the ring, which can wrap
+        around to the start once, so they are copied with (at most) two
+        block copies. The array is reused by the next call, so copy
+        anything that needs to be kept.
+        """
+        new_frames = self.newFrames()
+        n_frames = len(new_frames)
+        stack = self.stackBuffer(n_frames)
+        if n_frames:
+            [framestamps, timestamps] = self.getFramesInfo(new_frames)
+            self.stack_info[:n_frames] = list(zip(framestamps, timestamps))
+            t0 = time.perf_counter()
+            flat = stack.reshape(n_frames, -1)
+            start = new_frames[0]
+            first = min(n_frames, self.number_image_buffers - start)
+            flat[:first] = self.ring[start:start + first]
+            flat[first:] = self.ring[:n_frames - first]
+            self.stats.add_copy(time.perf_counter() - t0, n_frames)
+
+        self.checkHeldFrames(new_frames)
+        return [stack, [self.frame_x, self.frame_y]]
+
+    def holdFrame(self, hc_data):
+        """
+        Mark a frame returned by getFrames() as in use so that its data can be
+        read in place (e.g. by analysis in another thread) without copying.
+        Every holdFrame() must be matched by a releaseFrame().
+        """
+        with self.frame_lock:
+            for n, ring_data in enumerate(self.hcam_data):
+                if ring_data is hc_data:
+                    hc_data.refs += 1
+                    hc_data.stale = False
+                    self.held_frames[n] = hc_data
+                    return True
+        return False # not one of the camera buffers
+
+    def releaseFrame(self, hc_data):
+        """
+        Release a frame held with holdFrame(). Returns False if the camera
+        has started to write over the frame while it was held, in which case
+        the data read from it should be discarded. The buffer of frame f is
+        reused for frame f + number_image_buffers, which the camera starts
+        writing once it has captured that many frames.
+        """
+        with self.frame_lock:
+            hc_data.refs = max(hc_data.refs - 1, 0)
+            if hc_data.refs == 0:
+                for n, held_data in list(self.held_frames.items()):
+                    if held_data is hc_data:
+                        del self.held_frames[n]
+            if (self.getFrameCount() >= hc_data.framestamp + self.number_image_buffers):
+                hc_data.stale = True
+        return not hc_data.stale
+
+    def checkHeldFrames(self, new_frames):
+        """
+        Flag held frames that the camera has written over as stale. The
+        camera cannot be stopped from writing into a buffer and consumers
+        read held frames in place (e.g. through views of the buffer), so
+        the frames stay held until they are released, when releaseFrame()
+        checks the frame count again.
+        """
+        if not self.held_frames:
+            return
+        with self.frame_lock:
+            for n, hc_data in self.held_frames.items():
+                if (self.overrun or (n in new_frames)) and not hc_data.stale:
+                    print(">> Warning! held frame", n, "was overwritten by the camera")
+                    hc_data.stale = True
 
     def startAcquisition(self):
-        None
-
+        """
+        Allocate as many frames as will fit in 2GB of memory and start data acquisition.
+        """
+        with self.frame_lock: # the frame count restarts, so frames still held can't be checked
+            for hc_data in self.held_frames.values():
+                hc_data.stale = True
+        self.captureSetup()
+
+        # Allocate new image buffers if necessary. This will allocate
+        # as many frames as can fit in 2GB of memory, or 2000 frames,
+        # which ever is smaller.
+        n_buffers = min(int(self.buffer_bytes/self.frame_bytes), 2000)
+        if self.acquisition_mode == "fixed_length":
+            n_buffers = self.number_frames
+        if (self.old_frame_bytes != self.frame_bytes) or \
+                (self.number_image_buffers != n_buffers) or \
+                (self.acquisition_mode == "fixed_length"):
+            self.number_image_buffers = n_buffers
+
+            # Allocate new image buffers, as frames of one contiguous ring.
+            self.hcam_ptr = True
+            self.ring = np.empty((self.number_image_buffers, int(self.frame_bytes/2)), dtype=np.uint16)
+            self.hcam_data = []
+            for i in range(self.number_image_buffers):
+                hc_data = HCamData(data = self.ring[i])
+                self.hcam_data.append(hc_data)
+
+            self.old_frame_bytes = self.frame_bytes
+
+        # Attach image buffers and start acquisition.
+        self.sim_buffers = [hc_data.getData() for hc_data in self.hcam_data]
+        self.simStart(self.acquisition_mode == "fixed_length")
 
     def stopAcquisition(self):
-        None
-    
-    def startRecording(self):
-        None
-        
-
+        """
+        Stop data acquisition and release the memory associates with the frames.
+        """
+
+        # Stop acquisition.
+        self.simStop()
+
+        # Release image buffers.
+        self.sim_buffers = []
+
+        print("max camera backlog was:", self.max_backlog)
+        if self.stats.n_frames and not self.stats_printed:
+            print("acquisition:", self.stats)
+            self.stats_printed = True
+        self.max_backlog = 0
+
+    def startRecording(self, file_name, max_frames, slots = 64):
+        """
+        Start acquiring and stream the frames to a raw file, see
+        frameRecorder.FrameRecorder. At most max_frames are recorded and
+        at most slots frames are kept in memory waiting to be written.
+        Returns the recorder, call its stop() to finish the recording.
+        """
+        recorder = frameRecorder.FrameRecorder(self, file_name, max_frames, slots)
+        recorder.start()
+        return recorder
 
 
 if __name__ == '__main__':
-    
+
     import sys
-    import pyqtgraph as pg
-    import qtpy
-    from qtpy.QtWidgets import QApplication
-    
-    
+
     #
-    # Initialization
+    # Load test: stream frames from the simulated camera for a few seconds
+    # and report the throughput and the number of frames dropped.
     #
-    #dcam = ctypes.WinDLL('C:\\Users\\Admin\\Downloads\\DCAM-API for Windows (18.11.5660)\\DCAMAPI\\fbdphx\\Win\\x64\\dcamapi.dll')
-    dcam = ctypes.windll.dcamapi
-    #dcam.visit()
-    print(dcam)
-    paraminit = DCAMAPI_INIT(0, 0, 0, 0, None, None) 
-    paraminit.size = ctypes.sizeof(paraminit)
-    error_code = dcam.dcamapi_init(ctypes.byref(paraminit))
-    if (error_code != DCAMERR_NOERROR):
-        raise DCAMException("DCAM initialization failed with error code " + str(error_code))
-    
-    n_cameras = paraminit.iDeviceCount
+    # usage: python camera_try_stub.py [duration (s)] [subarray size] [exposure (s)]
+    #
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    exposure = float(sys.argv[3]) if len(sys.argv) > 3 else 0.001
 
-    print("found: {} cameras".format(n_cameras))
     hcam = HamamatsuCameraMR(camera_id = 0)
     print("camera 0 model:", hcam.getModelInfo(0))
 
-    
-    
-    
-    
-    
-    
-#     what = hcam.getProperties()
-#     print(what)
-#     attr = hcam.getPropertyAttribute('sensor_mode')
-#     print(attr.valuemax)
-#     rang = hcam.getPropertyRange('image_framebytes')
-#     print(rang)
-#     ragn = hcam.setPropertyValue('exposure_time', 0.01)
-#     print(ragn)
-#     boh = hcam.getPropertyValue('exposure_time')
-#     print(boh)
-#     mboh = hcam.getPropertyRW('image_framebytes')
-#     print(mboh)
-#     
-#     mboh = hcam.getPropertyAttribute('subarray_hsize')
-#     print(mboh.valuemax)
-#     mboh = hcam.setPropertyValue('subarray_hsize', mboh.valuemin )
-#     print(mboh)
-#     mboh = hcam.getPropertyAttribute('subarray_vsize')
-#     print(mboh.attribute , bin(mboh.attribute))
-#     print(mboh.attribute & DCAMPROP_ATTR_WRITABLE)
-#     mboh = hcam.setPropertyValue('subarray_vsize', mboh.valuemin)
-#     hcam.getPropertiesValues()
-#     rang = hcam.getPropertyValue('image_framebytes')
-#     print(rang)
-#     
-#     image = hcam.setPropertyValue("subarray_mode", "ON")
-#     print(image)
-#     rang = hcam.getPropertyValue('image_framebytes')
-#     print(rang)
-
-    
-    hcam.number_frames = 1
-    hcam.acquisition_mode = "fixed_length"
-    hsize = int(hcam.setPropertyValue("subarray_hsize", 2048))#int is for the reshape function(see later)
-    vsize = int(hcam.setPropertyValue("subarray_vsize", 2048))
-    hoffset = hcam.setPropertyValue("subarray_hpos", 0)
-    voffset = hcam.setPropertyValue("subarray_vpos", 0)
-    mode = hcam.setPropertyValue("subarray_mode", "ON")
-    exposure = hcam.setPropertyValue("exposure_time", 0.1) #when changing the exposure time, remember there is a timeout for the wait event 
-    binning = hcam.setPropertyValue("binning", "1x1")
-#   trigger
-#   trsource=hcam.setPropertyValue("trigger_source", DCAMPROP_TRIGGERSOURCE__EXTERNAL) 
-#   trmode=hcam.setPropertyValue("trigger_mode", DCAMPROP_TRIGGER_MODE__START)
-#   trpolarity=hcam.setPropertyValue("trigger_polarity", DCAMPROP_TRIGGERPOLARITY__POSITIVE)
-    #bin_fp = open("D://Data//trying_acquisition.dcimg", "wb")
-    props = hcam.getPropertiesValues()
-    print(props)
-    
-    while hcam.getPropertyValue("sensor_temperature")[0] > -9.0:
-        pass
-    #if 1:
-    #bin_fp = open("e:/zhuang/test.bin", "wb")
-    if 0:
-        
-        hcam.startAcquisition()
-        print("Gooooo")
-        time.sleep(5)
-        for i in range(hcam.number_frames):
-    
-            # Get frames.
-            [frames, dims] = hcam.getFrames()
-    
-            # Save frames.
-            for aframe in frames:
-                np_data = aframe.getData()
-                pg.image(np.reshape(np_data,(vsize, hsize)).T,)
-                #np_data.tofile(bin_fp)
-    
-            # Print backlog.
-            print (i, len(frames))
-            #print(np_data)
-            #pg.image(np.reshape(np_data,(vsize, hsize)).T) #.T do the transpose, otherwise the image is inverted (due to how data are put in the buffer)
-            #if (len(frames) > 20):
-            #    exit()
-    
-        hcam.stopAcquisition()
-        #bin_fp.close()
-        hcam.shutdown()
-        error_uninit = dcam.dcamapi_uninit()
-        
-        if (error_uninit != DCAMERR_NOERROR):
-            raise DCAMException("DCAM uninitialization failed with error code " + str(error_uninit))
-    
-    if 1:
-        try:
-            
-            hcam.startRecording()
-            
-        
-        finally:
-            
-            dcam.dcamcap_stop(hcam.camera_handle)
-
-            error_uninit = dcam.dcamapi_uninit()
-            
-            if (error_uninit != DCAMERR_NOERROR):
-                raise DCAMException("DCAM uninitialization failed with error code " + str(error_uninit))
-        
-
-    if sys.flags.interactive !=1 or not hasattr(qtpy.QtCore, 'PYQT_VERSION'):
-            QApplication.exec_()
-    
-    
-    
-    
-    
-    #start = hcam.startAcquisition()
-
-#     start = hcam.startAcquisition()
-#     stop = hcam.stopAcquisition()
-#    print(start, stop)
-# Testing.
-#
-# if (__name__ == "__main__"):
-# 
-#     import time
-#     import random
-# 
-#     print("found:", n_cameras, "cameras")
-#     if (n_cameras > 0):
-# 
-#         hcam = HamamatsuCameraMR(camera_id = 0)
-#         print(hcam.setPropertyValue("defect_correct_mode", 1))
-#         print("camera 0 model:", hcam.getModelInfo(0))
-# 
-#         # List support properties.
-#         if False:
-#             print("Supported properties:")
-#             props = hcam.getProperties()
-#             for i, id_name in enumerate(sorted(props.keys())):
-#                 [p_value, p_type] = hcam.getPropertyValue(id_name)
-#                 p_rw = hcam.getPropertyRW(id_name)
-#                 read_write = ""
-#                 if (p_rw[0]):
-#                     read_write += "read"
-#                 if (p_rw[1]):
-#                     read_write += ", write"
-#                 print("  ", i, ")", id_name, " = ", p_value, " type is:", p_type, ",", read_write)
-#                 text_values = hcam.getPropertyText(id_name)
-#                 if (len(text_values) > 0):
-#                     print("          option / value")
-#                     for key in sorted(text_values, key = text_values.get):
-#                         print("         ", key, "/", text_values[key])
-
-#         # Test setting & getting some parameters.
-#         if False:
-#             print(hcam.setPropertyValue("exposure_time", 0.001))
-# 
-#             #print(hcam.setPropertyValue("subarray_hsize", 2048))
-#             #print(hcam.setPropertyValue("subarray_vsize", 2048))
-#             print(hcam.setPropertyValue("subarray_hpos", 512))
-#             print(hcam.setPropertyValue("subarray_vpos", 512))
-#             print(hcam.setPropertyValue("subarray_hsize", 1024))
-#             print(hcam.setPropertyValue("subarray_vsize", 1024))
-# 
-#             print(hcam.setPropertyValue("binning", "1x1"))
-#             print(hcam.setPropertyValue("readout_speed", 2))
-#     
-#             hcam.setSubArrayMode()
-#             #hcam.startAcquisition()
-#             #hcam.stopAcquisition()
-# 
-#             params = ["internal_frame_rate",
-#                       "timing_readout_time",
-#                       "exposure_time"]
-# 
-#             #                      "image_height",
-#             #                      "image_width",
-#             #                      "image_framebytes",
-#             #                      "buffer_framebytes",
-#             #                      "buffer_rowbytes",
-#             #                      "buffer_top_offset_bytes",
-#             #                      "subarray_hsize",
-#             #                      "subarray_vsize",
-#             #                      "binning"]
-#             for param in params:
-#                 print(param, hcam.getPropertyValue(param)[0])
-# 
-#         # Test 'run_till_abort' acquisition.
-#         if False:
-#             print("Testing run till abort acquisition")
-#             hcam.startAcquisition()
-#             cnt = 0
-#             for i in range(300):
-#                 [frames, dims] = hcam.getFrames()
-#                 for aframe in frames:
-#                     print(cnt, aframe[0:5])
-#                     cnt += 1
-# 
-#             print("Frames acquired: " + str(cnt))    
-#             hcam.stopAcquisition()
-# 
-#         # Test 'fixed_length' acquisition.
-#         if True:
-#             for j in range (10000):
-#                 print("Testing fixed length acquisition")
-#                 hcam.setACQMode("fixed_length", number_frames = 10)
-#                 hcam.startAcquisition()
-#                 cnt = 0
-#                 iterations = 0
-#                 while cnt < 11 and iterations < 20:
-#                     [frames, dims] = hcam.getFrames()
-#                     waitTime = random.random()*0.03
-#                     time.sleep(waitTime)
-#                     iterations += 1
-#                     print('Frames loaded: ' + str(len(frames)))
-#                     print('Wait time: ' + str(waitTime))
-#                     for aframe in frames:
-#                         print(cnt, aframe[0:5])
-#                         cnt += 1
-#                 if cnt < 10:
-#                     print('##############Error: Not all frames found#########')
-#                     input("Press enter to continue")
-#                 print("Frames acquired: " + str(cnt))        
-#                 hcam.stopAcquisition()
-# 
-#                 hcam.setACQMode("run_till_abort")
-#                 hcam.startAcquisition()
-#                 time.sleep(random.random())
-#                 contFrames = hcam.getFrames()
-#                 hcam.stopAcquisition()
-
+    hsize = int(hcam.setPropertyValue("subarray_hsize", size))
+    vsize = int(hcam.setPropertyValue("subarray_vsize", size))
+    hcam.setPropertyValue("subarray_hpos", (SIM_SENSOR_SIZE - hsize)//2)
+    hcam.setPropertyValue("subarray_vpos", (SIM_SENSOR_SIZE - vsize)//2)
+    hcam.setPropertyValue("exposure_time", exposure)
+    hcam.setSubArrayMode()
+    print("frame rate: {:.1f} fps".format(hcam.getPropertyValue("internal_frame_rate")[0]))
+
+    hcam.startAcquisition()
+    n_frames = 0
+    t0 = time.time()
+    while time.time() - t0 < duration:
+        [frames, dims] = hcam.getFrames()
+        for aframe in frames:
+            np_data = np.reshape(aframe.getData(), (dims[1], dims[0]))
+        n_frames += len(frames)
+    t1 = time.time()
+    captured, late = hcam.sim_count, hcam.sim_late
+    hcam.stopAcquisition()
+    hcam.shutdown()
+
+    print("frames captured: {}, read: {}, lost to overruns: {}, not generated in time: {}".format(
+        captured, n_frames, hcam.frames_lost, late))
+    print("throughput: {:.1f} fps, {:.1f} MB/s".format(n_frames / (t1 - t0),
+        n_frames * hsize * vsize * 2 / (t1 - t0) / 1e6))
 
 
 #
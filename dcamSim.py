@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+"""
+A pure Python stand-in for the DCAM library (dcamapi.dll).
+
+DCAMSim has the dcam* functions that camera_try calls through ctypes,
+taking the same ctypes arguments (values, structures and byref()
+pointers), so that the real camera_try code paths can be run, profiled
+and benchmarked without the camera or the Windows driver:
+
+    dcam = camera_try.loadDCAM("sim")    # or set DCAM_LIBRARY=sim
+
+Each opened device is driven by the simulated camera from
+camera_try_stub (SIM_PROPERTIES, the capture thread and the
+SimulatedFrameSource), which writes frames into the buffers allocated
+with dcambuf_alloc or attached with dcambuf_attach at the camera frame
+rate. Each call also takes about as long as the call to the real
+library, see SIM_LATENCY.
+"""
+
+import ctypes
+import functools
+import itertools
+import numpy as np
+import threading
+import time
+
+import camera_try_stub as stub
+
+
+# DCAM constants that camera_try doesn't define.
+DCAMERR_ABORT = int("0x80000102", 0) - 2**32
+DCAMERR_TIMEOUT = int("0x80000106", 0) - 2**32
+DCAMERR_INVALIDPARAM = int("0x80000808", 0) - 2**32
+DCAMERR_NOTWRITABLE = int("0x80000823", 0) - 2**32
+
+DCAM_PIXELTYPE_MONO16 = 2
+
+SIM_MODEL = "C13440-20CU"
+
+## SIM_LATENCY
+#
+# Approximate time taken by each call to the real library with an
+# ORCA-Flash 4.0 V3 on USB 3.0, in seconds. Writing a property goes to
+# the camera and back, reading one only reads the driver's copy.
+#
+SIM_LATENCY = {
+    "dcamapi_init" : 0.3,
+    "dcamdev_open" : 0.5,
+    "dcamdev_close" : 0.05,
+    "dcamprop_getattr" : 2e-5,
+    "dcamprop_getvalue" : 2e-5,
+    "dcamprop_setgetvalue" : 2e-3,
+    "dcamprop_getvaluetext" : 2e-5,
+    "dcamprop_queryvalue" : 2e-5,
+    "dcamprop_getnextid" : 1e-5,
+    "dcamprop_getname" : 1e-5,
+    "dcambuf_alloc" : 5e-3,
+    "dcambuf_attach" : 2e-3,
+    "dcambuf_release" : 2e-3,
+    "dcambuf_lockframe" : 2e-5,
+    "dcamcap_start" : 0.02,
+    "dcamcap_stop" : 0.01,
+    "dcamcap_status" : 1e-5,
+    "dcamcap_transferinfo" : 1e-5,
+    "dcamwait_start" : 5e-5,    # after the event happens
+    }
+
+
+def argValue(arg):
+    """
+    The Python value of a ctypes argument (c_int32(1) -> 1).
+    """
+    return getattr(arg, "value", arg)
+
+def argObject(arg):
+    """
+    The object passed by ctypes.byref(), or the structure itself
+    if it was passed by value.
+    """
+    return getattr(arg, "_obj", arg)
+
+def writeString(address, text, n_bytes):
+    """
+    Copy text into a char buffer of n_bytes at address, as a null
+    terminated string.
+    """
+    data = text.encode("utf-8")[:n_bytes - 1] + b"\0"
+    ctypes.memmove(address, data, len(data))
+
+def charBufferAddress(struct, field):
+    """
+    Address of the char buffer pointed to by a c_char_p field of a
+    structure (reading the field would return a copy of the string).
+    """
+    return ctypes.c_void_p.from_buffer(struct, getattr(type(struct), field).offset).value
+
+def dcamFunction(fn):
+    """
+    Decorator for the simulated DCAM functions: wait for the latency of
+    the real call, and return DCAMERR_ERROR with the error message kept
+    for dcam_getlasterror() if the call fails.
+    """
+    @functools.wraps(fn)
+    def wrapper(self, *args):
+        delay = SIM_LATENCY.get(fn.__name__, 0) * self.latency_scale
+        if delay > 1e-3:
+            time.sleep(delay)
+        elif delay > 0: # sleep() can't wait for less than ~1 ms
+            t_end = time.perf_counter() + delay
+            while time.perf_counter() < t_end:
+                pass
+        try:
+            return fn(self, *args)
+        except Exception as e:
+            self.last_error = fn.__name__ + ": " + str(e)
+            return stub.DCAMERR_ERROR
+    return wrapper
+
+
+class SimDevice(object):
+    """
+    State of an opened camera. The simulated camera from camera_try_stub
+    holds the property values and runs the capture thread.
+    """
+    def __init__(self, index, frame_source = None):
+        self.index = index
+        self.camera = stub.HamamatsuCamera(camera_id = index, frame_source = frame_source)
+        self.allocated = False  # the buffers were allocated by dcambuf_alloc
+        self.seen_count = 0     # frame count at the last transferinfo
+        self.abort = False
+
+
+class DCAMSim(object):
+    """
+    Pure Python stand-in for the DCAM library.
+
+    Keyword arguments:
+    n_cameras     -- the number of cameras reported by dcamapi_init
+    latency_scale -- multiplies SIM_LATENCY, 0 makes the calls instant
+    frame_source  -- function returning the SimulatedFrameSource for each
+                     camera that is opened (the default if None)
+    """
+    def __init__(self, n_cameras = 1, latency_scale = 1.0, frame_source = None):
+        self.n_cameras = n_cameras
+        self.latency_scale = latency_scale
+        self.frame_source = frame_source
+        self.initialized = False
+        self.last_error = ""
+        self.devices = {}       # handle : SimDevice
+        self.waits = {}         # wait handle : SimDevice
+        self.handles = itertools.count(1)
+        self.prop_names = {p[0] : name for name, p in stub.SIM_PROPERTIES.items()}
+        self.prop_ids = sorted(self.prop_names)
+
+    def device(self, handle):
+        """
+        The SimDevice for a camera handle.
+        """
+        handle = argValue(handle)
+        if handle not in self.devices:
+            raise ValueError("invalid handle " + str(handle))
+        return self.devices[handle]
+
+    def property(self, prop_id):
+        """
+        The name and SIM_PROPERTIES entry of a property id.
+        """
+        prop_id = argValue(prop_id)
+        if prop_id not in self.prop_names:
+            raise ValueError("invalid property id " + hex(prop_id))
+        name = self.prop_names[prop_id]
+        return name, stub.SIM_PROPERTIES[name]
+
+    def fireTrigger(self, handle = 1):
+        """
+        Send an external trigger pulse to a camera.
+        """
+        self.device(handle).camera.fireTrigger()
+
+    def setTriggerPeriod(self, period, handle = 1):
+        """
+        Trigger a camera every period seconds when its trigger source
+        is external (0 to only trigger with fireTrigger()).
+        """
+        self.device(handle).camera.trigger_period = period
+
+    #
+    # Library and device.
+    #
+
+    @dcamFunction
+    def dcamapi_init(self, param_init):
+        argObject(param_init).iDeviceCount = self.n_cameras
+        self.initialized = True
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamapi_uninit(self):
+        for handle in list(self.devices):
+            self.devices[handle].camera.simStop()
+        self.devices, self.waits = {}, {}
+        self.initialized = False
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamdev_open(self, param_open):
+        param_open = argObject(param_open)
+        if not self.initialized:
+            raise RuntimeError("dcamapi_init has not been called")
+        if not (0 <= param_open.index < self.n_cameras):
+            raise ValueError("no camera " + str(param_open.index))
+        handle = next(self.handles)
+        source = self.frame_source() if self.frame_source else None
+        self.devices[handle] = SimDevice(param_open.index, source)
+        param_open.hdcam = handle
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamdev_close(self, handle):
+        self.device(handle).camera.simStop()
+        del self.devices[argValue(handle)]
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamdev_getstring(self, index, param_string):
+        param_string = argObject(param_string)
+        writeString(charBufferAddress(param_string, "text"), SIM_MODEL, param_string.textbytes)
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcam_getlasterror(self, handle, c_buf, buf_len):
+        writeString(ctypes.addressof(c_buf), self.last_error, argValue(buf_len))
+        return stub.DCAMERR_NOERROR
+
+    #
+    # Properties.
+    #
+
+    @dcamFunction
+    def dcamprop_getnextid(self, handle, prop_id, option):
+        # The top byte of the option is the (signed) number of properties to step.
+        prop_id = argObject(prop_id)
+        step = ctypes.c_int8((argValue(option) >> 24) & 0xFF).value
+        if step > 0:
+            following = [i for i in self.prop_ids if i > prop_id.value]
+        else:
+            following = [i for i in reversed(self.prop_ids) if i < prop_id.value]
+        step = max(abs(step), 1)
+        if len(following) < step:
+            return DCAMERR_INVALIDPARAM # no more properties
+        prop_id.value = following[step - 1]
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamprop_getname(self, handle, prop_id, c_buf, buf_len):
+        name, _ = self.property(prop_id)
+        writeString(ctypes.addressof(c_buf), name.upper().replace("_", " "), argValue(buf_len))
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamprop_getattr(self, handle, prop_attr):
+        prop_attr = argObject(prop_attr)
+        name, _ = self.property(prop_attr.iProp)
+        sim_attr = self.device(handle).camera.getPropertyAttribute(name)
+        for field, _ in stub.DCAMPROP_ATTR._fields_:
+            if field not in ("cbSize", "iProp"):
+                setattr(prop_attr, field, getattr(sim_attr, field))
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamprop_getvalue(self, handle, prop_id, c_value):
+        name, _ = self.property(prop_id)
+        argObject(c_value).value = self.device(handle).camera.sim_values[name]
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamprop_setgetvalue(self, handle, prop_id, c_value, option):
+        name, prop = self.property(prop_id)
+        c_value = argObject(c_value)
+        if not (prop[2] & stub.DCAMPROP_ATTR_WRITABLE):
+            return DCAMERR_NOTWRITABLE
+        camera = self.device(handle).camera
+        if camera.sim_status == stub.DCAMCAP_STATUS_BUSY:
+            raise RuntimeError(name + " can't be changed during capture")
+        c_value.value = camera.setPropertyValue(name, c_value.value)
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamprop_getvaluetext(self, handle, prop_text):
+        prop_text = argObject(prop_text)
+        name, prop = self.property(prop_text.iProp)
+        for text, value in prop[7].items():
+            if value == int(prop_text.value):
+                writeString(charBufferAddress(prop_text, "text"), text, prop_text.textbytes)
+                return stub.DCAMERR_NOERROR
+        raise ValueError(name + " has no text for " + str(prop_text.value))
+
+    @dcamFunction
+    def dcamprop_queryvalue(self, handle, prop_id, c_value, option):
+        name, prop = self.property(prop_id)
+        c_value = argObject(c_value)
+        p_min, p_max, step = prop[3], prop[4], prop[5]
+        if argValue(option) == stub.DCAMPROP_OPTION_NEXT:
+            if prop[7]:
+                values = [v for v in sorted(prop[7].values()) if v > c_value.value]
+            else:
+                values = [c_value.value + step] if c_value.value + step <= p_max else []
+            if not values:
+                return DCAMERR_INVALIDPARAM # no more values
+            c_value.value = values[0]
+        elif prop[7]: # nearest
+            c_value.value = min(prop[7].values(), key = lambda v: abs(v - c_value.value))
+        else:
+            c_value.value = min(max(p_min + round((c_value.value - p_min) / step) * step, p_min), p_max)
+        return stub.DCAMERR_NOERROR
+
+    #
+    # Buffers and capture.
+    #
+
+    @dcamFunction
+    def dcambuf_alloc(self, handle, n_buffers):
+        camera = self.device(handle).camera
+        n_pixels = camera.sim_values["buffer_framebytes"] // 2
+        camera.sim_buffers = [np.empty(n_pixels, dtype = np.uint16) for i in range(argValue(n_buffers))]
+        self.device(handle).allocated = True
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcambuf_attach(self, handle, param_attach):
+        param_attach = argObject(param_attach)
+        camera = self.device(handle).camera
+        n_pixels = camera.sim_values["buffer_framebytes"] // 2
+        camera.sim_buffers = [
+            np.ctypeslib.as_array((ctypes.c_uint16 * n_pixels).from_address(param_attach.buffer[i]))
+            for i in range(param_attach.buffercount)]
+        self.device(handle).allocated = False
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcambuf_release(self, handle, kind):
+        camera = self.device(handle).camera
+        if camera.sim_status == stub.DCAMCAP_STATUS_BUSY:
+            raise RuntimeError("the buffers can't be released during capture")
+        camera.sim_buffers = []
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcambuf_lockframe(self, handle, param_frame):
+        param_frame = argObject(param_frame)
+        device = self.device(handle)
+        camera = device.camera
+        with camera.sim_cond:
+            if not camera.sim_buffers:
+                raise RuntimeError("no buffers")
+            index = param_frame.iFrame
+            if index == -1: # the newest frame
+                index = camera.sim_newest
+            if not (0 <= index < len(camera.sim_buffers)) or (camera.sim_stamps[index] < 0):
+                raise ValueError("frame " + str(param_frame.iFrame) + " has not been captured")
+            param_frame.buf = camera.sim_buffers[index].ctypes.data
+            param_frame.framestamp = int(camera.sim_stamps[index])
+            t = camera.sim_times[index]
+            param_frame.timestamp.sec = int(t)
+            param_frame.timestamp.microsec = int((t - int(t)) * 1e6)
+        values = camera.sim_values
+        param_frame.rowbytes = values["buffer_rowbytes"]
+        param_frame.type = DCAM_PIXELTYPE_MONO16
+        param_frame.width = values["image_width"]
+        param_frame.height = values["image_height"]
+        param_frame.left = camera.frame_left
+        param_frame.top = camera.frame_top
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamcap_start(self, handle, mode):
+        device = self.device(handle)
+        camera = device.camera
+        if not camera.sim_buffers:
+            raise RuntimeError("no buffers have been allocated or attached")
+        binning = camera.sim_values["binning"]
+        camera.frame_source.configure(camera.frame_left, camera.frame_top,
+                                      camera.sim_values["image_width"] * binning,
+                                      camera.sim_values["image_height"] * binning, binning)
+        device.seen_count = 0
+        camera.simStart(argValue(mode) == stub.DCAMCAP_START_SNAP)
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamcap_stop(self, handle):
+        self.device(handle).camera.simStop()
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamcap_status(self, handle, status):
+        argObject(status).value = self.device(handle).camera.sim_status
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamcap_transferinfo(self, handle, param_transfer):
+        param_transfer = argObject(param_transfer)
+        device = self.device(handle)
+        with device.camera.sim_cond:
+            param_transfer.nNewestFrameIndex = device.camera.sim_newest
+            param_transfer.nFrameCount = device.camera.sim_count
+            device.seen_count = device.camera.sim_count
+        return stub.DCAMERR_NOERROR
+
+    #
+    # Wait handles.
+    #
+
+    @dcamFunction
+    def dcamwait_open(self, param_wait):
+        param_wait = argObject(param_wait)
+        device = self.device(param_wait.hdcam)
+        handle = next(self.handles)
+        self.waits[handle] = device
+        param_wait.hwait = handle
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamwait_close(self, wait_handle):
+        del self.waits[argValue(wait_handle)]
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamwait_start(self, wait_handle, param_start):
+        # A frame is ready if one was captured since the last transferinfo.
+        param_start = argObject(param_start)
+        device = self.waits[argValue(wait_handle)]
+        camera = device.camera
+        frame_ready = lambda: camera.sim_count != device.seen_count
+        stopped = lambda: camera.sim_status != stub.DCAMCAP_STATUS_BUSY
+        with camera.sim_cond:
+            device.abort = False
+            camera.sim_cond.wait_for(lambda: device.abort or
+                ((param_start.eventmask & stub.DCAMWAIT_CAPEVENT_FRAMEREADY) and frame_ready()) or
+                ((param_start.eventmask & stub.DCAMWAIT_CAPEVENT_STOPPED) and stopped()),
+                param_start.timeout / 1000.0)
+            if device.abort:
+                device.abort = False
+                return DCAMERR_ABORT
+            if frame_ready():
+                param_start.eventhappened = stub.DCAMWAIT_CAPEVENT_FRAMEREADY
+            elif stopped():
+                param_start.eventhappened = stub.DCAMWAIT_CAPEVENT_STOPPED
+            else:
+                return DCAMERR_TIMEOUT
+        return stub.DCAMERR_NOERROR
+
+    @dcamFunction
+    def dcamwait_abort(self, wait_handle):
+        device = self.waits[argValue(wait_handle)]
+        with device.camera.sim_cond:
+            device.abort = True
+            device.camera.sim_cond.notify_all()
+        return stub.DCAMERR_NOERROR
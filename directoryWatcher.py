@@ -2,8 +2,11 @@
 Stefan Spence 12/04/19
 
  - watch the image_read_path directory for new images
- - save the new image with label into a dated subdirectory under image_storage_path
- - delete the original file so that a new file with the same name can be created
+ - move the new image with label into a staging directory next to the
+   image_read_path, so that a new file with the same name can be created,
+   and emit its path for analysis straight away
+ - save the image into a dated subdirectory under image_storage_path in
+   background threads, so that slow storage doesn't hold up the analysis
  
 Assuming that image files are ASCII
 
@@ -15,100 +18,360 @@ import numpy as np
 import os
 import time
 import shutil
+import threading
+import queue
+import collections
+import re
 try:
     from PyQt4.QtCore import QThread, pyqtSignal, QEvent
 except ModuleNotFoundError:
     from PyQt5.QtCore import QThread, pyqtSignal, QEvent
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+import watchdog.events
+# close events were added in watchdog 2.1 (the pinned 0.8.3 doesn't have them)
+close_events = hasattr(watchdog.events, 'FileClosedEvent')
+from imageHandler import load_image, image_formats
+
+####    ####    ####    ####
+
+class archive_writer:
+    """Copy images from the staging directory into the image storage
+    directory with a pool of background threads.
+
+     - files are written without waiting for the disk, then synced to disk
+       together once fsync_batch files have been written or no new files
+       have arrived for 0.1 s
+     - fmt 'copy' keeps the original file, 'npy' saves the image as a binary
+       numpy array, and 'npz' as a compressed numpy archive
+     - staged files are deleted once they have been archived and released,
+       i.e. the analysis has finished with them (see release). Files that 
+       fail to be archived are left in the staging directory.
+    Keyword arguments:
+    n_threads   -- number of files to write at once
+    fmt         -- the format to archive images in: 'copy', 'npy', or 'npz'
+    fsync_batch -- the number of files to sync to disk together
+    """
+    def __init__(self, n_threads=2, fmt='copy', fsync_batch=16):
+        self.queue = queue.Queue()
+        self.fmt = fmt
+        self.fsync_batch = fsync_batch
+        self.lock = threading.Lock()
+        self.staged = {}    # staged file: [archived, released] until it's deleted
+        self.to_delete = collections.deque() # staged files to delete
+        self.copy_t = 0     # time taken to write the last file
+        self.n_archived = 0 # number of files archived and synced to disk
+        self.failed = 0     # number of files that couldn't be archived
+        self.running = True
+        self.threads = [threading.Thread(target=self.work, daemon=True)
+                        for i in range(n_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def add(self, src, dst):
+        """Queue the staged file src to be archived as dst (the extension
+        is changed for the npy and npz formats)"""
+        with self.lock:
+            self.staged[src] = [False, False]
+        self.queue.put((src, dst))
+
+    def mark(self, src, i):
+        """Set flag i (0: archived, 1: released) of the staged file src and
+        delete the file if it's both archived and released"""
+        with self.lock:
+            if src not in self.staged:
+                return # not staged by this archive, or it failed
+            self.staged[src][i] = True
+            if not all(self.staged[src]):
+                return
+            del self.staged[src]
+            self.to_delete.append(src)
+        self.clean()
+
+    def release(self, src):
+        """The analysis has finished with the staged file src, so it can be
+        deleted once it has been archived"""
+        self.mark(src, 1)
+
+    def destination(self, dst):
+        """Return the file name that dst is archived as, with the extension
+        changed for the npy and npz formats"""
+        if self.fmt in ('npy', 'npz'):
+            return os.path.splitext(dst)[0] + '.' + self.fmt
+        return dst
+
+    def write(self, src, dst):
+        """Write the staged file src to dst in the archive format. Returns
+        the open file, which still has to be synced to disk and closed.
+        Existing files are never overwritten (raises FileExistsError)."""
+        if self.fmt in ('npy', 'npz'):
+            im = load_image(src)
+        f = open(self.destination(dst), 'xb')
+        try:
+            if self.fmt == 'npy':
+                np.save(f, im)
+            elif self.fmt == 'npz':
+                np.savez_compressed(f, image=im)
+            else:
+                with open(src, 'rb') as f_src:
+                    shutil.copyfileobj(f_src, f, 1 << 20)
+            f.flush()
+        except:
+            f.close()
+            raise
+        return f
+
+    def sync(self, pending):
+        """Sync the written files in pending [(file, staged file)] to disk,
+        close them, and then empty the list. The staged files can be
+        deleted once they have been released."""
+        for f, src in pending:
+            try:
+                os.fsync(f.fileno())
+            except OSError as e:
+                print("WARNING: failed to sync " + f.name + " to disk: " + str(e))
+            f.close()
+        with self.lock:
+            self.n_archived += len(pending)
+        for f, src in pending:
+            self.mark(src, 0)
+        del pending[:]
+
+    def clean(self):
+        """Delete the staged files that have been archived and released. 
+        Files that are still open elsewhere (on Windows) are tried again 
+        the next time."""
+        with self.lock:
+            files, self.to_delete = list(self.to_delete), collections.deque()
+        for src in files:
+            try:
+                os.remove(src)
+            except PermissionError: # still open, try again later
+                with self.lock:
+                    self.to_delete.append(src)
+            except FileNotFoundError:
+                pass
+
+    def work(self):
+        """Archive the files in the queue until stopped"""
+        pending = [] # files that have been written but not synced to disk
+        while self.running or not self.queue.empty():
+            try:
+                src, dst = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if pending:
+                    self.sync(pending)
+                self.clean()
+                continue
+            t0 = time.time()
+            try:
+                pending.append((self.write(src, dst), src))
+            except (OSError, ValueError) as e:
+                with self.lock:
+                    self.staged.pop(src, None) # leave it in the staging dir
+                self.failed += 1
+                print("WARNING: failed to archive " + src + " to " + dst + ": " + str(e))
+                continue
+            self.copy_t = time.time() - t0
+            if len(pending) >= self.fsync_batch:
+                self.sync(pending)
+        if pending:
+            self.sync(pending)
+
+    def stop(self):
+        """Archive the files that are waiting, then delete the staged files
+        that have been released. The rest are deleted when they're released."""
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.clean()
 
 ####    ####    ####    ####
     
 # set up an event handler that is also a QObject through inheritance of QThread
 class system_event_handler(FileSystemEventHandler, QThread):
-    """The event handler responds to file creation events and emits the path
-    to the file as a signal"""
+    """The event handler responds to new files and emits the path to the
+    file as a signal once it has been written. The end of writing is found
+    from (fastest first):
+     - a file renamed into place in the directory (write to a .tmp or .part
+       file, then rename it), which is always complete
+     - completion = 'close': the close event when the writer closes the
+       file (inotify IN_CLOSE_WRITE on Linux, watchdog >= 2.1). A file 
+       renamed in from another directory only gives a created event, so a
+       created file that already has data is polled as below
+     - completion = 'marker': a sidecar file with marker_ext (e.g.
+       image.asc.done) that the writer creates after the image
+     - completion = 'poll': the file size not changing for a while
+    Files with the temporary extensions or the marker extension are not
+    processed themselves."""
     event_path = pyqtSignal(str)
+    marker_ext = '.done'              # sidecar file that marks an image as complete
+    temp_exts = ('.tmp', '.part')     # files being written before a rename
     
-    def __init__(self, image_storage_path, date):
+    def __init__(self, image_storage_path, date, staging_path='', archive=None,
+                 completion='poll'):
         super().__init__()
         
         self.last_event_path = ""   # last event processed 
         self.image_storage_path = image_storage_path  # directory where we copy images to
+        self.staging_path = staging_path # directory where images wait to be archived
+        self.archive = archive           # archive_writer that copies images to storage
+        self.completion = completion     # 'close', 'marker', or 'poll'
         self.date = date # today's date
         self.init_t = time.time()  # time of initiation: use to test how long it takes to realise an event is started
         self.event_t = 0           # time taken to process the last event
         self.end_t   = time.time() # time at end of event
         self.idle_t  = 0           # time between events
         self.write_t = 0           # time taken to watch a file being written
-        self.copy_t  = 0           # time taken to watch a file being copied 
+        self.copy_t  = 0           # time taken to move a file into staging
         self.nfn     = 0           # number to append to file so as not to overwrite
+        self.lock = threading.RLock() # held while processing a file, and by dir_watcher during a backfill
         
-    def wait_for_file(self, file_name, dt=0.01):
-        """Make sure that the file has finished being written by waiting until
-        the file size isn't changing anymore"""
-        last_file_size = -1
-        while last_file_size != os.path.getsize(file_name): 
-            last_file_size = os.path.getsize(file_name)
-            time.sleep(dt) # deliberately add pause so we don't loop too many times    
-    
+    def wait_for_file(self, file_name, dt=0.001, settle=0.01, max_dt=0.1):
+        """Polling fallback for when the writer doesn't signal the end of the
+        file: wait until the file size hasn't changed for settle seconds. The
+        polling interval starts at dt and doubles up to max_dt, so that a slow 
+        writer is polled less often."""
+        last_file_size = os.path.getsize(file_name)
+        stable = 0 # time that the size hasn't changed for
+        while stable < settle:
+            time.sleep(dt)
+            file_size = os.path.getsize(file_name)
+            if file_size == last_file_size:
+                stable += dt
+            else:
+                last_file_size, stable = file_size, 0
+            dt = min(2*dt, max_dt)
+
+    @staticmethod
+    def retry(func, *args, dt=0.001, timeout=1):
+        """Return func(*args), trying again after pauses that double from dt
+        while the other program still has the file open (PermissionError),
+        for up to timeout seconds."""
+        waited = 0
+        while True:
+            try:
+                return func(*args)
+            except PermissionError:
+                if waited >= timeout:
+                    raise
+                time.sleep(dt)
+                waited += dt
+                dt *= 2
+
+    def ignored(self, file_name):
+        """Whether file_name is a marker or a temporary file rather than an image"""
+        ext = os.path.splitext(file_name)[1].lower()
+        return ext == self.marker_ext or ext in self.temp_exts
+
     def on_created(self, event):
-        """On a new image being written, save the file with a synced label into the 
-        image storage dir"""
+        """A new file has been created. Process it with file_ready once it has
+        been written: straight away for a marker, after polling for 'poll'
+        completion, otherwise wait for the close or marker event. For 'close'
+        completion a file that isn't empty when it's created was renamed in
+        from another directory, which gives no close event, so it's polled."""
+        if event.is_directory:
+            return
         t0 = time.time()
-        self.idle_t = t0 - self.end_t # duration between end of last event and start of current event
-        self.wait_for_file(event.src_path) # wait until file has been written        
-        self.write_t = time.time() - t0
-        new_file_name = os.path.join(self.image_storage_path,
-                self.date+'.'+event.src_path.split(".")[-1])
-        self.copy_t = time.time()
-        if os.path.isfile(new_file_name): # don't overwrite files
-            new_file_name = os.path.join(self.image_storage_path, 
-                self.date+'_'+str(self.nfn)+'.'+event.src_path.split(".")[-1])
-            self.nfn += 1 # always a unique number
-        try:
-            shutil.copyfile(event.src_path, new_file_name)
-        except PermissionError:
-            print("WARNING: added a pause because python tried to access the file before the other program had let go")
-            time.sleep(0.2)
-            shutil.copyfile(event.src_path, new_file_name)
-        self.wait_for_file(new_file_name) # wait until the file has been copied
-        self.copy_t = time.time() - self.copy_t
-        try:
-            os.remove(event.src_path)  # delete the old file so that we can see a new created file event
-        except PermissionError:
-            print("WARNING: added a pause because python tried to access the file before the other program had let go")
-            time.sleep(0.2)
-            os.remove(event.src_path)
-        self.last_event_path = new_file_name  # update last event path
-        self.event_path.emit(new_file_name)  # emit signal
-        self.end_t = time.time()       # time at end of current event
-        self.event_t = self.end_t - t0 # duration of event
+        if self.completion == 'marker' and event.src_path.endswith(self.marker_ext):
+            self.file_ready(event.src_path[:-len(self.marker_ext)], t0)
+            try:
+                self.retry(os.remove, event.src_path)
+            except OSError: pass # the marker isn't needed any more
+        elif self.completion in ('poll', 'close') and not self.ignored(event.src_path):
+            try:
+                if self.completion == 'close' and os.path.getsize(event.src_path) == 0:
+                    return # still being written, wait for the close event
+                self.wait_for_file(event.src_path) # wait until file has been written
+            except FileNotFoundError:
+                return # renamed or removed while it was being written
+            self.file_ready(event.src_path, t0)
+
+    def on_closed(self, event):
+        """The writer has closed the file, so it is complete"""
+        if (self.completion == 'close' and not event.is_directory 
+                and not self.ignored(event.src_path)):
+            self.file_ready(event.src_path)
+
+    def on_moved(self, event):
+        """A file renamed into place within the directory is complete"""
+        if (not event.is_directory and not self.ignored(event.dest_path) and
+                os.path.dirname(event.dest_path) == os.path.dirname(event.src_path)):
+            self.file_ready(event.dest_path)
+
+    def exists(self, name):
+        """Whether an image called name is waiting in the staging dir or has
+        been archived in the image storage dir (with the archive's extension)"""
+        return (os.path.isfile(os.path.join(self.staging_path, name)) or 
+            os.path.isfile(self.archive.destination(os.path.join(self.image_storage_path, name))))
+
+    def file_ready(self, file_name, t0=None):
+        """The file has been written: move it with a synced label into the
+        staging dir and emit its path. The archive writer saves it into the
+        image storage dir in the background. t0 is the time the file was
+        created, if the handler waited for it to be written."""
+        with self.lock:
+            if not os.path.isfile(file_name):
+                return # already processed
+            t1 = time.time()
+            if t0 is None:
+                t0 = t1
+            self.idle_t = t0 - self.end_t # duration between end of last event and start of current event
+            self.write_t = t1 - t0
+            ext = file_name.split(".")[-1]
+            new_name = self.date+'.'+ext
+            while self.exists(new_name): # don't overwrite files
+                new_name = self.date+'_'+str(self.nfn)+'.'+ext
+                self.nfn += 1 # always a unique number
+            new_file_name = os.path.join(self.staging_path, new_name)
+            # moving the file lets a new file with the same name be created
+            self.retry(os.replace, file_name, new_file_name)
+            self.copy_t = time.time() - t1
+            self.archive.add(new_file_name, os.path.join(self.image_storage_path, new_name))
+            self.last_event_path = new_file_name  # update last event path
+            self.event_path.emit(new_file_name)  # emit signal
+            self.end_t = time.time()       # time at end of current event
+            self.event_t = self.end_t - t0 # duration of event
         
 ####    ####    ####    ####   
 
 # set up a separate event handler that reads in new files but doesn't copy or delete
 class silent_event_handler(system_event_handler):
-    """The event handler responds to file creation events and emits the path
-    to the file as a signal. This silent event handler does not copy or delete
-    files, merely emit the event path."""
+    """The event handler responds to new files and emits the path to the
+    file as a signal once it has been written. This silent event handler
+    does not copy or delete files, merely emit the event path. The most
+    recent max_seen files emitted are remembered so that they're only
+    emitted once."""
     event_path = pyqtSignal(str)
+    max_seen = 10000 # number of files to remember
     
-    def __init__(self, image_storage_path, date):
+    def __init__(self, image_storage_path, date, completion='poll'):
         # same init as the base system event handler
-        system_event_handler.__init__(self, image_storage_path, date)   
+        system_event_handler.__init__(self, image_storage_path, date, completion=completion)
+        self.seen = collections.OrderedDict() # (file name, modification time, size) of the files emitted
 
-    def on_created(self, event):
-        """On a new image being written, save the file with a synced label into the 
-        image storage dir"""
-        t0 = time.time()
-        self.idle_t = t0 - self.end_t # duration between end of last event and start of current event
-        self.wait_for_file(event.src_path) # wait until file has been written        
-        self.write_t = time.time() - t0
-        self.last_event_path = event.src_path  # update last event path
-        self.event_path.emit(event.src_path)  # emit signal
-        self.end_t = time.time()       # time at end of current event
-        self.event_t = self.end_t - t0 # duration of event
+    def file_ready(self, file_name, t0=None):
+        """The file has been written: emit its path, unless the same version
+        of the file has already been emitted (e.g. by a backfill)"""
+        t1 = time.time()
+        if t0 is None:
+            t0 = t1
+        try:
+            key = (file_name, os.path.getmtime(file_name), os.path.getsize(file_name))
+        except OSError:
+            return # removed before it could be processed
+        with self.lock:
+            if key in self.seen:
+                return
+            self.seen[key] = None
+            if len(self.seen) > self.max_seen:
+                self.seen.popitem(last=False) # forget the oldest
+            self.idle_t = t0 - self.end_t # duration between end of last event and start of current event
+            self.write_t = t1 - t0
+            self.last_event_path = file_name  # update last event path
+            self.event_path.emit(file_name)  # emit signal
+            self.end_t = time.time()       # time at end of current event
+            self.event_t = self.end_t - t0 # duration of event
 
 ####    ####    ####    ####   
         
@@ -121,6 +384,9 @@ class dir_watcher(QThread):
     Initiate an observer that watches for file creation events and
     processes them with the chosen event_handler, which can be 
     actively moving files, or passively reading in the event path.
+    The observer starts with the thread (start()), after the slots have
+    been connected to the event handler, and the image files already in
+    the read path are processed first (except those in skip).
     Keyword arguments:
     config_file -- the file to load relevant directories from.
         The format is important for reading in the directories.
@@ -130,8 +396,18 @@ class dir_watcher(QThread):
     image_read_path       -- directory that new image creation
         events will occur in.
     results_path          -- directory for results to be stored in
+    active                -- whether to move new files into storage (True)
+        or just emit their paths (False)
+    archive_format        -- the format that active mode saves images in:
+        'copy', 'npy', or 'npz' (see archive_writer)
+    completion            -- how to tell that a new file has been written 
+        (see system_event_handler): 'close', 'marker', 'poll', or 'auto' 
+        to use close events if the observer has them (inotify with 
+        watchdog >= 2.1), else poll. 'close' falls back to 'poll' when 
+        watchdog has no close events, since no file would be processed.
     """
-    def __init__(self, config_file='./config/config.dat', active=True):
+    def __init__(self, config_file='./config/config.dat', active=True, archive_format='copy',
+                 completion='auto'):
         super().__init__()
         # load paths used from config.dat
         self.dirs_dict = self.get_dirs(config_file)  # handy dict contains them all
@@ -139,23 +415,35 @@ class dir_watcher(QThread):
         self.log_file_path = self.dirs_dict['Log File Path: ']
         self.image_read_path = self.dirs_dict['Image Read Path: ']
         self.results_path = self.dirs_dict['Results Path: ']
+        self.observer = None # stays None if the config file wasn't found
+        self.archive = None
         if self.image_storage_path: # =0 if get_dirs couldn't find config.dat, else continue
             # create the watchdog object
             self.observer = Observer()
+            if completion == 'auto': # only inotify reports when a file is closed
+                completion = 'close' if type(self.observer).__name__ == 'InotifyObserver' else 'poll'
+            if completion == 'close' and not close_events:
+                completion = 'poll'
             # get the date to be used for file labeling
             self.date = time.strftime("%d %b %B %Y", time.localtime()).split(" ") # day short_month long_month year
             self.image_storage_path += r'\%s\%s\%s'%(self.date[3],self.date[2],self.date[0])
-            if active: # active event handler copies then deletes new files
+            if active: # active event handler moves new files into staging then archives them
+                self.staging_path = os.path.join(self.image_read_path, 'staging')
+                os.makedirs(self.staging_path, exist_ok=True) # before the observer starts
+                self.archive = archive_writer(fmt=archive_format)
                 self.event_handler = system_event_handler(self.image_storage_path, 
-                                                          self.date[0]+self.date[1]+self.date[3])
+                                                          self.date[0]+self.date[1]+self.date[3],
+                                                          self.staging_path, self.archive,
+                                                          completion)
             else: # passive event handler just emits the event path
                 self.event_handler = silent_event_handler(self.image_storage_path, 
-                                                          self.date[0]+self.date[1]+self.date[3])
+                                                          self.date[0]+self.date[1]+self.date[3],
+                                                          completion)
             # create image storage directory by date if it doesn't already exist
             os.makedirs(self.image_storage_path, exist_ok=True) # requies version > 3.2
             # initiate observer, don't recursively search directories within the image_read_path
             self.observer.schedule(self.event_handler, self.image_read_path, recursive=False)
-            self.observer.start()
+        self.skip = set() # names of the files already in the read path not to process
     
     @staticmethod # static method can be accessed without making an instance of the class
     def get_dirs(config_file='./config/config.dat'):
@@ -191,8 +479,51 @@ class dir_watcher(QThread):
             outstr += key + '\n' + value + '\n'
         return outstr
     
+    @staticmethod
+    def natural_key(file_name):
+        """Sort key that orders the numbers in file names by value, so that
+        img2 comes before img10"""
+        return [int(x) if x.isdigit() else x.lower() for x in re.split(r'(\d+)', file_name)]
+
+    def existing_files(self):
+        """Return the names of the image files already in the image read path
+        in natural sort order"""
+        return sorted([f for f in os.listdir(self.image_read_path)
+                if os.path.splitext(f)[1].lower() in image_formats
+                and os.path.isfile(os.path.join(self.image_read_path, f))],
+            key=self.natural_key)
+
     def run(self):
-        pass
+        """Start watching for new files, then backfill: pass the image files
+        already in the image read path (except those in skip) to the event
+        handler in natural sort order, as if they had just been written.
+        Live events wait until the backfill has finished, and files that
+        are in both are only processed once (active mode moves them, 
+        passive mode remembers them)."""
+        if self.observer is None:
+            return
+        with self.event_handler.lock:
+            self.observer.start()
+            for file_name in self.existing_files():
+                if file_name not in self.skip:
+                    self.event_handler.file_ready(os.path.join(self.image_read_path, file_name))
+
+    def stop(self):
+        """Stop watching for new files, then finish archiving the files
+        that are waiting."""
+        self.wait() # for the backfill to finish
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        if self.archive:
+            self.archive.stop()
+
+    def release(self, file_name):
+        """The emitted file file_name has been processed (or isn't needed), 
+        so in active mode it can be deleted from the staging dir once it 
+        has been archived. Every emitted path should be released."""
+        if self.archive:
+            self.archive.release(file_name)
         
     def save_config(self, config_file='./config/config.dat'):
         """Write the directories currently in use into a new config file."""
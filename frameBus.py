@@ -0,0 +1,129 @@
+"""ORCAFlashCapture
+Max Snelling
+
+Pass frames from the camera to the analysis and archival stages in the
+same process, instead of writing them into the image read path for the
+directory watcher to pick up, copy, and delete.
+
+ - the capture side publishes each image array with a file name label
+ - the image goes straight into the analysis worker's queue, unless it
+   is full, in which case the image is only archived
+ - the image is also put in a bounded archive queue, and a writer thread
+   saves it into the image storage directory with the same naming as the
+   directory watcher's event handler, never overwriting an existing file
+
+The directory watcher is still used for images from external programs.
+"""
+import numpy as np
+import os
+import re
+import time
+import queue
+try:
+    from PyQt4.QtCore import QThread, pyqtSignal
+except ModuleNotFoundError:
+    from PyQt5.QtCore import QThread, pyqtSignal
+
+####    ####    ####    ####
+
+class frame_bus(QThread):
+    """Publish images to the analysis worker and archive them to file.
+
+    The thread runs the archival stage, so that writing files never holds
+    up the analysis. publish() blocks when the archive queue is full, which
+    leaves frames waiting in the camera buffers rather than using more
+    memory. If the analysis queue is full the image is not analysed, so 
+    that the analysis doesn't hold up the camera, and is counted in skipped.
+    Keyword arguments:
+    analysis           -- the analysis_worker that processes the images
+    image_storage_path -- directory to save the images in. If empty the
+                        images are only analysed.
+    date               -- date string that the file names start with
+    maxsize            -- the maximum number of images waiting to be saved
+    """
+    archived = pyqtSignal(str) # path of each image once it has been saved
+
+    def __init__(self, analysis, image_storage_path='', date='', maxsize=100):
+        super().__init__()
+        self.analysis = analysis
+        self.image_storage_path = image_storage_path
+        self.date = date
+        self.queue = queue.Queue(maxsize)
+        self.mode = 'thresh'  # passed to analysis_worker.add: 'thresh', 'fixed' or None
+        self.analyse = True   # False to only archive the images
+        self.nfn = 0          # number appended to the file name so as not to overwrite
+        self.running = False
+        self.write_t = 0      # time taken to save the last image
+        self.skipped = 0      # images that weren't analysed because the analysis queue was full
+
+    def set_storage(self, image_storage_path, date):
+        """Save the following images in image_storage_path, with file names
+        starting with date. The file numbers continue from the highest
+        number already in the directory, e.g. from an earlier session."""
+        self.image_storage_path = image_storage_path
+        self.date = date
+        if image_storage_path and os.path.isdir(image_storage_path):
+            pattern = re.compile(re.escape(date) + r'_(\d+)\.\w+$')
+            nums = [int(m.group(1)) for m in map(pattern.match, os.listdir(image_storage_path)) if m]
+            self.nfn = max(nums + [self.nfn - 1]) + 1
+
+    def publish(self, image, label=None):
+        """Pass an image array indexed [x, y] to the analysis and archival
+        stages. The image must not be changed afterwards, so copy camera
+        buffers before publishing them. label is the file number used to
+        name the image, the next number is used if it is None.
+        Returns the label."""
+        if label is None:
+            label = str(self.nfn)
+            self.nfn += 1
+        if self.analyse:
+            try:
+                self.analysis.add(image, label, self.mode, block=False)
+            except queue.Full:
+                self.skipped += 1
+        if self.image_storage_path:
+            self.queue.put((image, label))
+        return label
+
+    def start(self):
+        """Start saving images. running is set here rather than in run so
+        that stop() straight after start() still stops the thread."""
+        self.running = True
+        super().start()
+
+    def stop(self):
+        """Stop the thread once the images waiting have been saved"""
+        self.running = False
+        self.wait()
+
+    def save(self, image, label):
+        """Save the image as date_label.npy in the image storage directory.
+        If a file with that name already exists (e.g. saved by the directory
+        watcher) the name is followed by the next free number instead.
+        Returns the file name."""
+        base = os.path.join(self.image_storage_path, self.date+'_'+label)
+        file_name, n = base + '.npy', 0
+        while True:
+            try:
+                with open(file_name, 'xb') as f:
+                    np.save(f, image)
+                return file_name
+            except FileExistsError:
+                file_name = base + '_' + str(n) + '.npy'
+                n += 1
+
+    def run(self):
+        """Save the images in the archive queue until stopped"""
+        while self.running or not self.queue.empty():
+            try:
+                image, label = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            t0 = time.time()
+            try:
+                file_name = self.save(image, label)
+            except OSError as e:
+                print("\n WARNING: failed to save image "+label+": "+str(e))
+                continue
+            self.write_t = time.time() - t0
+            self.archived.emit(file_name)
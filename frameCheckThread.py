@@ -2,39 +2,41 @@
 import threading
 import time
 
-class FrameCheckThreadLive(threading.Thread):
-    """Frame check thread for live feed"""
+class FrameDeliveryThread(threading.Thread):
+    """Frame delivery thread for live and triggered feeds.
 
-    def __init__(self, app):
-        threading.Thread.__init__(self)
-        self.app = app
-        self.running = True
+    Waits on the camera for new frames (newFrames blocks on the DCAM wait
+    handle) and passes them on as soon as they are ready, so the latency 
+    is set by the camera rather than a sleep. The camera keeps acquiring
+    (run_till_abort) so there is no dead time between frames.
+    If every_frame is True all of the new frames are passed to 
+    app.update_images (e.g. for triggered shots, which must not be 
+    dropped), otherwise only the newest is passed to app.update_image."""
 
-    def run(self):
-        while self.running:
-            self.app.update_image()
-            time.sleep(.500)
-        
-    def stop(self):
-        self.running = False
-            
-class FrameCheckThreadTrigger(threading.Thread):
-    """Frame check thread for trigger feed"""
-
-    def __init__(self, app):
+    def __init__(self, app, every_frame=False):
         threading.Thread.__init__(self)
         self.app = app
+        self.every_frame = every_frame
         self.running = True
+        self.idle = threading.Event() # used to sleep when the camera isn't acquiring
 
     def run(self):
         while self.running:
-            success = self.app.update_image()
-            if success:
-                self.app.hcam.stopAcquisition()
-                self.app.hcam.startAcquisition()
-            time.sleep(.100)
-            
+            frames, dims = self.app.hcam.getFrames() # blocks until a frame is ready or timeout
+            if not self.running:
+                break
+            if len(frames) >= 1 and self.every_frame:
+                self.app.update_images(frames, dims)
+            elif len(frames) >= 1:
+                self.app.update_image([frames[-1], dims]) # newest frame only
+            else: # the camera isn't acquiring, so getFrames doesn't wait
+                self.idle.wait(0.01)
+
     def stop(self):
         self.running = False
+        self.idle.set()
+        if self.is_alive():
+            self.app.hcam.abortWait() # stop waiting for the next frame
+            if threading.current_thread() is not self:
+                self.join()
         self.app.hcam.stopAcquisition()
-        
\ No newline at end of file
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""ORCAFlashCapture
+Max Snelling
+
+Stream frames from the camera to disk for long kinetic series.
+
+ - a drain thread waits on the camera and copies each new frame out of the
+   camera ring into one of a fixed number of slots, so that the ring is
+   emptied as fast as the camera fills it
+ - a writer thread copies the filled slots into a memory-mapped raw file
+   that was preallocated for max_frames frames, and hands the slots back
+ - if the writer falls behind and there are no free slots, frames wait in
+   the camera ring, then are dropped (and counted) rather than using more
+   memory
+
+The recording is saved as a raw uint16 file of shape (frames, height, width)
+with a .shape sidecar, which imageHandler.load_image can memory-map, and a
+.index.csv file with the frame number, camera framestamp and timestamp of
+each recorded frame.
+"""
+import numpy as np
+import threading
+import ctypes
+import time
+import queue
+
+class FrameRecorder:
+    """Record frames from the camera to file_name until stop() is called
+    or max_frames have been recorded.
+
+    Keyword arguments:
+    hcam       -- the camera (camera_try.HamamatsuCamera or HamamatsuCameraMR)
+    file_name  -- path of the raw file to write
+    max_frames -- the most frames that will be recorded, the file is
+                preallocated for this many frames
+    slots      -- number of frames that can wait to be written, this bounds
+                the memory used
+    slot_timeout -- seconds to wait for a free slot before dropping a frame
+    """
+    def __init__(self, hcam, file_name, max_frames, slots=64, slot_timeout=0.1):
+        self.hcam = hcam
+        self.file_name = file_name
+        self.max_frames = int(max_frames)
+        self.n_slots = slots
+        self.slot_timeout = slot_timeout
+        self.running = False
+        self.n_taken = 0     # frames taken from the camera (written or waiting)
+        self.n_written = 0   # frames written to the file
+        self.dropped = 0     # frames dropped because there was no free slot
+        self.lost = 0        # frames the camera overwrote before they were taken
+        self.last_stamp = None
+        self.drain_thread = None
+        self.write_thread = None
+
+    def start(self):
+        """Start acquisition and the drain and writer threads."""
+        self.hcam.setACQMode("run_till_abort")
+        self.hcam.startAcquisition() # sets frame_x, frame_y, frame_bytes
+        shape = (self.hcam.frame_y, self.hcam.frame_x)
+        self.frame_bytes = self.hcam.frame_bytes
+        self.data = np.memmap(self.file_name, dtype=np.uint16, mode='w+',
+                              shape=(self.max_frames,) + shape)
+        self.index = np.zeros(self.max_frames, dtype=[('frame', int),
+                                ('framestamp', int), ('timestamp', float)])
+        self.slots = np.empty((self.n_slots,) + shape, dtype=np.uint16)
+        self.free = queue.Queue()   # indexes of the slots that can be filled
+        for i in range(self.n_slots):
+            self.free.put(i)
+        self.filled = queue.Queue() # (slot, framestamp, timestamp) waiting to be written
+        self.running = True
+        self.drain_thread = threading.Thread(target=self.drain, daemon=True)
+        self.write_thread = threading.Thread(target=self.write, daemon=True)
+        self.write_thread.start()
+        self.drain_thread.start()
+
+    def drain(self):
+        """Copy new frames out of the camera ring into free slots."""
+        while self.running and self.n_taken < self.max_frames:
+            new_frames = self.hcam.newFrames() # blocks until a frame is ready or timeout
+            for n in new_frames:
+                if self.n_taken >= self.max_frames:
+                    break
+                address, framestamp, timestamp = self.hcam.getFrameInfo(n)
+                if self.last_stamp is not None:
+                    if framestamp <= self.last_stamp:
+                        continue # already taken, the ring was overrun
+                    self.lost += framestamp - self.last_stamp - 1 # overwritten in the ring
+                self.last_stamp = framestamp
+                try: # the frame stays in the camera ring while waiting for a slot
+                    slot = self.free.get(timeout=self.slot_timeout)
+                except queue.Empty: # the writer is too far behind
+                    self.dropped += 1
+                    continue
+                t0 = time.perf_counter()
+                ctypes.memmove(self.slots[slot].ctypes.data, address, self.frame_bytes)
+                self.hcam.stats.add_copy(time.perf_counter() - t0)
+                self.hcam.stats.add_frames([framestamp], [timestamp])
+                self.filled.put((slot, framestamp, timestamp))
+                self.n_taken += 1
+            if not new_frames and not self.running:
+                break
+        self.running = False
+
+    def write(self):
+        """Write the filled slots into the file in order."""
+        while self.running or not self.filled.empty():
+            try:
+                slot, framestamp, timestamp = self.filled.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            i = self.n_written
+            self.data[i] = self.slots[slot]
+            self.index[i] = (i, framestamp, timestamp)
+            self.n_written += 1
+            self.free.put(slot)
+
+    def stop(self):
+        """Stop acquisition, write the frames that are waiting, then trim the
+        file to the frames recorded and save the .shape and index files.
+        Returns the number of frames written."""
+        self.running = False
+        if self.drain_thread is not None and self.drain_thread.is_alive():
+            self.hcam.abortWait() # stop waiting for the next frame
+            self.drain_thread.join()
+        self.hcam.stopAcquisition()
+        if self.write_thread is not None:
+            self.write_thread.join()
+        shape = np.shape(self.data)[1:]
+        self.data.flush()
+        del self.data # close the memory map before trimming the file
+        with open(self.file_name, 'r+b') as f:
+            f.truncate(self.n_written * self.frame_bytes)
+        with open(self.file_name + '.shape', 'w') as f:
+            f.write(' '.join(map(str, (self.n_written,) + shape)))
+        np.savetxt(self.file_name + '.index.csv', self.index[:self.n_written],
+            fmt=['%d', '%d', '%.6f'], delimiter=',', header='frame, framestamp, timestamp')
+        print("recorded", self.n_written, "frames, dropped", self.dropped,
+            "(writer behind), lost", self.lost, "(camera buffer overrun)")
+        return self.n_written
+
+    def is_alive(self):
+        """Whether frames are still being recorded (False once max_frames
+        have been written)."""
+        return self.running or (self.write_thread is not None and self.write_thread.is_alive())
@@ -7,7 +7,8 @@ director watcher and Qt GUI. This allows it to be imported for other purposes.
 Assume that there are two peaks in the histogram which are separated by a 
 region of zeros.
 
-Assuming that image files are ASCII.
+Image files can be .npy, raw uint16 with a .shape sidecar file, TIFF, or
+ASCII (the legacy format, where the first column is the row number).
 """
 import os
 import sys
@@ -34,6 +35,144 @@ def est_param(h):
 
     return peak_inds, properties['prominences'], properties['widths']
 
+# image file formats identified by their extension
+image_formats = {'.npy':'npy', '.npz':'npz', '.raw':'raw', '.bin':'raw', '.tif':'tiff', 
+                '.tiff':'tiff', '.asc':'ascii', '.txt':'ascii', '.csv':'ascii'}
+
+def detect_format(im_name):
+    """Return the format of the image file im_name: 'npy', 'npz', 'raw', 'tiff',
+    or 'ascii'. Look at the file extension first, then the magic bytes at the 
+    start of the file."""
+    ext = os.path.splitext(im_name)[1].lower()
+    if ext in image_formats:
+        return image_formats[ext]
+    with open(im_name, 'rb') as f:
+        magic = f.read(6)
+    if magic == b'\x93NUMPY':
+        return 'npy'
+    elif magic[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    elif os.path.isfile(im_name + '.shape'):
+        return 'raw'
+    return 'ascii'
+
+def load_image(im_name, fmt=None, mmap_mode=None):
+    """Return an array with the values of the image in the file im_name.
+    Keyword arguments:
+    im_name   -- the absolute path to the image file
+    fmt       -- the format of the file (see detect_format), detected if None
+    mmap_mode -- memory-map .npy and raw files instead of reading them, 
+                e.g. 'r' (see numpy.load)
+    """
+    if fmt is None:
+        fmt = detect_format(im_name)
+    if fmt == 'npy':
+        return np.load(im_name, mmap_mode=mmap_mode)
+    elif fmt == 'npz': # compressed archive from directoryWatcher.archive_writer
+        with np.load(im_name) as archive:
+            return archive['image']
+    elif fmt == 'raw': # the sidecar file contains the shape, e.g. '512 512'
+        with open(im_name + '.shape', 'r') as f:
+            shape = tuple(map(int, f.read().replace(',', ' ').split()))
+        if mmap_mode:
+            return np.memmap(im_name, dtype=np.uint16, mode=mmap_mode, shape=shape)
+        return np.fromfile(im_name, dtype=np.uint16).reshape(shape)
+    elif fmt == 'tiff':
+        return np.asarray(Image.open(im_name))
+    else: # legacy ASCII
+        return np.loadtxt(im_name)
+
+def frame_stats(full_im, chunk=256):
+    """Return the sum and sum of squares of the pixel counts in an image and
+    the (x, y) position of the max pixel. The image is read chunk rows at a 
+    time so that a memory-mapped file is never loaded or copied in full."""
+    total, total2 = 0., 0.
+    im_max, pos = None, (0, 0)
+    for r in range(0, np.shape(full_im)[0], chunk):
+        block = np.asarray(full_im[r:r+chunk], dtype=float)
+        total += np.sum(block)
+        total2 += np.einsum('ij,ij->', block, block)
+        i = np.argmax(block)
+        if im_max is None or block.flat[i] > im_max: # keep the first max, like np.argmax
+            im_max = block.flat[i]
+            x, y = np.unravel_index(i, block.shape)
+            pos = (x + r, y)
+    return total, total2, pos
+
+def integral_image(ims):
+    """Return the summed-area table of an image indexed [x, y], or of a 
+    stack of images [image, x, y], with a leading row and column of zeros
+    so that sat[..., x, y] is the sum of ims[..., :x, :y]. The sum over any
+    rectangle is then four lookups with rect_sum."""
+    ims = np.asarray(ims, dtype=float)
+    sat = np.zeros(ims.shape[:-2] + (ims.shape[-2]+1, ims.shape[-1]+1))
+    np.cumsum(np.cumsum(ims, axis=-2), axis=-1, out=sat[..., 1:, 1:])
+    return sat
+
+def pixel_dtype(ims, dtype=None):
+    """Return the smallest of uint16, int32, and float64 (or the integer 
+    dtype of ims) that holds the pixel values of ims exactly, e.g. so that 
+    images loaded from ASCII files as floats can be stored as integers.
+    If dtype is given, return it if it already holds the values of ims."""
+    ims = np.asarray(ims)
+    if dtype is not None and np.can_cast(ims.dtype, dtype):
+        return np.dtype(dtype)
+    if ims.dtype.kind in 'ui' and dtype is None:
+        return ims.dtype
+    if ims.dtype.kind in 'uif' and np.all(np.isfinite(ims)) and np.all(ims == np.round(ims)):
+        lo, hi = (np.min(ims), np.max(ims)) if np.size(ims) else (0, 0)
+        for t in ((dtype,) if dtype is not None else (np.uint16, np.int32)):
+            if np.dtype(t).kind in 'ui' and np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+                return np.dtype(t)
+    return np.dtype(float)
+
+def rect_sum(sat, xmin, ymin, xmax, ymax):
+    """Return the sum over [xmin:xmax, ymin:ymax] of each image in the 
+    summed-area table sat made by integral_image."""
+    return sat[..., xmax, ymax] - sat[..., xmin, ymax] - sat[..., xmax, ymin] + sat[..., xmin, ymin]
+
+####    ####    ####    ####
+
+class column_store:
+    """Store columns of results in one structured array.
+    
+    The array has space for more rows than are filled. When it is full the 
+    capacity is doubled, so adding a row costs O(1) on average and the 
+    data is only copied log(N) times over a run of N images. Each column is
+    accessed by name as a view (not a copy) of the whole array, including 
+    the empty space at the end.
+    Keyword arguments:
+    dtype -- a list of (column name, type) for a numpy structured array
+    n     -- the initial number of rows to make space for
+    """
+    def __init__(self, dtype, n=10000):
+        self.dtype = np.dtype(dtype)
+        self.n = n                            # initial capacity
+        self.data = np.zeros(n, dtype=self.dtype)
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __len__(self):
+        return np.size(self.data)
+
+    def reserve(self, size, filled=None):
+        """Make sure that there is space for size rows in total, doubling the 
+        capacity until there is. Only the first filled rows are copied."""
+        capacity = np.size(self.data)
+        if size > capacity:
+            while capacity < size:
+                capacity *= 2
+            if filled is None:
+                filled = np.size(self.data)
+            data = np.zeros(capacity, dtype=self.dtype)
+            data[:filled] = self.data[:filled]
+            self.data = data
+
+    def reset(self):
+        """Delete all of the data and return to the initial capacity"""
+        self.data = np.zeros(self.n, dtype=self.dtype)
+
 ####    ####    ####    ####
         
 # convert an image into its pixel counts to put into a histogram
@@ -41,22 +180,28 @@ class image_handler:
     """Analyse individual image files and create a histogram.
     
     Load an ROI image centred on the atom, integrate the counts,
-    then compare to the threshold. For speed, make an array of 
-    counts with length n. If the number of images analysed exceeds 
-    (n-10) of this length then append another n elements to the array."""
+    then compare to the threshold. For speed, the results are stored 
+    in a column_store with space for n images which doubles in size 
+    whenever it is filled. The columns (counts, atom, files, etc.) are 
+    views of the store, so slicing [:im_num] doesn't copy.
+    The pixels around the ROI (within cache_margin) and the sums over each
+    image are also kept in a column_store, so that when the ROI is moved or
+    resized inside the cached region the counts of all of the images so
+    far can be recalculated without loading the files again."""
     def __init__(self, atom_index=0, atom_symbol='Cs '):
         self.i = atom_index             # indicates the index of this handler in the list
         self.X = atom_symbol            # the name of the atom that this handler deals with
         self.delim = ' '                # delimieter to use when opening files
-        self.n = 10000                  # length of array for storing counts
-        self.counts = np.zeros(self.n)  # integrated counts over the ROI
-        self.mid_count = np.zeros(self.n)# count at the centre of the ROI
-        self.mean_count = np.zeros(self.n) # list of mean counts in image - estimates background 
-        self.std_count  = np.zeros(self.n) # list of standard deviation of counts in image
-        self.xc_list = np.zeros(self.n) # horizontal positions of max pixel
-        self.yc_list = np.zeros(self.n) # vertical positions of max pixel
-        self.atom = np.zeros(self.n)    # deduce presence of an atom by comparison with threshold
-        self.files = np.array([None]*(self.n)) # labels of files. 
+        self.n = 10000                  # initial length of arrays for storing counts
+        self.results = column_store([
+            ('files', object),          # labels of files. 
+            ('counts', float),          # integrated counts over the ROI
+            ('mid_count', float),       # count at the centre of the ROI
+            ('mean_count', float),      # list of mean counts in image - estimates background 
+            ('std_count', float),       # list of standard deviation of counts in image
+            ('xc_list', float),         # horizontal positions of max pixel
+            ('yc_list', float),         # vertical positions of max pixel
+            ('atom', float)], self.n)   # deduce presence of an atom by comparison with threshold
         self.peak_indexes = [0,0]       # indexes of peaks in histogram
         self.peak_heights = [0,0]       # heights of peaks in histogram
         self.peak_widths  = [0,0]       # widths of peaks in histogram
@@ -71,91 +216,308 @@ class image_handler:
         self.im_num = 0                 # number of images processed
         self.im_vals = np.array([])     # the data from the last image is accessible to an image_handler instance
         self.bin_array = []             # if bins for the histogram are supplied, plotting can be faster
+        self.formats = {}               # image file format for each (directory, extension)
+        self.mmap_mode = 'r'            # memory-map .npy/raw files when processing so only the ROI is copied
+        self.batch_bytes = 1 << 26      # most memory for the float copy of a chunk of images in process_batch
+        self.hist_bins = np.array([])   # bin edges of the histogram of counts[:hist_n]
+        self.hist_occ = np.array([])    # occupancy of the histogram bins
+        self.hist_n = 0                 # number of counts in the histogram
+        self.hist_range = (0, 0)        # min and max of the counts in the histogram
+        self.hist_fixed = False         # whether the histogram used the bin_array
+        self.atom_n = 0                 # atom[:atom_n] has been set from the counts
+        self.atom_thresh = None         # the threshold that atom[:atom_n] was set with
+        self.cache_margin = 10          # pixels cached on each side of the ROI, 0 to turn off the cache
+        self.cache_rows = 64            # initial number of images the cache has space for
+        self.cache = None               # column_store of the cached pixels and image sums
+        self.cache_box = (0, 0, 0, 0)   # xmin, ymin, xmax, ymax of the cached pixels
+        self.cache_shape = None         # shape of the images in the cache
+        self.cache_n = 0                # number of images in the cache
         
     def set_pic_size(self, im_name):
         """Set the pic size by looking at the number of columns in a file"""
-        im_vals = np.genfromtxt(im_name, delimiter=self.delim)
-        self.pic_size = int(np.size(im_vals[0]) - 1) # the first column of ASCII image is row number
+        im_vals = self.load_full_im(im_name)
+        if self.image_format(im_name) == 'ascii':
+            self.pic_size = int(np.size(im_vals[0]) - 1) # the first column of ASCII image is row number
+        else:
+            self.pic_size = int(np.size(im_vals[0]))
         return self.pic_size
 
+    def image_format(self, im_name):
+        """Return the format of the image file, only detecting it for the
+        first file from each directory with a given extension"""
+        key = os.path.split(im_name)[0], os.path.splitext(im_name)[1].lower()
+        try:
+            return self.formats[key]
+        except KeyError:
+            self.formats[key] = detect_format(im_name)
+            return self.formats[key]
+
+    # columns of the results store
+    files      = property(lambda self: self.results['files'])
+    counts     = property(lambda self: self.results['counts'])
+    mid_count  = property(lambda self: self.results['mid_count'])
+    mean_count = property(lambda self: self.results['mean_count'])
+    std_count  = property(lambda self: self.results['std_count'])
+    xc_list    = property(lambda self: self.results['xc_list'])
+    yc_list    = property(lambda self: self.results['yc_list'])
+    atom       = property(lambda self: self.results['atom'])
+
     def reset_arrays(self):
         """Reset all of the histogram array data to zero"""
-        self.files = np.array([None]*(self.n)) # labels of files. 
-        self.counts = np.zeros(self.n)  # integrated counts over ROI
-        self.mid_count = np.zeros(self.n)  # count at the centre of the ROI
-        self.mean_count = np.zeros(self.n) # list of mean counts in image - estimates background 
-        self.std_count = np.zeros(self.n)  # list of standard deviation of counts in image
-        self.xc_list = np.zeros(self.n) # horizontal positions of max pixel
-        self.yc_list = np.zeros(self.n) # vertical positions of max pixel
-        self.atom = np.zeros(self.n)    # deduce presence of an atom by comparison with threshold
+        self.results.reset()
         self.im_num = 0                 # number of images processed
+        self.hist_n = 0                 # rebin the histogram
+        self.atom_n = 0                 # reset atom presence
+        self.cache = None               # start a new cache around the ROI
+
+    def discard(self, n):
+        """Remove the last n images that were processed, e.g. if the camera
+        overwrote an image while it was being counted. The cache is rolled 
+        back with the counts so that it can still be used to recount."""
+        self.im_num -= min(n, self.im_num)
+        self.cache_n = min(self.cache_n, self.im_num)
         
         
-    def load_full_im(self, im_name):
-        """return an array with the values of the image"""
-        
-        #Numpy Method
-        image_array = np.loadtxt(im_name)
-        
-        #PNG Method
-        #image = Image.open(im_name)
-        #image_array = np.asarray(image)
-    
+    def load_full_im(self, im_name, mmap_mode=None):
+        """return an array with the values of the image. If mmap_mode is 
+        given, .npy and raw files are memory-mapped instead of read."""
+        image_array = load_image(im_name, self.image_format(im_name), mmap_mode)
         self.pic_size = image_array.shape[0] * image_array.shape[1]
         return image_array
         
     def process(self, im_name):
         """Get the data from an image """
-        try:
-            self.add_count(im_name)
-        except IndexError: # this is a bad exception - the error might be from a bad ROI rather than reaching the end of the arrays
-            # filled the array of size n so add more elements
-            if self.im_num % (self.n - 10) == 0 and self.im_num > self.n / 2:
-                self.counts = np.append(self.counts, np.zeros(self.n))
-                self.mid_count = np.append(self.mid_count, np.zeros(self.n))
-                self.mean_count = np.append(self.mean_count, np.zeros(self.n)) 
-                self.std_count = np.append(self.std_count, np.zeros(self.n))
-                self.xc_list = np.append(self.xc_list, np.zeros(self.n))
-                self.yc_list = np.append(self.yc_list, np.zeros(self.n))
-                self.atom = np.append(self.atom, np.zeros(self.n))
-                self.files = np.append(self.files, np.array([None]*self.n))
-            self.add_count(im_name)
+        self.results.reserve(self.im_num + 1, self.im_num)
+        self.add_count(im_name)
+
+    def process_frame(self, full_im, label):
+        """Get the data from an image that is already in memory, e.g. a view
+        of a camera buffer, so that no file has to be written or read.
+        The image is indexed full_im[x, y] like the loaded image files.
+        label is stored in place of the file number."""
+        self.results.reserve(self.im_num + 1, self.im_num)
+        self.pic_size = np.size(full_im)
+        self.add_frame_count(full_im, label)
 
     def add_count(self, im_name):
         """Fill in the next index of the counts by summing over the ROI region and then 
         getting a counts/pixel. 
         Fill in the next index of the file, xc, yc, mean, std arrays."""
-        full_im = self.load_full_im(im_name) # make an array of the image
-        not_roi = full_im.copy()
-        # get the ROI
-        if self.roi_size % 2: # odd ROI length (+1 to upper bound)
-            # ROI
-            self.im_vals = full_im[self.xc-self.roi_size//2:self.xc+self.roi_size//2+1,
-            self.yc-self.roi_size//2:self.yc+self.roi_size//2+1]
-            # background outside the ROI
-            not_roi[self.xc-self.roi_size//2:self.xc+self.roi_size//2+1,
-            self.yc-self.roi_size//2:self.yc+self.roi_size//2+1] = np.zeros(np.shape(self.im_vals))
-        else:                 # even ROI length
-            # ROI
-            self.im_vals = full_im[self.xc-self.roi_size//2:self.xc+self.roi_size//2,
-            self.yc-self.roi_size//2:self.yc+self.roi_size//2]
-            # background outside the ROI
-            not_roi[self.xc-self.roi_size//2:self.xc+self.roi_size//2,
-            self.yc-self.roi_size//2:self.yc+self.roi_size//2] = np.zeros(np.shape(self.im_vals))
+        full_im = self.load_full_im(im_name, self.mmap_mode) # make an array of the image
+        # naming convention: [Species]_[date]_[Dexter file #]
+        self.add_frame_count(full_im, im_name.split("_")[-1].split(".")[0])
 
+    def add_frame_count(self, full_im, label):
+        """Fill in the next index of the arrays from the image array full_im,
+        labelled in the files array by label."""
+        # get the ROI (copied since full_im might be a camera buffer or a memory map)
+        xmin, ymin = self.xc-self.roi_size//2, self.yc-self.roi_size//2
+        xmax = self.xc+self.roi_size//2 + self.roi_size % 2 # odd ROI length (+1 to upper bound)
+        ymax = self.yc+self.roi_size//2 + self.roi_size % 2
+        self.im_vals = np.array(full_im[xmin:xmax, ymin:ymax])
+        
         # background statistics: mean count and standard deviation across image
+        # outside of the ROI, from the full image sums minus the ROI sums
+        im_sum, im_sum2, max_pos = frame_stats(full_im)
+        roi_vals = self.im_vals.astype(float)
         N = np.size(full_im) - np.size(self.im_vals)
-        self.mean_count[self.im_num] = np.sum(not_roi) / N
-        self.std_count[self.im_num] = np.sqrt(np.sum((not_roi[not_roi>0]-self.mean_count[self.im_num])**2) / (N - 1))
+        bg_sum = im_sum - np.sum(roi_vals)
+        bg_sum2 = im_sum2 - np.sum(roi_vals**2)
+        self.cache_frames(np.asarray(full_im)[None], [im_sum], [im_sum2])
+        self.mean_count[self.im_num] = bg_sum / N
+        self.std_count[self.im_num] = np.sqrt(max(bg_sum2 - bg_sum**2 / N, 0) / (N - 1))
         # sum of counts in the ROI of the image gives the signal
         self.counts[self.im_num] = np.sum(self.im_vals) # / np.size(self.im_vals) # mean        
-        # naming convention: [Species]_[date]_[Dexter file #]
-        self.files[self.im_num] = im_name.split("_")[-1].split(".")[0]
+        self.files[self.im_num] = label
         # find the count at the centre of the ROI
         self.mid_count[self.im_num] = full_im[self.xc, self.yc]
-        self.xc_list[self.im_num], self.yc_list[self.im_num] = np.unravel_index(np.argmax(full_im), full_im.shape)
+        self.xc_list[self.im_num], self.yc_list[self.im_num] = max_pos
         self.im_num += 1
         
+    def load_batch(self, file_list):
+        """Load the image files in file_list into an (N, H, W) stack for 
+        process_batch. Files that fail to load or that have a different 
+        size to the first image are skipped with a warning.
+        Returns the stack and the list of file labels."""
+        ims, labels = [], []
+        for file_name in file_list:
+            try:
+                im = self.load_full_im(file_name, self.mmap_mode)
+                if len(ims) and np.shape(im) != np.shape(ims[0]):
+                    raise ValueError('image size does not match')
+            except (OSError, ValueError):
+                print("\n WARNING: failed to load "+file_name)
+                continue
+            ims.append(im)
+            # naming convention: [Species]_[date]_[Dexter file #]
+            labels.append(file_name.split("_")[-1].split(".")[0])
+        return np.array(ims), labels
+
+    def process_batch(self, stack_or_paths, labels=None, chunk=64):
+        """Process a stack of images at once, filling in the arrays for all
+        of them together. 
+        Keyword arguments:
+        stack_or_paths -- an (N, H, W) array of images indexed [image, x, y],
+                        or a list of file names which are loaded chunk at a time.
+        labels         -- labels for the files array. The default for a stack 
+                        is the image number.
+        chunk          -- number of images to load or process at once, which
+                        limits the memory used. Fewer images are processed
+                        at once if their float copy would be more than
+                        batch_bytes.
+        Returns the number of images processed."""
+        if not isinstance(stack_or_paths, np.ndarray): # list of file names
+            n = 0
+            for i in range(0, len(stack_or_paths), chunk):
+                stack, labels = self.load_batch(stack_or_paths[i:i+chunk])
+                n += self.process_batch(stack, labels, chunk)
+            return n
+        stack = stack_or_paths
+        N = np.shape(stack)[0] if np.ndim(stack) == 3 else 0
+        if N == 0:
+            return 0
+        if labels is None:
+            labels = list(map(str, range(self.im_num, self.im_num + N)))
+        self.results.reserve(self.im_num + N, self.im_num) # make space for the new images
+        self.pic_size = np.size(stack[0])
+        xmin, ymin = self.xc-self.roi_size//2, self.yc-self.roi_size//2
+        xmax = self.xc+self.roi_size//2 + self.roi_size % 2 # odd ROI length (+1 to upper bound)
+        ymax = self.yc+self.roi_size//2 + self.roi_size % 2
+        chunk = max(1, min(chunk, self.batch_bytes // (8 * self.pic_size)))
+        
+        for j in range(0, N, chunk):
+            block = np.asarray(stack[j:j+chunk], dtype=float)
+            n = np.size(block, 0)
+            i = self.im_num + j # index in the arrays
+            full = block.reshape(n, -1)
+            roi = block[:, xmin:xmax, ymin:ymax].reshape(n, -1)
+            # background statistics outside of the ROI, from the full image sums minus the ROI sums
+            M = np.size(full, 1) - np.size(roi, 1)
+            im_sum, im_sum2 = np.sum(full, axis=1), np.einsum('ij,ij->i', full, full)
+            bg_sum = im_sum - np.sum(roi, axis=1)
+            bg_sum2 = im_sum2 - np.einsum('ij,ij->i', roi, roi)
+            self.mean_count[i:i+n] = bg_sum / M
+            self.std_count[i:i+n] = np.sqrt(np.maximum(bg_sum2 - bg_sum**2 / M, 0) / (M - 1))
+            # sum of counts in the ROI of the image gives the signal
+            self.counts[i:i+n] = np.sum(roi, axis=1)
+            # find the count at the centre of the ROI
+            self.mid_count[i:i+n] = block[:, self.xc, self.yc]
+            self.xc_list[i:i+n], self.yc_list[i:i+n] = np.unravel_index(
+                    np.argmax(full, axis=1), np.shape(block)[1:])
+            self.cache_frames(np.asarray(stack[j:j+chunk]), im_sum, im_sum2, i)
+        self.files[self.im_num:self.im_num+N] = labels
+        self.im_vals = np.array(stack[-1, xmin:xmax, ymin:ymax])
+        self.im_num += N
+        return N
+        
+    def cache_frames(self, ims, im_sums, im_sums2, i=None):
+        """Store the pixels around the ROI from the stack of images ims
+        indexed [image, x, y] and their sums and sums of squares, at index
+        i (default im_num) of the cache. The cached region is fixed by the
+        ROI when the first image is added. The cache is dropped if it would
+        not match the counts, e.g. if the image size changes. The patches are
+        stored as integers where the pixel values allow, and the cache 
+        starts small and doubles in size as images are added."""
+        i = self.im_num if i is None else i
+        shape = np.shape(ims)[1:]
+        if self.cache is None:
+            if i > 0 or not self.cache_margin: # counts were added without caching
+                return
+            m = self.cache_margin
+            self.cache_box = (max(self.xc - self.roi_size//2 - m, 0), 
+                max(self.yc - self.roi_size//2 - m, 0),
+                min(self.xc + self.roi_size//2 + self.roi_size%2 + m, shape[0]),
+                min(self.yc + self.roi_size//2 + self.roi_size%2 + m, shape[1]))
+            xmin, ymin, xmax, ymax = self.cache_box
+            self.cache_shape = shape
+            self.cache = column_store([('patch', pixel_dtype(ims[:, xmin:xmax, ymin:ymax]), 
+                (xmax-xmin, ymax-ymin)), ('im_sum', float), ('im_sum2', float)], 
+                min(self.cache_rows, self.n))
+            self.cache_n = 0
+        if shape != self.cache_shape or i != self.cache_n:
+            self.cache = None
+            return
+        n = len(ims)
+        xmin, ymin, xmax, ymax = self.cache_box
+        patches = ims[:, xmin:xmax, ymin:ymax]
+        dtype = self.cache.dtype['patch'].base
+        if pixel_dtype(patches, dtype) != dtype: # values no longer fit: store as floats
+            self.cache.dtype = np.dtype([('patch', float, self.cache.dtype['patch'].shape), 
+                ('im_sum', float), ('im_sum2', float)])
+            self.cache.data = self.cache.data.astype(self.cache.dtype)
+        self.cache.reserve(i + n, i)
+        self.cache['patch'][i:i+n] = patches
+        self.cache['im_sum'][i:i+n] = im_sums
+        self.cache['im_sum2'][i:i+n] = im_sums2
+        self.cache_n = i + n
+
+    def recount(self, dimensions):
+        """Set the ROI to dimensions [xc, yc, roi_size] and recalculate the
+        counts, background, and centre count of all of the images so far
+        from the cache. The histogram and atom presence are then updated
+        the next time they are used.
+        Returns True if the new ROI is inside the cached region, otherwise
+        the ROI is only set for the following images and returns False."""
+        self.set_roi(dimensions=dimensions)
+        xmin, ymin = self.xc-self.roi_size//2, self.yc-self.roi_size//2
+        xmax = self.xc+self.roi_size//2 + self.roi_size % 2 # odd ROI length (+1 to upper bound)
+        ymax = self.yc+self.roi_size//2 + self.roi_size % 2
+        x0, y0, x1, y1 = self.cache_box
+        if (self.cache is None or self.cache_n != self.im_num or xmin < x0 
+                or ymin < y0 or xmax > x1 or ymax > y1):
+            return False
+        n = self.im_num
+        patches = self.cache['patch'][:n]
+        roi = patches[:, xmin-x0:xmax-x0, ymin-y0:ymax-y0].reshape(n, -1).astype(float)
+        # background statistics outside of the ROI, from the full image sums minus the ROI sums
+        M = np.prod(self.cache_shape) - np.size(roi, 1)
+        bg_sum = self.cache['im_sum'][:n] - np.sum(roi, axis=1)
+        bg_sum2 = self.cache['im_sum2'][:n] - np.einsum('ij,ij->i', roi, roi)
+        self.mean_count[:n] = bg_sum / M
+        self.std_count[:n] = np.sqrt(np.maximum(bg_sum2 - bg_sum**2 / M, 0) / (M - 1))
+        self.counts[:n] = np.sum(roi, axis=1)
+        self.mid_count[:n] = patches[:, self.xc-x0, self.yc-y0]
+        if n:
+            self.im_vals = np.array(patches[-1, xmin-x0:xmax-x0, ymin-y0:ymax-y0])
+        self.hist_n = 0                 # rebin the histogram
+        self.atom_n = 0                 # reset atom presence
+        return True
+
+    def roi_sweep(self, sizes=None, shifts=range(-2, 3)):
+        """Find the fidelity of each ROI with a length in sizes and centre
+        shifted by (dx, dy) for dx, dy in shifts from the current ROI centre,
+        using the counts of all of the images so far. The counts are taken
+        from summed-area tables of the cached pixels, so each ROI only costs
+        four lookups per image. ROIs outside of the cache are skipped.
+        Returns a structured array with columns xc, yc, roi_size, fidelity,
+        err_fidelity, and thresh, sorted from the highest fidelity (then 
+        the smallest error)."""
+        results = []
+        if self.cache is not None and self.cache_n == self.im_num and self.im_num:
+            n = self.im_num
+            x0, y0, x1, y1 = self.cache_box
+            sat = integral_image(self.cache['patch'][:n])
+            if sizes is None: 
+                sizes = range(1, min(x1-x0, y1-y0) + 1)
+            test = image_handler() # automatic binning since the counts change with the ROI size
+            test.results.reserve(n)
+            for l in sizes:
+                for dx in shifts:
+                    for dy in shifts:
+                        xc, yc = self.xc + dx, self.yc + dy
+                        xmin, ymin = xc - l//2, yc - l//2
+                        xmax, ymax = xc + l//2 + l%2, yc + l//2 + l%2
+                        if xmin < x0 or ymin < y0 or xmax > x1 or ymax > y1:
+                            continue
+                        test.counts[:n] = rect_sum(sat, xmin-x0, ymin-y0, xmax-x0, ymax-y0)
+                        test.im_num, test.hist_n, test.atom_n = n, 0, 0
+                        test.fidelity, test.err_fidelity = 0, 0 # not set if there aren't two peaks
+                        test.hist_and_thresh()
+                        results.append((xc, yc, l, test.fidelity, test.err_fidelity, test.thresh))
+        results = np.array(results, dtype=[('xc', int), ('yc', int), ('roi_size', int), 
+                    ('fidelity', float), ('err_fidelity', float), ('thresh', float)])
+        return results[np.lexsort((results['err_fidelity'], -results['fidelity']))]
+
     def get_latest_count(self):
         return self.counts[self.im_num-1]
             
@@ -214,15 +576,12 @@ class image_handler:
             # set the threshold where the fidelity is max
             self.search_fidelity(self.peak_counts[0], self.peak_widths[0] ,self.peak_counts[1])
         # atom is present if the counts are above threshold
-        self.atom[:self.im_num] = self.counts[:self.im_num] // self.thresh 
+        self.update_atoms()
         return bins, occ, self.thresh
 
     def histogram(self):
         """Make a histogram of the photon counts but don't update the threshold"""
-        if np.size(self.bin_array) > 0: 
-            occ, bins = np.histogram(self.counts[:self.im_num], self.bin_array) # fixed bins. 
-        else:
-            occ, bins = np.histogram(self.counts[:self.im_num]) # no bins provided, do automatic binning
+        bins, occ = self.update_hist()
         # get the indexes of peak positions, heights, and widths
         self.peak_indexes, self.peak_heights, self.peak_widths = est_param(occ)
         self.peak_counts = bins[self.peak_indexes] + 0.5*(bins[1] - bins[0])
@@ -232,9 +591,50 @@ class image_handler:
             self.peak_widths = [(bins[1] - bins[0]) * self.peak_widths[0]/2., # /np.sqrt(2*np.log(2)), 
                                 (bins[1] - bins[0]) * self.peak_widths[1]/2.] # /np.sqrt(2*np.log(2))]
         # atom is present if the counts are above threshold
-        self.atom[:self.im_num] = self.counts[:self.im_num] // self.thresh
+        self.update_atoms()
         return bins, occ, self.thresh
         
+    def update_hist(self):
+        """Update the histogram of counts[:im_num], only binning the counts
+        added since the last update. All of the counts are rebinned if the
+        bin_array changes, if new counts are outside of the range used for
+        automatic binning, or if the arrays were reset. 
+        Returns the bin edges and the occupancy, the same as np.histogram"""
+        new = self.counts[self.hist_n:self.im_num]
+        fixed = np.size(self.bin_array) > 0
+        if self.hist_n == 0 or self.im_num < self.hist_n or fixed != self.hist_fixed:
+            rebin = True
+        elif fixed:  # fixed bins. 
+            rebin = not np.array_equal(self.bin_array, self.hist_bins)
+        else:        # automatic binning spans the range of the counts
+            rebin = np.size(new) > 0 and (np.min(new) < self.hist_range[0] 
+                                        or np.max(new) > self.hist_range[1])
+        if rebin:
+            if fixed:
+                self.hist_occ, self.hist_bins = np.histogram(self.counts[:self.im_num], self.bin_array)
+            else:
+                self.hist_occ, self.hist_bins = np.histogram(self.counts[:self.im_num])
+            if self.im_num > 0:
+                self.hist_range = (np.min(self.counts[:self.im_num]), np.max(self.counts[:self.im_num]))
+            self.hist_fixed = fixed
+        elif np.size(new) > 0:
+            idx = np.searchsorted(self.hist_bins, new, side='right') - 1
+            idx[new == self.hist_bins[-1]] -= 1 # the last bin includes its upper edge
+            idx = idx[(idx >= 0) & (idx < np.size(self.hist_occ))] # drop counts outside of the bins
+            self.hist_occ += np.bincount(idx, minlength=np.size(self.hist_occ))
+        self.hist_n = self.im_num
+        return self.hist_bins, self.hist_occ
+
+    def update_atoms(self):
+        """Atom is present if the counts are above threshold. Only set atom 
+        for the counts added since the last update, unless the threshold has
+        changed, so that the atoms always match the reported threshold."""
+        if self.atom_n == 0 or self.thresh != self.atom_thresh or self.im_num < self.atom_n:
+            self.atom_thresh = self.thresh
+            self.atom_n = 0
+        self.atom[self.atom_n:self.im_num] = self.counts[self.atom_n:self.im_num] // self.thresh
+        self.atom_n = self.im_num
+
     def peaks_and_thresh(self):
         """Get an estimate of the peak positions and standard deviations given a set threshold
         Then set the threshold as 5 standard deviations above background
@@ -252,7 +652,7 @@ class image_handler:
         sep = at_peak - bg_peak
         self.thresh = bg_peak + 5*bg_stdv # update threshold
         # atom is present if the counts are above threshold
-        self.atom[:self.im_num] = self.counts[:self.im_num] // self.thresh 
+        self.update_atoms()
         atom_count = np.size(np.where(self.atom > 0)[0])  # images with counts above threshold
         empty_count = np.size(np.where(self.atom[:self.im_num] == 0)[0])
         load_prob = np.around(atom_count / self.im_num, 4)
@@ -286,25 +686,28 @@ class image_handler:
     def load_from_csv(self, file_name):
         """Load back in the counts data from a stored csv file, leavning space
         in the arrays to add new data as well"""
-        data = np.genfromtxt(file_name, delimiter=',')
+        data = np.atleast_2d(np.genfromtxt(file_name, delimiter=','))
+        header = '' # the histogram stats and column headings are commented out
         with open(file_name, 'r') as f:
-            header = f.readline()
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                header += line
         if np.size(data): # check the file wasn't empty
+            N = np.size(data[:,0])
+            self.results.reserve(self.im_num + N, self.im_num) # leave space to add new data
+            new = self.results.data[self.im_num:self.im_num + N]
             i = 0
-            self.files = np.concatenate((self.files[:self.im_num], data[:,i], np.array([None]*self.n)))
-            self.counts = np.concatenate((self.counts[:self.im_num], data[:,i+1], np.zeros(self.n)))
-            self.atom = np.concatenate((self.atom[:self.im_num], data[:,i+2], np.zeros(self.n)))
-            if 'Max Count' in header or 'Mid Count' in header:
-                self.mid_count = np.concatenate((self.mid_count[:self.im_num], data[:,i+3], np.zeros(self.n)))
+            new['files'], new['counts'], new['atom'] = data[:,i], data[:,i+1], data[:,i+2]
+            if 'Max Count' in header or 'Mid Count' in header or 'ROI Centre Count' in header:
+                new['mid_count'] = data[:,i+3]
                 i += 4
             else: # retain compatability with older csv files that don't contain max/mid count
-                self.mid_count = np.concatenate((self.mid_count[:self.im_num], np.zeros(self.n + np.size(data[:,i]))))
+                new['mid_count'] = 0
                 i += 3
-            self.xc_list = np.concatenate((self.xc_list[:self.im_num], data[:,i], np.zeros(self.n)))
-            self.yc_list = np.concatenate((self.yc_list[:self.im_num], data[:,i+1], np.zeros(self.n)))
-            self.mean_count = np.concatenate((self.mean_count[:self.im_num], data[:,i+2], np.zeros(self.n)))
-            self.std_count = np.concatenate((self.std_count[:self.im_num], data[:,i+3], np.zeros(self.n)))
-            self.im_num += np.size(data[:,0]) # now we have filled this many extra columns.
+            new['xc_list'], new['yc_list'] = data[:,i], data[:,i+1]
+            new['mean_count'], new['std_count'] = data[:,i+2], data[:,i+3]
+            self.im_num += N # now we have filled this many extra columns.
         
     def save_state(self, save_file_name, hist_header=None, hist_stats=None):
         """Save the processed data to csv. 
@@ -319,7 +722,7 @@ class image_handler:
         hist_stats     -- a list of histogram statistics associated with this histogram
         """
         # atom is present if the counts are above threshold
-        self.atom[:self.im_num] = self.counts[:self.im_num] // self.thresh 
+        self.update_atoms()
         # histogram data
         out_arr = np.array((self.files[:self.im_num], self.counts[:self.im_num], 
             self.atom[:self.im_num], self.mid_count[:self.im_num], self.xc_list[:self.im_num], 
@@ -335,3 +738,295 @@ class image_handler:
                 header=header%int(self.thresh))
 
 ####    ####    ####    ####
+
+class multi_site_handler:
+    """Get the counts in many ROIs at once, e.g. the sites of a tweezer array.
+
+    Each image is loaded once and the counts of all of the sites are taken 
+    from it in one vectorised gather, so that the time per image hardly 
+    depends on the number of sites. The ROIs are squares [xc, yc, size] like
+    image_handler's, clipped to the edges of the image. For an image shape
+    they are turned into either:
+     - an (n_sites, size**2) array of flat pixel indexes, if the clipped 
+       ROIs all have the same number of pixels (a regular array)
+     - otherwise a sparse (n_sites, n_pixels) matrix of ones, so that the 
+       counts are the matrix times the flattened image
+    For weighted counting (see set_psf) the sparse matrix holds a Gaussian 
+    PSF kernel for each site instead of ones, which weights the pixels near
+    the atom more than the background at the edges of the ROI.
+    The counts are stored in an (n_images, n_sites) array with space for 
+    more images, which doubles in size when it is filled.
+    Keyword arguments:
+    rois -- an (n_sites, 3) array of [xc, yc, size] for each site
+    n    -- the initial number of images to make space for
+    """
+    def __init__(self, rois=[], n=10000):
+        self.n = n                      # initial number of rows of the counts array
+        self.thresh = 1                 # threshold for atom detection, a number or one per site (see fit_thresh)
+        self.mmap_mode = 'r'            # memory-map .npy/raw files so only the sites are read
+        self.formats = {}               # image file format for each (directory, extension)
+        self.psf = None                 # (wx, wy, x offset, y offset) for weighted counts
+        self.set_rois(rois)
+
+    def set_rois(self, rois):
+        """Set the ROIs from an (n_sites, 3) array of [xc, yc, size] and
+        clear the counts, since they are for different sites."""
+        self.rois = np.reshape(np.asarray(rois, dtype=int), (-1, 3))
+        if np.size(self.thresh) not in (1, len(self.rois)): # one per site of the old ROIs
+            self.thresh = float(np.mean(self.thresh))
+        self.shape = None               # image shape that the indexes were made for
+        self.index = None               # (n_sites, pixels) flat indexes, or None
+        self.matrix = None              # sparse (n_sites, n_pixels) matrix, or None
+        self.reset_arrays()
+
+    def reset_arrays(self):
+        """Delete the counts and return to the initial capacity"""
+        self.counts = np.zeros((self.n, len(self.rois)))
+        self.files = np.zeros(self.n, dtype=object)
+        self.im_num = 0                 # number of images processed
+
+    def discard(self, n):
+        """Remove the counts of the last n images that were processed"""
+        self.im_num -= min(n, self.im_num)
+
+    def load_rois(self, file_name):
+        """Load the ROIs from a csv file with columns xc, yc, size"""
+        self.set_rois(np.loadtxt(file_name, delimiter=',', ndmin=2))
+
+    def save_rois(self, file_name):
+        """Save the ROIs to a csv file with columns xc, yc, size"""
+        np.savetxt(file_name, self.rois, fmt='%d', delimiter=',', header='xc, yc, size')
+
+    def make_index(self, shape):
+        """Make the flat pixel indexes (or the sparse matrix) of the ROIs in 
+        images with the given (x, y) shape."""
+        self.shape = tuple(shape)
+        xmin = np.clip(self.rois[:,0] - self.rois[:,2]//2, 0, shape[0])
+        ymin = np.clip(self.rois[:,1] - self.rois[:,2]//2, 0, shape[1])
+        xmax = np.clip(self.rois[:,0] + self.rois[:,2]//2 + self.rois[:,2]%2, 0, shape[0])
+        ymax = np.clip(self.rois[:,1] + self.rois[:,2]//2 + self.rois[:,2]%2, 0, shape[1])
+        w, h = xmax - xmin, ymax - ymin
+        if self.psf is None and len(self.rois) and np.all(w == w[0]) and np.all(h == h[0]):
+            dx, dy = np.meshgrid(np.arange(w[0]), np.arange(h[0]), indexing='ij')
+            x = xmin[:,None] + dx.ravel()
+            y = ymin[:,None] + dy.ravel()
+            self.index = np.ravel_multi_index((x, y), shape)
+            self.matrix = None
+        else:
+            from scipy.sparse import csr_matrix
+            sites, pixels, weights = [], [], []
+            for i in range(len(self.rois)):
+                x, y = np.meshgrid(np.arange(xmin[i], xmax[i]), np.arange(ymin[i], ymax[i]), indexing='ij')
+                pixels.append(np.ravel_multi_index((x.ravel(), y.ravel()), shape))
+                sites.append(np.full(np.size(x), i))
+                weights.append(self.psf_weights(x.ravel(), y.ravel(), self.rois[i]))
+            pixels = np.concatenate(pixels) if pixels else np.array([], dtype=int)
+            sites = np.concatenate(sites) if sites else np.array([], dtype=int)
+            weights = np.concatenate(weights) if weights else np.array([])
+            self.matrix = csr_matrix((weights, (sites, pixels)),
+                                     shape=(len(self.rois), int(np.prod(shape))))
+            self.index = None
+
+    def psf_weights(self, x, y, roi):
+        """Return the weights of the pixels (x, y) in an ROI [xc, yc, size]:
+        ones, or for weighted counting the PSF p normalised as p / sum(p**2),
+        so that an atom giving N counts spread over the PSF gives a weighted
+        count of N."""
+        if self.psf is None:
+            return np.ones(np.size(x))
+        wx, wy, x0, y0 = self.psf
+        xc, yc = roi[0] + x0, roi[1] + y0
+        p = np.exp(-2*(x - xc)**2/wx**2 - 2*(y - yc)**2/wy**2)
+        p /= np.sum(p)
+        return p / np.sum(p**2)
+
+    def set_psf(self, wx=None, wy=None, x0=0, y0=0):
+        """Count with the pixels weighted by a Gaussian PSF with 1/e^2 widths
+        wx, wy (pixels) centred at (x0, y0) from the centre pixel (xc, yc)
+        of each ROI.
+        If wx is None, go back to uniform counts. Clears the counts, since
+        they are on a different scale."""
+        if wx is None:
+            self.psf = None
+        else:
+            self.psf = (wx, wy if wy else wx, x0, y0)
+        self.shape = None # remake the matrix for the next image
+        self.reset_arrays()
+
+    def fit_psf(self, mean_im):
+        """Fit a Gaussian PSF to an image averaged over many shots with atoms
+        (indexed [x, y]) and use it for weighted counting. The ROIs of all
+        of the sites are averaged, then the sums along x and y are fitted 
+        with a Gaussian. Returns the PSF (wx, wy, x0, y0) in pixels."""
+        from fitCurve import fit
+        size = int(np.max(self.rois[:,2]))
+        padded = np.pad(np.asarray(mean_im, dtype=float), size, mode='edge')
+        patch = np.zeros((size, size))
+        for xc, yc, l in self.rois: # the same size box around each site
+            x, y = xc + size - size//2, yc + size - size//2
+            patch += padded[x:x+size, y:y+size]
+        psf = []
+        for axis in [1, 0]: # sum over y for the profile along x, then over x
+            profile = np.sum(patch, axis=axis)
+            f = fit(np.arange(size) - (size - 1)/2., profile) # centre of the box at 0
+            f.estGaussParam()
+            f.p0 = [f.p0[0], f.p0[1], 2*f.p0[2], np.min(profile)] # 1/e^2 width
+            f.getBestFit(f.offGauss)
+            psf.append((abs(f.ps[2]), f.ps[1]))
+        (wx, x0), (wy, y0) = psf
+        shift = 0.5*(1 - size%2) # the centre of an even box is between pixels
+        self.set_psf(wx, wy, x0 - shift, y0 - shift)
+        return self.psf
+
+    def site_counts(self, flat):
+        """Return the (n_images, n_sites) counts from an (n_images, n_pixels)
+        array of flattened images"""
+        if self.index is not None:
+            return np.take(flat, self.index, axis=1).sum(axis=2, dtype=float)
+        return np.asarray((self.matrix @ flat.T).T, dtype=float)
+
+    def process(self, im_name):
+        """Get the counts of all of the sites from an image file"""
+        full_im = load_image(im_name, self.image_format(im_name), self.mmap_mode)
+        self.process_batch(full_im[None], [im_name.split("_")[-1].split(".")[0]])
+
+    def process_frame(self, full_im, label):
+        """Get the counts of all of the sites from an image array indexed 
+        [x, y] that is already in memory, e.g. a view of a camera buffer.
+        Returns the number of images processed (0 if there are no sites)."""
+        return self.process_batch(np.asarray(full_im)[None], [label])
+
+    def process_batch(self, stack, labels=None, chunk=64):
+        """Get the counts of all of the sites from an (N, H, W) stack of 
+        images indexed [image, x, y]. labels are stored in the files array,
+        the default is the image number. Returns the number of images."""
+        N = np.shape(stack)[0] if np.ndim(stack) == 3 else 0
+        if N == 0 or len(self.rois) == 0:
+            return 0
+        if labels is None:
+            labels = list(map(str, range(self.im_num, self.im_num + N)))
+        if np.shape(stack)[1:] != self.shape:
+            self.make_index(np.shape(stack)[1:])
+        if self.im_num + N > np.size(self.files): # double the capacity until it fits
+            capacity = np.size(self.files)
+            while capacity < self.im_num + N:
+                capacity *= 2
+            counts, files = np.zeros((capacity, len(self.rois))), np.zeros(capacity, dtype=object)
+            counts[:self.im_num], files[:self.im_num] = self.counts[:self.im_num], self.files[:self.im_num]
+            self.counts, self.files = counts, files
+        for j in range(0, N, chunk):
+            block = stack[j:j+chunk]
+            n = np.size(block, 0)
+            self.counts[self.im_num+j:self.im_num+j+n] = self.site_counts(block.reshape(n, -1))
+        self.files[self.im_num:self.im_num+N] = labels
+        self.im_num += N
+        return N
+
+    image_format = image_handler.image_format # same cache of file formats
+
+    def get_latest_counts(self):
+        """Return the counts of each site in the last image"""
+        return self.counts[self.im_num-1]
+
+    def fit_thresh(self):
+        """Set the threshold of each site from the histogram of its counts,
+        the same way as image_handler.hist_and_thresh: where the fidelity is
+        highest between the background and signal peaks, or the middle of
+        the histogram if two peaks aren't found. Returns the thresholds."""
+        n = self.im_num
+        if n < 2:
+            return self.thresh
+        test = image_handler() # automatic binning
+        test.results.reserve(n)
+        thresh = np.zeros(len(self.rois))
+        for i in range(len(self.rois)):
+            test.counts[:n] = self.counts[:n, i]
+            test.im_num, test.hist_n, test.atom_n = n, 0, 0
+            thresh[i] = test.hist_and_thresh()[2]
+        self.thresh = thresh
+        return thresh
+
+    def atoms(self):
+        """Return an (n_images, n_sites) boolean array of whether the counts
+        are above the threshold"""
+        return self.counts[:self.im_num] > self.thresh
+
+    def occupancy(self):
+        """Return the fraction of images with an atom at each site"""
+        return np.mean(self.atoms(), axis=0) if self.im_num else np.zeros(len(self.rois))
+
+    def save_state(self, save_file_name):
+        """Save the counts to csv, one row per image with the file label
+        then the counts of each site"""
+        out_arr = np.concatenate((self.files[:self.im_num,None], 
+                                  self.counts[:self.im_num]), axis=1)
+        header = 'ROI xc ; yc ; size, ' + ', '.join('%d ; %d ; %d'%tuple(r) for r in self.rois)
+        header += '\nThreshold, ' + ', '.join('%.6g'%t for t in np.broadcast_to(self.thresh, len(self.rois)))
+        header += '\nFile, ' + ', '.join('Site %d'%i for i in range(len(self.rois)))
+        np.savetxt(save_file_name, out_arr, fmt='%s', delimiter=',', header=header)
+
+####    ####    ####    ####
+
+class image_accumulator:
+    """Keep the running sum and sum of squares of the images in a run, so 
+    that the mean and standard deviation images can be displayed without 
+    keeping or reloading the images. The memory used only depends on the 
+    number of pixels, not the number of images.
+    The images are split into shots with and without an atom, as judged 
+    when each image is added, and both are combined for the whole run."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clear the sums"""
+        self.shape = None               # shape of the images, indexed [x, y]
+        self.n = np.zeros(2, dtype=int) # number of images [no atom, atom]
+        self.sum = None                 # (2, x, y) sum of the images [no atom, atom]
+        self.sum2 = None                # (2, x, y) sum of the squares of the images
+        self.tmp = None                 # space for the square of an image
+
+    def add(self, ims, atoms=None):
+        """Add an image indexed [x, y] or a stack of images [image, x, y]
+        to the sums. atoms is whether there is an atom in each image (the 
+        default is no atom). If the image size changes, the sums restart."""
+        ims = np.asarray(ims)
+        if ims.ndim == 2:
+            ims = ims[None]
+        if atoms is None:
+            atoms = np.zeros(len(ims), dtype=bool)
+        if ims.shape[1:] != self.shape:
+            self.reset()
+            self.shape = ims.shape[1:]
+            self.sum = np.zeros((2,) + self.shape)
+            self.sum2 = np.zeros((2,) + self.shape)
+            self.tmp = np.zeros(self.shape)
+        for im, k in zip(ims, np.asarray(atoms, dtype=int).ravel()): # in place, one image at a time
+            np.add(self.sum[k], im, out=self.sum[k])
+            np.multiply(im, im, out=self.tmp, dtype=float)
+            np.add(self.sum2[k], self.tmp, out=self.sum2[k])
+            self.n[k] += 1
+
+    def mean(self, atom=None):
+        """Return the mean image of the shots with (atom=True), without
+        (atom=False), or regardless of (atom=None) an atom. Returns None
+        if there are no images."""
+        n, total, _ = self.totals(atom)
+        return total / n if n else None
+
+    def std(self, atom=None):
+        """Return the standard deviation of each pixel over the shots, with
+        atom selecting the images as in mean(). Returns None if there are 
+        fewer than two images."""
+        n, total, total2 = self.totals(atom)
+        if n < 2:
+            return None
+        return np.sqrt(np.maximum(total2 - total**2 / n, 0) / (n - 1))
+
+    def totals(self, atom=None):
+        """Return the number of images, the sum and the sum of squares for 
+        the shots with, without, or regardless of (None) an atom."""
+        if self.shape is None:
+            return 0, None, None
+        if atom is None:
+            return np.sum(self.n), np.sum(self.sum, axis=0), np.sum(self.sum2, axis=0)
+        return self.n[int(atom)], self.sum[int(atom)], self.sum2[int(atom)]
@@ -12,6 +12,7 @@ https://github.com/micropolimi/HamamatsuCamera
 import os
 import sys
 import time
+import queue
 import numpy as np
 from astropy.stats import binom_conf_interval
 import pyqtgraph as pg    # not as flexible as matplotlib but works a lot better with qt
@@ -36,6 +37,8 @@ os.chdir(os.path.dirname(os.path.realpath(__file__)))
 import imageHandler as ih # process images to build up a histogram
 import histoHandler as hh # collect data from histograms together
 import directoryWatcher as dw # use watchdog to get file creation events
+import analysisWorker as aw # process images in a separate thread
+import frameBus as fb # pass camera frames to analysis and archive in process
 import fitCurve as fc   # custom class to get best fit parameters using curve_fit
 import ctypes
 import ctypes.util
@@ -72,6 +75,9 @@ class main_window(QMainWindow):
         1: tacitly initiate the directoryWatcher.
         2: pop-up window asks the user if they want to initiate.
     """
+    frame_ready = pyqtSignal(object) # [HCamData, [frame_x, frame_y]] held from the camera buffers
+    frame_display = pyqtSignal(object) # image array for the capture canvas
+
     def __init__(self, config_file='./config/config.dat', pop_up=2):
         super().__init__()
         self.bias = 697   # bias off set from EMCCD
@@ -81,6 +87,12 @@ class main_window(QMainWindow):
         self.c = [(255,127,14), (31,119,180)] # colours to plot in
         self.image_handler = [ih.image_handler(i, self.atomX[i]) for i in range(len(self.atomX))] # class to process images
         self.histo_handler = [hh.histo_handler(i, self.atomX[i]) for i in range(len(self.atomX))] # class to process histograms
+        self.analysis = aw.analysis_worker(self.image_handler) # thread that processes images
+        self.analysis.accumulator = ih.image_accumulator() # running sum of all of the images
+        self.analysis.results.connect(self.plot_results)
+        self.analysis.start()
+        self.frame_bus = fb.frame_bus(self.analysis) # archives once the dir watcher sets the storage path
+        self.frame_bus.start()
         self.hist_num = 0 # ID number for the next histogram
         pg.setConfigOption('background', 'w') # set graph background default white
         pg.setConfigOption('foreground', 'k') # set graph foreground default black
@@ -94,7 +106,9 @@ class main_window(QMainWindow):
         self.plot_time = 0     # time taken to plot the graph
 
     def initCamera(self):
-        dcam = ctypes.windll.dcamapi
+        """Initialise the DCAM library and open camera 0. The library is
+        chosen by the DCAM_LIBRARY environment variable, see camera_try.loadDCAM"""
+        dcam = camera_try.loadDCAM()
         print(dcam)
         paraminit = camera_try.DCAMAPI_INIT(0, 0, 0, 0, None, None)
         paraminit.size = ctypes.sizeof(paraminit)
@@ -104,7 +118,7 @@ class main_window(QMainWindow):
 
         n_cameras = paraminit.iDeviceCount
         print("found: {} cameras".format(n_cameras))
-        self.hcam = camera_try.HamamatsuCameraMR(camera_id = 0)
+        self.hcam = camera_try.HamamatsuCameraMR(camera_id = 0, dcam = dcam)
         print("camera 0 model:", self.hcam.getModelInfo(0))
 
     def init_log(self):
@@ -141,12 +155,20 @@ class main_window(QMainWindow):
         self.centre_widget.layout.addWidget(self.tabs)
         self.centre_widget.setLayout(self.centre_widget.layout)
         self.setCentralWidget(self.centre_widget)
-        self.frame_thread = frameCheckThread.FrameCheckThreadLive(self)
+        self.frame_thread = frameCheckThread.FrameDeliveryThread(self) # replaced when capture starts
         self.acquisition_mode = "run_till_abort"
         self.trigger_mode = "intenal"
         self.threshold_reset = False
         self.in_reset = False
         self.colormap_toggle = True
+        self.direct_analysis = False # analyse frames from the camera buffers instead of saving them
+        self.frame_in_use = None     # frame held from the camera buffers for analysis
+        self.frame_num = 0           # label for frames analysed directly
+        self.image_num = 0           # number of frames saved in external trigger mode
+        self.use_frame_bus = False   # publish frames on the frame bus instead of saving them for the dir watcher
+        self.frame_ready.connect(self.analyse_frame) # queued: frames arrive from the frame thread
+        self.display_pending = False # a frame is waiting to be drawn on the capture canvas
+        self.frame_display.connect(self.show_capture)
 
         # validators for user input
         reg_exp = QRegExp(r'([0-9]+(\.[0-9]+)?,?)+')
@@ -178,6 +200,10 @@ class main_window(QMainWindow):
         reset_hist.triggered.connect(self.check_reset)
         hist_menu.addAction(reset_hist)
 
+        roi_sweep = QAction('ROI size sweep', self) # fidelity of ROIs around the current one
+        roi_sweep.triggered.connect(self.roi_sweep)
+        hist_menu.addAction(roi_sweep)
+
         load_menu = QMenu('Load histogram data', self)  # drop down menu for loading hist
         load_dir = QAction('From Files', self) # from image files
         load_dir.triggered.connect(self.load_from_files)
@@ -203,6 +229,30 @@ class main_window(QMainWindow):
         bin_options.triggered.connect(self.set_bins) # connect the signal
         hist_menu.addMenu(bin_menu)
 
+        # array menu loads ROIs for the sites of a tweezer array, which are all analysed at once
+        array_menu = menubar.addMenu('Array')
+        load_sites = QAction('Load array ROIs', self) # csv of xc, yc, size for each site
+        load_sites.triggered.connect(self.load_site_rois)
+        array_menu.addAction(load_sites)
+        save_sites = QAction('Save array ROIs', self)
+        save_sites.triggered.connect(self.save_site_rois)
+        array_menu.addAction(save_sites)
+        save_site_counts = QAction('Save array counts', self) # counts of every site in each image
+        save_site_counts.triggered.connect(self.save_site_counts)
+        array_menu.addAction(save_site_counts)
+        fit_site_psf = QAction('Fit array PSF weights', self) # weight counts by a PSF fitted to the average image
+        fit_site_psf.triggered.connect(self.fit_site_psf)
+        array_menu.addAction(fit_site_psf)
+        uniform_sites = QAction('Uniform array counts', self)
+        uniform_sites.triggered.connect(self.uniform_site_counts)
+        array_menu.addAction(uniform_sites)
+        fit_site_thresh = QAction('Fit array thresholds', self) # from the histogram of each site
+        fit_site_thresh.triggered.connect(self.fit_site_thresh)
+        array_menu.addAction(fit_site_thresh)
+        set_site_thresh = QAction('Set array threshold', self) # the same for every site
+        set_site_thresh.triggered.connect(self.set_site_thresh)
+        array_menu.addAction(set_site_thresh)
+
 
         # load plots from log files
         varplot_menu = menubar.addMenu('Plotting')
@@ -290,6 +340,30 @@ class main_window(QMainWindow):
         capture_grid.addWidget(threshold_toggle, 1,i, 1,1)
         i+=1
 
+        direct_text = QLabel("Direct Analysis:", self)
+        direct_text.setFont(QFont(direct_text.font().family(), 12))
+        direct_text.setAlignment(Qt.AlignRight)
+        capture_grid.addWidget(direct_text, 1,i, 1,1)
+        i+=1
+
+        direct_toggle = QCheckBox("")
+        direct_toggle.setChecked(False)
+        direct_toggle.stateChanged.connect(self.direct_analysis_toggle_clicked)
+        capture_grid.addWidget(direct_toggle, 1,i, 1,1)
+        i+=1
+
+        bus_text = QLabel("Frame Bus:", self)
+        bus_text.setFont(QFont(bus_text.font().family(), 12))
+        bus_text.setAlignment(Qt.AlignRight)
+        capture_grid.addWidget(bus_text, 1,i, 1,1)
+        i+=1
+
+        bus_toggle = QCheckBox("")
+        bus_toggle.setChecked(False)
+        bus_toggle.stateChanged.connect(self.frame_bus_toggle_clicked)
+        capture_grid.addWidget(bus_toggle, 1,i, 1,1)
+        i+=1
+
         capture_text = QLabel("Capture", self)
         capture_text.setFont(QFont(capture_text.font().family(), 24, QFont.Bold))
         capture_text.setAlignment(Qt.AlignCenter)
@@ -348,6 +422,36 @@ class main_window(QMainWindow):
         except:
             pass
 
+        binning_label = QLabel("Binning:", self)
+        binning_label.setFont(QFont(binning_label.font().family(), 12))
+        binning_label.setAlignment(Qt.AlignCenter)
+        capture_grid.addWidget(binning_label, 2,11, 1,1)
+
+        self.binning_input = QComboBox(self)
+        self.binning_input.addItems(["1x1", "2x2", "4x4"])
+        self.binning_input.activated[str].connect(self.binning_edit)
+        capture_grid.addWidget(self.binning_input, 2,12, 1,1)
+
+        roi_subarray_label = QLabel("Fit to ROIs:", self)
+        roi_subarray_label.setFont(QFont(roi_subarray_label.font().family(), 12))
+        roi_subarray_label.setAlignment(Qt.AlignRight)
+        capture_grid.addWidget(roi_subarray_label, 2,13, 1,1)
+
+        self.roi_subarray_toggle = QCheckBox("") # read out only the pixels around the ROIs
+        self.roi_subarray_toggle.setChecked(False)
+        self.roi_subarray_toggle.stateChanged.connect(self.roi_subarray_toggle_clicked)
+        capture_grid.addWidget(self.roi_subarray_toggle, 2,14, 1,1)
+
+        margin_label = QLabel("Margin:", self)
+        margin_label.setFont(QFont(margin_label.font().family(), 12))
+        margin_label.setAlignment(Qt.AlignCenter)
+        capture_grid.addWidget(margin_label, 2,15, 1,1)
+
+        self.roi_margin_input = QLineEdit(self) # pixels of background kept around the ROIs
+        self.roi_margin_input.setValidator(int_validator)
+        self.roi_margin_input.setText('10')
+        capture_grid.addWidget(self.roi_margin_input, 2,16, 1,1)
+
         capture_im_widget = pg.GraphicsLayoutWidget()
         capture_viewbox = capture_im_widget.addViewBox()
         self.capture_canvas = pg.ImageItem()
@@ -651,6 +755,13 @@ class main_window(QMainWindow):
         colormap_checkbox.stateChanged.connect(self.colormap_toggle_clicked)
         im_grid.addWidget(colormap_checkbox, 0,4, 1,1)
 
+        # choose between the last image and images accumulated over the run
+        self.im_display_input = QComboBox(self)
+        self.im_display_input.addItems(['Last image', 'Mean image', 'Mean with atom',
+                                        'Mean without atom', 'Std. dev. image'])
+        self.im_display_input.currentIndexChanged[int].connect(self.set_im_display)
+        im_grid.addWidget(self.im_display_input, 0,5, 1,1)
+
         # centre of ROI x position
         self.roi_labels = {}
         for i, X in enumerate(self.atomX):
@@ -757,24 +868,31 @@ class main_window(QMainWindow):
             pass
 
     def remove_im_files(self):
-        """Ask the user if they want to remove image files from the read image
-        path since the dir watcher only notices file created not modified"""
-        text = 'The directory watcher only notices file creation events, not modifications.\n'
-        text += 'Therefore the image read path must be emptied so new files can be created.\n'
-        text += '\nDelete the following files from '+self.dir_watcher.image_read_path+"?\n"
-        file_list = []
-        for file_name in os.listdir(self.dir_watcher.image_read_path):
-            if '.asc' in file_name:
-                file_list.append(file_name)
-                if len(file_list) < 10:
-                    text += "\t - " + file_name + "\n"
+        """Ask the user what to do with the image files already in the read 
+        image path, since the dir watcher only notices new files: process 
+        them (a backfill, before any new files), delete them, or ignore them.
+        Ignored files are put in the dir watcher's skip set."""
+        file_list = self.dir_watcher.existing_files()
+        if not file_list:
+            return
+        text = 'The directory watcher only notices new files, but there are already\n'
+        text += 'image files in '+self.dir_watcher.image_read_path+":\n"
+        for file_name in file_list[:9]:
+            text += "\t - " + file_name + "\n"
         text += '(Total %s files found.)\n'%len(file_list)
-
-        reply = QMessageBox.question(self, 'Remove Initial Image files?',
-            text, QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-        if reply == QMessageBox.Yes:
+        text += '\nProcess them in order before new files, delete them, or ignore them?'
+
+        msg = QMessageBox(QMessageBox.Question, 'Existing Image Files', text)
+        process_button = msg.addButton('Process', QMessageBox.AcceptRole)
+        delete_button = msg.addButton('Delete', QMessageBox.DestructiveRole)
+        msg.addButton('Ignore', QMessageBox.RejectRole)
+        msg.setDefaultButton(process_button)
+        msg.exec_()
+        if msg.clickedButton() == delete_button:
             for file_name in file_list:
                 os.remove(os.path.join(self.dir_watcher.image_read_path, file_name))
+        elif msg.clickedButton() != process_button:
+            self.dir_watcher.skip = set(file_list)
 
     def dw_mode_switch(self):
         """Change the dw_mode switch so that when in active mode it reads active,
@@ -790,8 +908,9 @@ class main_window(QMainWindow):
         background (which might overwrite files)."""
         if self.dir_watcher: # check if there is a current thread
             self.print_times("ms")  # prints performance of dir_watcher
-            self.dir_watcher.observer.stop() # ensure that the old thread stops
+            self.dir_watcher.stop() # ensure that the old thread stops
             self.dir_watcher = None
+            self.frame_bus.set_storage('', '') # only analyse frames from the bus
             self.dw_status_label.setText("Stopped")
             self.dw_init_button.setText('Initiate directory watcher') # turns on
             self.recent_label.setText('')
@@ -800,9 +919,13 @@ class main_window(QMainWindow):
             self.dir_watcher = dw.dir_watcher(
                     config_file=self.config_edit.text(),
                     active=self.dw_mode.isChecked()) # instantiate dir watcher
-            self.remove_im_files() # prompt to remove image files
+            self.remove_im_files() # prompt to process or remove image files
             self.dir_watcher.event_handler.event_path.connect(self.update_plot) # default
-            self.dir_watcher.event_handler.event_path.connect(self.update_im)
+            # start watching once the slots are connected, so that no files are missed.
+            # Files that arrived during the prompt are processed with the backfill
+            self.dir_watcher.start()
+            self.frame_bus.set_storage(self.dir_watcher.image_storage_path,
+                                       self.dir_watcher.event_handler.date)
             self.dw_status_label.setText("Running")
             # get current date
             self.date = self.dir_watcher.date
@@ -842,11 +965,30 @@ class main_window(QMainWindow):
         else:
             return None
 
-    def update_image(self):
-        latest_frame = self.get_latest_frame()
+    def update_image(self, latest_frame=None):
+        """Display the newest frame [HCamData, [frame_x, frame_y]] (taken from 
+        the camera if not supplied) and pass it on for analysis. Called from 
+        the frame delivery thread."""
+        if latest_frame is None:
+            latest_frame = self.get_latest_frame()
         if latest_frame != None:
-            img = np.reshape(latest_frame[0].getData(),(latest_frame[1][0], latest_frame[1][1])).T
-            self.capture_canvas.setImage(img)
+            # the camera buffer is row by row, transpose so that img[x, y]
+            img = np.reshape(latest_frame[0].getData(),(latest_frame[1][1], latest_frame[1][0])).T
+            if not self.display_pending: # skip drawing frames faster than the GUI can
+                self.display_pending = True
+                self.frame_display.emit(img)
+
+            if self.direct_analysis:
+                # hand the camera buffer straight to the image handlers. Only the
+                # newest frame is analysed: drop it if the last one is still in use
+                if self.frame_in_use is None and self.hcam.holdFrame(latest_frame[0]):
+                    self.frame_in_use = latest_frame[0]
+                    self.frame_ready.emit(latest_frame)
+                return True
+
+            if self.use_frame_bus: # analyse and archive a copy without writing it to the read path
+                self.publish_frame(np.array(img))
+                return True
 
             #PNG Method
             #from PIL import Image
@@ -855,43 +997,79 @@ class main_window(QMainWindow):
             #im.save(os.path.join(self.dir_watcher.image_read_path, 'img.png'))
 
             #Numpy Method
-            np.save(os.path.join(self.dir_watcher.image_read_path, 'img.npy'), img)
+            if self.dir_watcher:
+                np.save(os.path.join(self.dir_watcher.image_read_path, 'img.npy'), img)
             
             return True
         else:
             return False
 
+    def update_images(self, frames, dims):
+        """Pass on every one of the new frames (a list of HCamData of size 
+        dims = [frame_x, frame_y]) for analysis and display the newest, so 
+        that no triggered shot is dropped. Called from the frame delivery thread."""
+        for hc_data in frames:
+            if self.direct_analysis:
+                if self.hcam.holdFrame(hc_data): # released by the analysis worker
+                    self.frame_ready.emit([hc_data, dims])
+            elif self.use_frame_bus:
+                self.publish_frame(np.reshape(hc_data.getData(), (dims[1], dims[0])).T.copy())
+            elif self.dir_watcher:
+                # the camera buffer is row by row, transpose so that img[x, y]
+                img = np.reshape(hc_data.getData(), (dims[1], dims[0])).T
+                self.image_num += 1 # unique names so that files aren't overwritten before they're moved
+                np.save(os.path.join(self.dir_watcher.image_read_path, 'img%s.npy'%self.image_num), img)
+        if not self.display_pending: # skip drawing frames faster than the GUI can
+            self.display_pending = True
+            self.frame_display.emit(np.reshape(frames[-1].getData(), (dims[1], dims[0])).T)
+
+    def show_capture(self, img):
+        """Draw the image on the capture canvas (in the GUI thread)"""
+        self.capture_canvas.setImage(img)
+        self.display_pending = False
+
     def set_status_text(self, status):
         self.status_text.setText("Status: " + status)
 
     def start_live(self):
-        self.hcam.setACQMode("fixed_length", 1)
+        self.frame_thread.stop() # in case it's already running
+        self.hcam.setACQMode("run_till_abort")
+        self.fit_subarray_to_rois()
         self.set_trigger_internal()
         self.set_status_text("Capturing (Live)")
 
-        self.frame_thread = frameCheckThread.FrameCheckThreadTrigger(self)
+        self.frame_thread = frameCheckThread.FrameDeliveryThread(self) # newest frame only
         self.hcam.startAcquisition()
         self.frame_thread.start()
 
     def stop_live(self):
         self.frame_thread.stop()
-        self.set_status_text("Stopped")
+        stats = self.hcam.stats.summary()
+        self.set_status_text("Stopped (%d frames, %d missed, max backlog %d)" % (
+            stats['frames'], stats['missed'], stats['backlog max']))
 
     def start_external_capture(self):
-        self.hcam.setACQMode("fixed_length", 1)
+        """Keep acquiring with buffers attached once, taking a frame for each
+        trigger, and pass on every frame from the ring of buffers"""
+        self.frame_thread.stop() # in case it's already running
+        self.hcam.setACQMode("run_till_abort")
+        self.fit_subarray_to_rois()
         self.set_trigger_external()
         self.set_status_text("Capturing (External)")
 
-        self.frame_thread = frameCheckThread.FrameCheckThreadTrigger(self)
+        self.frame_thread = frameCheckThread.FrameDeliveryThread(self, every_frame=True)
         self.hcam.startAcquisition()
         self.frame_thread.start()
 
     def stop_external_capture(self):
         self.frame_thread.stop()
-        self.set_status_text("Stopped")
+        stats = self.hcam.stats.summary()
+        self.set_status_text("Stopped (%d frames, %d missed, max backlog %d)" % (
+            stats['frames'], stats['missed'], stats['backlog max']))
 
     def single_frame_capture(self):
         self.hcam.setACQMode("fixed_length", 1)
+        self.fit_subarray_to_rois()
         self.set_trigger_internal()
 
         self.hcam.startAcquisition()
@@ -902,6 +1080,7 @@ class main_window(QMainWindow):
         self.trigger_mode = "external"
 
         self.hcam.setPropertyValue("trigger_source", camera_try.DCAMPROP_TRIGGERSOURCE__EXTERNAL)
+        self.hcam.setPropertyValue("trigger_active", camera_try.DCAMPROP_TRIGGERACTIVE__EDGE) # one frame per trigger
         self.hcam.setPropertyValue("trigger_mode", camera_try.DCAMPROP_TRIGGER_MODE__NORMAL)
         self.hcam.setPropertyValue("trigger_polarity", camera_try.DCAMPROP_TRIGGERPOLARITY__POSITIVE)
 
@@ -917,6 +1096,15 @@ class main_window(QMainWindow):
         else:
             self.threshold_reset = True
     
+    def direct_analysis_toggle_clicked(self):
+        if self.direct_analysis:
+            self.direct_analysis = False
+        else:
+            self.direct_analysis = True
+
+    def frame_bus_toggle_clicked(self):
+        self.use_frame_bus = not self.use_frame_bus
+
     def colormap_toggle_clicked(self):
         if self.colormap_toggle:
             self.colormap_toggle = False
@@ -924,23 +1112,129 @@ class main_window(QMainWindow):
             self.colormap_toggle = True
 
     def sub_array_x_edit(self, input):
-        input = int(input)
-        if(input != None and input < self.hcam.maxWidth and input < 0):
-            self.hcam.setPropertyValue("subarray_hsize", input)
-        else:
-            self.hcam.setPropertyValue("subarray_hsize", int(self.hcam.maxWidth))
-        self.hcam.setSubArrayMode()
+        """Set the width of the camera subarray, or the full width if
+        the input is out of range."""
+        try:
+            width = int(input)
+        except ValueError:
+            return # the text is empty while the user is typing
+        if not (0 < width <= self.hcam.max_width):
+            width = int(self.hcam.max_width)
+        if width != self.hcam.getPropertyValue("subarray_hsize")[0]: # cached
+            self.hcam.setPropertyValue("subarray_hsize", width)
+            self.hcam.setSubArrayMode()
 
     def sub_array_y_edit(self, input):
-        input = int(input)
-        if(input != None and input < self.hcam.maxWidth and input < 0):
-            self.hcam.setPropertyValue("subarray_vsize", input)
+        """Set the height of the camera subarray, or the full height if
+        the input is out of range."""
+        try:
+            height = int(input)
+        except ValueError:
+            return
+        if not (0 < height <= self.hcam.max_height):
+            height = int(self.hcam.max_height)
+        if height != self.hcam.getPropertyValue("subarray_vsize")[0]:
+            self.hcam.setPropertyValue("subarray_vsize", height)
+            self.hcam.setSubArrayMode()
+
+    def binning_edit(self, text):
+        """Set the camera binning, keeping the ROIs on the same sensor pixels."""
+        if self.frame_thread.is_alive():
+            self.binning_input.setCurrentIndex(self.binning_input.findText(
+                "%dx%d" % (self.get_binning(), self.get_binning())))
+            self.set_status_text("Stop capturing before changing the binning")
+            return
+        self.set_camera_window(self.hcam.getSubArray(), text)
+        self.fit_subarray_to_rois()
+
+    def get_binning(self):
+        """Return the camera binning as the number of sensor pixels along
+        each side of an image pixel."""
+        return int(self.hcam.getPropertyValue("binning")[0])
+
+    def roi_subarray_toggle_clicked(self):
+        """Read out the smallest subarray that covers the ROIs, or go back to
+        the full sensor. Applied now if the camera is stopped, otherwise the
+        next time capture starts."""
+        if self.frame_thread.is_alive():
+            self.set_status_text("ROI subarray will be applied when capture restarts")
+        elif self.roi_subarray_toggle.isChecked():
+            self.fit_subarray_to_rois()
         else:
-            self.hcam.setPropertyValue("subarray_vsize", int(self.hcam.maxHeight))
-        self.hcam.setSubArrayMode()
+            self.set_camera_window([0, self.hcam.max_width, 0, self.hcam.max_height])
+
+    def fit_subarray_to_rois(self):
+        """If the Fit to ROIs box is checked, set the camera subarray to the
+        bounding box of all of the ROIs plus the margin of background pixels,
+        so that the readout time and the data per frame scale with the ROIs
+        rather than the sensor."""
+        if not self.roi_subarray_toggle.isChecked():
+            return
+        try:
+            margin = int(self.roi_margin_input.text())
+        except ValueError:
+            margin = 0
+        hpos, _, vpos, _ = self.hcam.getSubArray()
+        binning = self.get_binning()
+        lo, hi = [], [] # corners of the ROIs in image pixels
+        for ih in self.image_handler:
+            lo.append([ih.xc - ih.roi_size//2, ih.yc - ih.roi_size//2])
+            hi.append([ih.xc + ih.roi_size//2 + ih.roi_size%2, ih.yc + ih.roi_size//2 + ih.roi_size%2])
+        x0, y0 = (np.min(lo, axis=0) - margin) * binning + [hpos, vpos] # sensor pixels
+        x1, y1 = (np.max(hi, axis=0) + margin) * binning + [hpos, vpos]
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.hcam.max_width), min(y1, self.hcam.max_height)
+        if x1 <= x0 or y1 <= y0:
+            self.set_status_text("ROIs are outside of the sensor, subarray not changed")
+            return
+        self.set_camera_window([int(x0), int(x1 - x0), int(y0), int(y1 - y0)])
+
+    def set_camera_window(self, window, binning=None):
+        """Set the camera subarray window [hpos, hsize, vpos, vsize] in sensor
+        pixels and optionally the binning text (e.g. '2x2'), then shift and
+        scale the ROIs and the array site ROIs so that they stay on the same
+        sensor pixels in the new images. The array site counts are cleared.
+        If the window moved, the cached pixels of the image handlers are 
+        dropped, so recounting is off until the histograms are reset."""
+        old_hpos, _, old_vpos, _ = self.hcam.getSubArray()
+        old_binning = self.get_binning()
+        if binning is not None:
+            self.hcam.setPropertyValue("binning", binning)
+        hpos, hsize, vpos, vsize = self.hcam.setSubArray(*window)
+        new_binning = self.get_binning()
+        def to_new(xc, yc, size): # same sensor pixels in the new image coordinates
+            xs = old_hpos + (xc + 0.5) * old_binning # centre of the ROI in sensor pixels
+            ys = old_vpos + (yc + 0.5) * old_binning
+            return [int((xs - hpos) // new_binning), int((ys - vpos) // new_binning),
+                    max(int(round(size * old_binning / new_binning)), 1)]
+        dims = []
+        with self.analysis.lock:
+            for ih in self.image_handler:
+                dims.append(to_new(ih.xc, ih.yc, ih.roi_size))
+                ih.set_roi(dimensions=dims[-1])
+                if [hpos, vpos, new_binning] != [old_hpos, old_vpos, old_binning]:
+                    ih.cache = None # the cached pixels are from other sensor pixels
+            site_handler = self.analysis.site_handler
+            if site_handler is not None: # the site counts are cleared
+                site_handler.set_rois([to_new(*roi) for roi in site_handler.rois])
+                if site_handler.psf is not None:
+                    site_handler.set_psf(*[p * old_binning / new_binning for p in site_handler.psf])
+        for i, new_dim in enumerate(dims):
+            for j in range(len(new_dim)):
+                text = self.atomX[i] + self.roi_label_text[j]
+                self.roi_labels[text].setText(text + str(new_dim[j]))
+                self.roi_edits[text].setText(str(new_dim[j]))
+            self.rois[i].setPos(new_dim[0] - new_dim[2]//2, new_dim[1] - new_dim[2]//2, finish=False)
+            self.rois[i].setSize([new_dim[2], new_dim[2]], finish=False)
+        self.xsize_input.setText(str(hsize)) # already set, so these don't write to the camera
+        self.ysize_input.setText(str(vsize))
+        self.set_status_text("Stopped (subarray %d x %d at (%d, %d), binning %d)" % (
+            hsize, vsize, hpos, vpos, new_binning))
 
     def exposure_time_edit(self, input):
-        self.hcam.setPropertyValue("exposure_time", float(input))
+        try:
+            self.hcam.setPropertyValue("exposure_time", float(input))
+        except ValueError: pass # the text is empty or incomplete
 
     #### #### user input functions #### ####
 
@@ -970,12 +1264,50 @@ class main_window(QMainWindow):
         xc, yc = int(x0 + l//2), int(y0 + l//2)  # centre
 
         new_dim = [xc, yc, l]  # new dimensions for ROI
-        self.image_handler[roi_idx].set_roi(dimensions=new_dim)
+        self.recount_roi(roi_idx, new_dim)
         for i in range(len(new_dim)):
             text = self.atomX[roi_idx] + self.roi_label_text[i]
             self.roi_labels[text].setText(text + str(new_dim[i]))
             self.roi_edits[text].setText(str(new_dim[i]))
 
+    def recount_roi(self, roi_idx, new_dim):
+        """Set the ROI [xc, yc, l] of image handler roi_idx. If the new ROI 
+        is inside the pixels cached around the old one, recalculate the 
+        counts of the images so far and redraw the histogram."""
+        im_han = self.image_handler[roi_idx]
+        with self.analysis.lock:
+            recounted = im_han.recount(new_dim) and im_han.im_num > 0
+        if recounted:
+            self.plot_current_hist([im_han.histogram if self.thresh_toggle.isChecked()
+                                    else im_han.hist_and_thresh])
+
+    def roi_sweep(self):
+        """Find the fidelity of ROIs with different sizes and positions around
+        the current ROI, using the counts of the images so far, then ask the
+        user whether to use the best one."""
+        for roi_idx, im_han in enumerate(self.image_handler):
+            t0 = time.time()
+            with self.analysis.lock:
+                results = im_han.roi_sweep()
+            if not np.size(results):
+                continue # no cached images for this ROI
+            text = '%s ROIs tested in %.3g s. Best ROIs (xc, yc, size: fidelity):\n'%(
+                    np.size(results), time.time() - t0)
+            text += '\n'.join(['%s, %s, %s: %.4g +/- %.2g'%(r['xc'], r['yc'], r['roi_size'], 
+                    r['fidelity'], r['err_fidelity']) for r in results[:5]])
+            text += '\n\nUse the best ROI?'
+            reply = QMessageBox.question(self, self.atomX[roi_idx] + 'ROI sweep',
+                text, QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if reply == QMessageBox.Yes:
+                new_dim = [int(results[0][k]) for k in ['xc', 'yc', 'roi_size']]
+                self.recount_roi(roi_idx, new_dim)
+                for i in range(len(new_dim)):
+                    text = self.atomX[roi_idx] + self.roi_label_text[i]
+                    self.roi_labels[text].setText(text + str(new_dim[i]))
+                    self.roi_edits[text].setText(str(new_dim[i]))
+                self.rois[roi_idx].setPos(new_dim[0] - new_dim[2]//2, new_dim[1] - new_dim[2]//2, finish=False)
+                self.rois[roi_idx].setSize([new_dim[2], new_dim[2]], finish=False)
+
     def pic_size_text_edit(self, text):
         """Update the specified size of an image in pixels when the user
         edits the text in the line edit widget"""
@@ -1056,7 +1388,7 @@ class main_window(QMainWindow):
         if int(new_dim[2]) == 0:
             new_dim[2] = 1 # can't have zero width
 
-        self.image_handler[roi_idx].set_roi(dimensions=list(map(int, new_dim)))
+        self.recount_roi(roi_idx, list(map(int, new_dim)))
         for i in range(len(new_dim)):
             text = self.atomX[roi_idx] + self.roi_label_text[i]
             self.roi_labels[text].setText(text + str(new_dim[i]))
@@ -1110,8 +1442,9 @@ class main_window(QMainWindow):
             if self.thresh_toggle.isChecked():
                 try:
                     # get threshold from QLineEdit
-                    self.image_handler[idx].thresh = float(
-                            self.hist_edits[key[:3]+self.hist_label_text[3]].text())
+                    thresh = float(self.hist_edits[key[:3]+self.hist_label_text[3]].text())
+                    with self.analysis.lock:
+                        self.image_handler[idx].thresh = thresh
                     # show the new threshold in the label
                     self.stat_labels[key[:3]+'Threshold'].setText(
                             str(int(self.image_handler[idx].thresh)))
@@ -1292,7 +1625,7 @@ class main_window(QMainWindow):
                 self.hist_canvas[idx].plot(xs, bf.gauss(xs, *bf.ps), pen='b') # plot best fit
 
             # update atom statistics
-            im_han.atom[:im_han.im_num] = im_han.counts[:im_han.im_num] // im_han.thresh   # update atom presence
+            im_han.update_atoms()   # update atom presence
             atom_array = im_han.atom[:im_han.im_num]
             atom_list.append(atom_array)
             above_idxs = np.where(atom_array > 0)[0] # index of images with counts above threshold
@@ -1475,18 +1808,25 @@ class main_window(QMainWindow):
             except Exception: pass # if already disconnected
             if self.dir_watcher:
                 self.dir_watcher.event_handler.event_path.connect(self.update_plot)
+        self.set_bus_mode()
 
     def set_im_show(self, toggle):
         """If the toggle is True, always update the widget with the last image.
-        Note that disconnecting all slots means that this toggle might have to
-        be reset when other buttons are pressed."""
-        if self.dir_watcher:
-            if toggle:
-                self.dir_watcher.event_handler.event_path.connect(self.update_im)
-            else:
-                try: # note: it could have been connected several times... need while True: ... break
-                    self.dir_watcher.event_handler.event_path.disconnect(self.update_im)
-                except Exception: pass # if it's already been disconnected
+        The analysis worker sends the last image with its results."""
+        self.analysis.show_im = toggle
+
+    def set_im_display(self, idx):
+        """Choose whether the last image or an image accumulated over all of
+        the images so far is displayed. Images are only accumulated while an
+        accumulated image is chosen, starting from when it is chosen. 
+        Accumulated images are updated at most once every 
+        analysis.acc_refresh seconds."""
+        display = ['last', 'mean', 'atom', 'empty', 'std'][idx]
+        with self.analysis.lock:
+            if self.analysis.display == 'last' and display != 'last':
+                self.analysis.accumulator.reset()
+            self.analysis.display = display
+        self.analysis.last_acc = 0 # show the new choice straight away
 
     def swap_signals(self):
         """Disconnect the image_handler process signal from the dir_watcher event
@@ -1514,6 +1854,7 @@ class main_window(QMainWindow):
                 if self.multirun_save_dir.text() == '':
                     self.choose_multirun_dir()
                 self.dir_watcher.event_handler.event_path.connect(self.multirun_step)
+                self.set_bus_mode() # frames on the bus also go to multirun_step once saved
                 self.mr['# omit'] = int(self.omit_edit.text()) # number of files to omit
                 self.mr['# hist'] = int(self.multirun_hist_size.text()) # number of files in histogram
                 self.mr['o'], self.mr['h'], self.mr['v'] = 0, 0, 0 # counters for different stages of multirun
@@ -1547,6 +1888,7 @@ class main_window(QMainWindow):
             except Exception: pass # already disconnected
             if self.dir_watcher:
                 self.dir_watcher.event_handler.event_path.connect(self.multirun_step)
+                self.set_bus_mode()
 
     def set_bins(self, action=None):
         """Check which of the bin action menu bar options is checked.
@@ -1581,8 +1923,41 @@ class main_window(QMainWindow):
                     self.dir_watcher.event_handler.event_path.connect(self.recent_label.setText) # might need a better label
                     # just process the image
                     if self.bin_actions[2].isChecked():
-                        for im_han in self.image_handler:
-                            self.dir_watcher.event_handler.event_path.connect(im_han.process)
+                        self.dir_watcher.event_handler.event_path.connect(self.process_only)
+                    else: # the file isn't needed
+                        self.dir_watcher.event_handler.event_path.connect(self.dir_watcher.release)
+        self.set_bus_mode()
+
+    def publish_frame(self, img):
+        """Publish a copy of a frame on the frame bus. Called from the frame
+        delivery thread, so if the threshold reset was triggered the data
+        are reset here and the histogram is redrawn with the next results."""
+        if self.in_reset:
+            self.in_reset = False
+            self.reset_analysis()
+        self.frame_bus.publish(img)
+
+    def set_bus_mode(self):
+        """Make the frame bus hand frames on in the same way as the slots
+        connected to the dir watcher: during a multi-run the archived files
+        go to multirun_step, otherwise the frames are analysed in memory
+        with or without updating the threshold, or not at all for No Update."""
+        try: # disconnect all slots
+            self.frame_bus.archived.disconnect()
+        except Exception: pass # already disconnected
+        if self.multirun_switch.isChecked():
+            self.frame_bus.analyse = False
+            self.frame_bus.archived.connect(self.multirun_step)
+        elif self.bin_actions[3].isChecked(): # No Update
+            self.frame_bus.analyse = False
+        else:
+            self.frame_bus.analyse = True
+            if self.bin_actions[2].isChecked(): # No Display
+                self.frame_bus.mode = None
+            elif self.thresh_toggle.isChecked():
+                self.frame_bus.mode = 'fixed'
+            else:
+                self.frame_bus.mode = 'thresh'
 
     #### #### canvas functions #### ####
 
@@ -1593,39 +1968,39 @@ class main_window(QMainWindow):
         threshold value."""
         # update the histogram and threshold estimate
         for hf in hist_functions:
-            bins, occ, thresh = hf()
             idx = np.where([x.histogram == hf or x.hist_and_thresh == hf
                     for x in self.image_handler])[0][0]
+            im_han = self.image_handler[idx]
+            with self.analysis.lock:
+                bins, occ, thresh = hf()
+                count, atom = im_han.get_latest_count(), im_han.atom[im_han.im_num-1]
+            self.plot_hist(idx, bins, occ, thresh, count, atom if im_han.im_num else None)
+
+    def plot_hist(self, idx, bins, occ, thresh, count=0, atom=None):
+        """Plot the histogram with bin edges bins and occupancy occ and the 
+        threshold on the canvas for image handler idx. count and atom are 
+        the count and atom presence of the latest image (None if there are
+        no images), taken with the histogram so that they match."""
+        self.hist_canvas[idx].clear()
+        self.hist_canvas[idx].plot(bins, occ, stepMode=True, pen='k',
+                                fillLevel=0, brush = (220,220,220,220)) # histogram
+        self.hist_canvas[idx].plot([thresh]*2, [0, max(occ)], pen='r') # threshold line
+
+        # Update counts text
+        self.update_counts_label(count)
+
+        # Checks if counts are below threshold if option is checked
+        if self.threshold_reset and self.threshold_check(atom):
+            self.histogram_status.setText("Reset")
+            self.histogram_status.setStyleSheet("background-color: red") 
+            self.in_reset = True
+        else:
+            self.histogram_status.setText("Running")
+            self.histogram_status.setStyleSheet("background-color: lightgreen") 
 
-            self.hist_canvas[idx].clear()
-            self.hist_canvas[idx].plot(bins, occ, stepMode=True, pen='k',
-                                    fillLevel=0, brush = (220,220,220,220)) # histogram
-            self.hist_canvas[idx].plot([thresh]*2, [0, max(occ)], pen='r') # threshold line
-
-            # Update counts text
-            self.update_counts_label(idx)
-
-            # Checks if counts are below threshold if option is checked
-            if self.threshold_reset and self.threshold_check(idx):
-                self.histogram_status.setText("Reset")
-                self.histogram_status.setStyleSheet("background-color: red") 
-                self.in_reset = True
-            else:
-                self.histogram_status.setText("Running")
-                self.histogram_status.setStyleSheet("background-color: lightgreen") 
-
-    def threshold_check(self, index):
-        im_han = self.image_handler[index]
-        # Finds location of the newest run
-        run_number = -1
-        for x in im_han.files:
-            if x:
-                run_number += 1
-            else:
-                break
-
+    def threshold_check(self, atom):
         # Checks if latest run is above threshold
-        if im_han.atom[run_number] < 1:
+        if atom is not None and atom < 1:
             self.reset_sequence()
             return True
     
@@ -1635,9 +2010,17 @@ class main_window(QMainWindow):
             self.in_reset = False
     
     def reset_data(self):
-        self.image_handler[0].reset_arrays()
+        self.reset_analysis()
         self.hist_canvas[0].clear()   
 
+    def reset_analysis(self):
+        """Clear the data in the image handlers, which is safe from any thread"""
+        with self.analysis.lock:
+            self.image_handler[0].reset_arrays()
+            if self.analysis.site_handler is not None:
+                self.analysis.site_handler.reset_arrays()
+            self.analysis.accumulator.reset()
+
     def reset_sequence(self):
         print("Data below threshold. Reseting sequence")
         # Creates a unique file to save in tje filewatch location
@@ -1648,14 +2031,16 @@ class main_window(QMainWindow):
         file.write(time_with_code)
         file.close()
 
-    def update_counts_label(self, idx):
-        self.counts_label.setText("Counts: " + str(self.image_handler[idx].get_latest_count()))
+    def update_counts_label(self, count):
+        self.counts_label.setText("Counts: " + str(count))
 
     def update_im(self, event_path):
         """Receive the event path emitted from the system event handler signal
         display the image from the file in the image canvas""" 
-        im_vals = self.image_handler[0].load_full_im(event_path)
-        
+        self.show_im(self.image_handler[0].load_full_im(event_path))
+
+    def show_im(self, im_vals):
+        """Display the image array im_vals in the image canvas"""
         # Apply jet colormap
         if self.colormap_toggle: 
             colormap = cm.get_cmap("jet")           
@@ -1669,40 +2054,72 @@ class main_window(QMainWindow):
         self.im_hist.setLevels(np.min(im_vals), np.max(im_vals))
         self.pic_size_label.setText(str(self.image_handler[0].pic_size))
 
+    def analyse_frame(self, frame):
+        """Receive a frame [HCamData, [frame_x, frame_y]] held from the camera
+        buffers by update_image and queue it for the analysis worker, which
+        processes it in place then releases it back to the camera"""
+        self.reset_data_check()
+        hc_data, [frame_x, frame_y] = frame
+        img = np.reshape(hc_data.getData(), (frame_y, frame_x)).T
+        self.frame_num += 1
+        mode = 'fixed' if self.thresh_toggle.isChecked() else 'thresh'
+        self.queue_image(img, str(self.frame_num), mode, 
+                        lambda: self.release_frame(hc_data))
+
+    def release_frame(self, hc_data):
+        """Release the frame held for analysis back to the camera. Returns False
+        if the camera overwrote the frame while it was being processed."""
+        self.frame_in_use = None
+        return self.hcam.releaseFrame(hc_data)
+
+    def queue_image(self, image, label=None, mode='thresh', release=None):
+        """Queue an image for the analysis worker without blocking the GUI.
+        If the queue is full the image is dropped, counted in 
+        analysis.dropped, and released straight away."""
+        try:
+            self.analysis.add(image, label, mode, release, block=False)
+        except queue.Full:
+            self.analysis.dropped += 1
+            if release is not None:
+                release()
+
+    def file_release(self, event_path):
+        """Return a function that tells the dir watcher that emitted the file
+        event_path that it has been processed, so the staged file can be
+        deleted once it's archived"""
+        dir_watcher = self.dir_watcher
+        return lambda: dir_watcher.release(event_path)
+
     def update_plot(self, event_path):
         """Receive the event path emitted from the system event handler signal
-        process the file in the event path with the image handler and update
-        the figure"""
+        and queue the file for the analysis worker, which processes it with the
+        image handlers and sends back the histogram to update the figure"""
         self.reset_data_check()
-        
-        # add the count
-        t1 = time.time()
-        for im_han in self.image_handler:
-            im_han.process(event_path)
-        t2 = time.time()
-        self.int_time = t2 - t1
-        
-        # display the name of the most recent file
-        self.recent_label.setText('Just processed: '+os.path.basename(event_path))
-        self.plot_current_hist([x.hist_and_thresh for x in self.image_handler]) # update the displayed plot
-        self.plot_time = time.time() - t2
+        self.queue_image(event_path, mode='thresh', release=self.file_release(event_path))
 
     def update_plot_only(self, event_path):
         """Receive the event path emitted from the system event handler signal
-        process the file in the event path with the image handler and update
-        the figure but without changing the threshold value"""
-        # add the count
+        and queue the file for the analysis worker, which sends back the 
+        histogram to update the figure but without changing the threshold value"""
         self.reset_data_check()
-        
-        t1 = time.time()
-        for im_han in self.image_handler:
-            im_han.process(event_path)
+        self.queue_image(event_path, mode='fixed', release=self.file_release(event_path))
+
+    def process_only(self, event_path):
+        """Receive the event path emitted from the system event handler signal
+        and queue the file to be processed without updating the figure"""
+        self.queue_image(event_path, mode=None, release=self.file_release(event_path))
+
+    def plot_results(self, results):
+        """Receive the results emitted by the analysis worker and display them:
+        the histograms, latest counts, and the last image"""
         t2 = time.time()
-        self.int_time = t2 - t1
-        
+        self.int_time = results['int_time']
         # display the name of the most recent file
-        self.recent_label.setText('Just processed: '+os.path.basename(event_path))
-        self.plot_current_hist([x.histogram for x in self.image_handler]) # update the displayed plot
+        self.recent_label.setText('Just processed: '+results['name'])
+        for idx, hist in enumerate(results['hists']):
+            self.plot_hist(idx, hist['bins'], hist['occ'], hist['thresh'], hist['count'], hist['atom'])
+        if results['image'] is not None:
+            self.show_im(results['image'])
         self.plot_time = time.time() - t2
 
     def multirun_step(self, event_path):
@@ -1719,8 +2136,9 @@ class main_window(QMainWindow):
             elif self.mr['h'] < self.mr['# hist']: # add to histogram
                 # add the count to the histogram
                 t1 = time.time()
-                for im_han in self.image_handler:
-                    im_han.process(event_path)
+                with self.analysis.lock:
+                    for im_han in self.image_handler:
+                        im_han.process(event_path)
                 t2 = time.time()
                 self.int_time = t2 - t1
                 # display the name of the most recent file
@@ -1744,10 +2162,14 @@ class main_window(QMainWindow):
                         self.multirun_save_dir.text(), self.mr['prefix'])
                             + '_' + str(self.mr['v']) + '.csv',
                     confirm=False)# save histogram
-                for im_han in self.image_handler:
-                    im_han.reset_arrays() # clear histogram
+                with self.analysis.lock:
+                    for im_han in self.image_handler:
+                        im_han.reset_arrays() # clear histogram
                 self.mr['v'] += 1 # increment counter
 
+        if self.dir_watcher: # the staged file can be deleted once it's archived
+            self.dir_watcher.release(event_path)
+
         if self.mr['v'] == np.size(self.mr['var list']):
             self.save_varplot(
                 save_file_name=os.path.join(
@@ -1856,9 +2278,9 @@ class main_window(QMainWindow):
         default_path = self.get_default_path(option='im')
         try:
             if 'PyQt4' in sys.modules:
-                file_name = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc);;all (*)')
+                file_name = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc *.npy *.raw *.tif *.tiff);;all (*)')
             elif 'PyQt5' in sys.modules:
-                file_name, _ = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc);;all (*)')
+                file_name, _ = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc *.npy *.raw *.tif *.tiff);;all (*)')
             for im_han in self.image_handler:
                 im_han.set_pic_size(file_name) # sets image handler's pic size
                 self.pic_size_edit.setText(str(im_han.pic_size)) # update loaded value
@@ -1872,16 +2294,17 @@ class main_window(QMainWindow):
         default_path = self.get_default_path(option='im')
         try:
             if 'PyQt4' in sys.modules:
-                file_name = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc);;all (*)')
+                file_name = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc *.npy *.raw *.tif *.tiff);;all (*)')
             elif 'PyQt5' in sys.modules:
-                file_name, _ = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc);;all (*)')
+                file_name, _ = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc *.npy *.raw *.tif *.tiff);;all (*)')
             # get pic size from this image in case the user forgot to set it
             for i in range(len(self.atomX)):  # loop over atomic species
                 self.image_handler[i].set_pic_size(file_name) # sets image handler's pic size
                 self.pic_size_edit.setText(str(self.image_handler[i].pic_size)) # update loaded value
                 self.pic_size_label.setText(str(self.image_handler[i].pic_size)) # update loaded value
                 # get the position of the max count
-                self.image_handler[i].set_roi(im_name=file_name) # sets xc and yc
+                with self.analysis.lock:
+                    self.image_handler[i].set_roi(im_name=file_name) # sets xc and yc
                 self.roi_edits[self.atomX[i]+self.roi_label_text[0]].setText(str(self.image_handler[i].xc)) # update loaded value
                 self.roi_edits[self.atomX[i]+self.roi_label_text[1]].setText(str(self.image_handler[i].yc))
                 self.roi_edits[self.atomX[i]+self.roi_label_text[2]].setText(str(self.image_handler[i].roi_size))
@@ -1895,6 +2318,113 @@ class main_window(QMainWindow):
             pass # user cancelled - file not found
 
 
+    def load_site_rois(self):
+        """Get the user to select a csv file of ROIs (xc, yc, size) for the
+        sites of an array. The counts of all of the sites are then taken from
+        each image processed by the analysis worker."""
+        default_path = self.get_default_path()
+        try:
+            if 'PyQt4' in sys.modules:
+                file_name = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'csv(*.csv);;all (*)')
+            elif 'PyQt5' in sys.modules:
+                file_name, _ = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'csv(*.csv);;all (*)')
+            site_handler = ih.multi_site_handler()
+            site_handler.load_rois(file_name)
+            with self.analysis.lock:
+                self.analysis.site_handler = site_handler
+            self.recent_label.setText('Loaded %s array ROIs'%len(site_handler.rois))
+        except (OSError, ValueError):
+            pass # user cancelled - file not found
+
+    def save_site_rois(self):
+        """Save the array ROIs (xc, yc, size) to a csv file"""
+        if self.analysis.site_handler is None:
+            return
+        default_path = self.get_default_path()
+        try:
+            if 'PyQt4' in sys.modules:
+                file_name = QFileDialog.getSaveFileName(self, 'Save File', default_path, 'csv(*.csv);;all (*)')
+            elif 'PyQt5' in sys.modules:
+                file_name, _ = QFileDialog.getSaveFileName(self, 'Save File', default_path, 'csv(*.csv);;all (*)')
+            if file_name:
+                self.analysis.site_handler.save_rois(file_name)
+        except OSError:
+            pass # user cancelled - file not found
+
+    def save_site_counts(self):
+        """Save the counts of every site of the array in each image to csv"""
+        if self.analysis.site_handler is None:
+            return
+        default_path = self.get_default_path()
+        try:
+            if 'PyQt4' in sys.modules:
+                file_name = QFileDialog.getSaveFileName(self, 'Save File', default_path, 'csv(*.csv);;all (*)')
+            elif 'PyQt5' in sys.modules:
+                file_name, _ = QFileDialog.getSaveFileName(self, 'Save File', default_path, 'csv(*.csv);;all (*)')
+            if file_name:
+                with self.analysis.lock:
+                    self.analysis.site_handler.save_state(file_name)
+        except OSError:
+            pass # user cancelled - file not found
+
+    def fit_site_psf(self):
+        """Get the user to select images with atoms loaded in the array, fit
+        a Gaussian PSF to their average over the sites, then weight the
+        pixels of each site by the PSF when counting. This clears the array
+        counts."""
+        if self.analysis.site_handler is None:
+            return
+        default_path = self.get_default_path(option='im')
+        try:
+            if 'PyQt4' in sys.modules:
+                file_list = QFileDialog.getOpenFileNames(self,
+                    'Select Files', default_path, 'Images(*.asc *.npy *.npz *.raw *.tif *.tiff);;all (*)')
+            elif 'PyQt5' in sys.modules:
+                file_list, _ = QFileDialog.getOpenFileNames(self,
+                    'Select Files', default_path, 'Images(*.asc *.npy *.npz *.raw *.tif *.tiff);;all (*)')
+            if not file_list:
+                return
+            mean_im = np.zeros(np.shape(ih.load_image(file_list[0])))
+            for file_name in file_list:
+                mean_im += ih.load_image(file_name)
+            mean_im /= len(file_list)
+            with self.analysis.lock:
+                wx, wy, x0, y0 = self.analysis.site_handler.fit_psf(mean_im)
+            self.recent_label.setText('Array PSF widths %.3g, %.3g'%(wx, wy))
+        except (OSError, ValueError, RuntimeError) as e: # RuntimeError if the fit fails
+            print('\n WARNING: could not fit the array PSF: '+str(e))
+
+    def uniform_site_counts(self):
+        """Count all of the pixels in each site equally. This clears the 
+        array counts."""
+        if self.analysis.site_handler is None:
+            return
+        with self.analysis.lock:
+            self.analysis.site_handler.set_psf()
+
+    def fit_site_thresh(self):
+        """Set the threshold of each site of the array from the histogram
+        of its counts so far"""
+        if self.analysis.site_handler is None:
+            return
+        with self.analysis.lock:
+            thresh = self.analysis.site_handler.fit_thresh()
+        self.recent_label.setText('Array thresholds %.4g - %.4g'%(np.min(thresh), np.max(thresh)))
+
+    def set_site_thresh(self):
+        """Get the user to enter a threshold to use for every site of the array"""
+        if self.analysis.site_handler is None:
+            return
+        text, ok = QInputDialog.getText(self, 'Set array threshold', 'Threshold (counts): ',
+            text='%.6g'%np.mean(self.analysis.site_handler.thresh))
+        if ok:
+            try:
+                thresh = float(text)
+            except ValueError:
+                return # not a number
+            with self.analysis.lock:
+                self.analysis.site_handler.thresh = thresh
+
     def save_hist_data(self, trigger=None, atoms=range(2), save_file_name='', confirm=True):
         """Prompt the user to give a directory to save the histogram data, then save
         atoms specifies which histograms to save, referring to the indices of self.atomX"""
@@ -1988,15 +2518,23 @@ class main_window(QMainWindow):
             if 'Save' in choice: # prompt user for file name then save
                 if self.save_hist_data(atoms=idxs):
                     # only reset the histograms if the save was successful
-                    for i in idxs:
-                        self.image_handler[i].reset_arrays() # get rid of old data
-                        self.hist_canvas[i].clear() # remove old histogram from display
+                    self.reset_handlers(idxs)
             else:
-                for i in idxs:
-                    self.image_handler[i].reset_arrays() # get rid of old data
-                    self.hist_canvas[i].clear() # remove old histogram from display
+                self.reset_handlers(idxs)
         return choice, ok, idxs
 
+    def reset_handlers(self, idxs):
+        """Clear the data in the image handlers with indexes idxs and the
+        accumulated images, holding the analysis lock since the analysis
+        worker could be processing an image at the same time."""
+        with self.analysis.lock:
+            for i in idxs:
+                self.image_handler[i].reset_arrays() # get rid of old data
+            if len(idxs):
+                self.analysis.accumulator.reset()
+        for i in idxs:
+            self.hist_canvas[i].clear() # remove old histogram from display
+
     def load_empty_hist(self):
         """Prompt the user with options to save the data and then reset the
         histogram"""
@@ -2008,13 +2546,9 @@ class main_window(QMainWindow):
             return 0
         elif reply == QMessageBox.Yes:
             self.save_hist_data()  # prompt user for file name then save
-            for idx in range(len(self.image_handler)):
-                self.image_handler[idx].reset_arrays() # get rid of old data
-                self.hist_canvas[idx].clear() # remove old histogram from display
+            self.reset_handlers(range(len(self.image_handler)))
         elif reply == QMessageBox.No:
-            for idx in range(len(self.image_handler)):
-                self.image_handler[idx].reset_arrays() # get rid of old data
-                self.hist_canvas[idx].clear() # remove old histogram from display
+            self.reset_handlers(range(len(self.image_handler)))
 
 
     def load_from_files(self, trigger=None):
@@ -2027,18 +2561,11 @@ class main_window(QMainWindow):
                 self.recent_label.setText('Processing files...') # comes first otherwise not executed
                 if 'PyQt4' in sys.modules:
                     file_list = QFileDialog.getOpenFileNames(self,
-                        'Select Files', default_path, 'Images(*.asc);;all (*)')
+                        'Select Files', default_path, 'Images(*.asc *.npy *.raw *.tif *.tiff);;all (*)')
                 elif 'PyQt5' in sys.modules:
                     file_list, _ = QFileDialog.getOpenFileNames(self,
-                        'Select Files', default_path, 'Images(*.asc);;all (*)')
-                for file_name in file_list:
-                    for im_han in self.image_handler:
-                        try:
-                            im_han.process(file_name)
-                            self.recent_label.setText(
-                                'Just processed: '+os.path.basename(file_name)) # only updates at end of loop
-                        except:
-                            print("\n WARNING: failed to load "+file_name)
+                        'Select Files', default_path, 'Images(*.asc *.npy *.raw *.tif *.tiff);;all (*)')
+                self.process_file_list(file_list)
                 self.update_stats()
                 if self.recent_label.text == 'Processing files...':
                     self.recent_label.setText('Finished Processing')
@@ -2069,18 +2596,27 @@ class main_window(QMainWindow):
                         os.path.join(image_storage_path,
                             '_' + date + '_' + dfn + '.asc') for dfn in list(map(str,
                             range(int(minmax[0]), int(minmax[1]))))]
-            for file_name in file_list:
-                try:
-                    for im_han in self.image_handler:
-                        im_han.process(file_name)
-                    self.recent_label.setText(
-                        'Just processed: '+os.path.basename(file_name)) # only updates at end of loop
-                except:
-                    print("\n WARNING: failed to load "+file_name) # probably file size was wrong
+            self.process_file_list(file_list)
             self.update_stats()
             if self.recent_label.text == 'Processing files...':
                 self.recent_label.setText('Finished Processing')
 
+    def process_file_list(self, file_list, chunk=64):
+        """Load the image files in chunks and process each chunk with all
+        of the image handlers at once. Files that fail to load are skipped.
+        The analysis lock is held while the counts are added so that they
+        aren't mixed with images from the analysis worker."""
+        for i in range(0, len(file_list), chunk):
+            stack, labels = self.image_handler[0].load_batch(file_list[i:i+chunk])
+            with self.analysis.lock:
+                for im_han in self.image_handler:
+                    im_han.process_batch(stack, labels)
+                if self.analysis.site_handler is not None:
+                    self.analysis.site_handler.process_batch(stack, labels)
+            if len(labels):
+                self.recent_label.setText(
+                    'Just processed: '+os.path.basename(file_list[min(i+chunk, len(file_list))-1])) # only updates at end of loop
+
     def load_from_csv(self, trigger=None):
         """Prompt the user to select a csv file to load histogram data from.
         It must have the specific layout that the image_handler saves in."""
@@ -2095,7 +2631,8 @@ class main_window(QMainWindow):
                     elif 'PyQt5' in sys.modules:
                         file_name, _ = QFileDialog.getOpenFileName(self, 'Select File for '+im_han.X,
                                                             default_path, 'csv(*.csv);;all (*)')
-                    im_han.load_from_csv(file_name)
+                    with self.analysis.lock:
+                        im_han.load_from_csv(file_name)
                 self.update_stats()
             except OSError:
                 pass # user cancelled - file not found
@@ -2105,9 +2642,9 @@ class main_window(QMainWindow):
         default_path = self.get_default_path(option='im')
         try:
             if 'PyQt4' in sys.modules:
-                file_name = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc);;all (*)')
+                file_name = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc *.npy *.raw *.tif *.tiff);;all (*)')
             elif 'PyQt5' in sys.modules:
-                file_name, _ = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc);;all (*)')
+                file_name, _ = QFileDialog.getOpenFileName(self, 'Select A File', default_path, 'Images (*.asc *.npy *.raw *.tif *.tiff);;all (*)')
             if file_name:  # avoid crash if the user cancelled
                 self.update_im(file_name)
         except OSError:
@@ -2155,11 +2692,24 @@ class main_window(QMainWindow):
                 self.dir_watcher.event_handler.write_t*scale)+unit)
             print("File copying duration: %.4g "%(
                 self.dir_watcher.event_handler.copy_t*scale)+unit)
+            if self.dir_watcher.archive:
+                print("File archiving duration: %.4g "%(
+                    self.dir_watcher.archive.copy_t*scale)+unit)
         else:
             print("Initiate the directory watcher before testing timings")
 
     #### #### UI management functions #### ####
 
+    def stop_analysis(self):
+        """Stop the sources of images first (the directory watcher, then the
+        frame bus), queue the files they have already emitted, then let the
+        analysis worker process everything in its queue before stopping."""
+        if self.dir_watcher:              # make sure that the directory watcher stops
+            self.dir_watcher.stop()
+        self.frame_bus.stop()             # save the frames waiting to be archived
+        QApplication.processEvents()      # deliver the file paths already emitted
+        self.analysis.stop()              # process the images in the queue
+
     def closeEvent(self, event):
         """Prompt user to save data on closing"""
         # Stops frame watch thread if running
@@ -2169,13 +2719,11 @@ class main_window(QMainWindow):
             "Save before closing?", QMessageBox.Save |
             QMessageBox.Discard | QMessageBox.Cancel, QMessageBox.Cancel)
         if reply == QMessageBox.Save:
+            self.stop_analysis()
             self.save_hist_data()         # save current state
-            if self.dir_watcher:          # make sure that the directory watcher stops
-                self.dir_watcher.observer.stop()
             event.accept()
         elif reply == QMessageBox.Discard:
-            if self.dir_watcher: # make sure that the directory watcher stops
-                self.dir_watcher.observer.stop()
+            self.stop_analysis()
             event.accept()
         else:
             event.ignore()